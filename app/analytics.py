@@ -0,0 +1,286 @@
+"""
+Usage analytics rollups for FastAPI MindWeb Application
+Per-minute and per-hour counters per room (class), updated in the same
+transaction as each message insert, so dashboards read a few pre-aggregated
+rows instead of scanning messages and users
+
+Each bucket holds message counts by type, distinct active users (users who
+sent a message), the AI answer count and average AI latency. Room '*' covers
+all rooms. Minute buckets are pruned after ANALYTICS_MINUTE_RETENTION_HOURS;
+hour buckets are kept, and they outlive message retention.
+
+Build rollups from existing history with:
+    python -m app.analytics backfill [--batch-size 1000]
+"""
+
+import argparse
+import asyncio
+import json
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import event, select, delete, func, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database import Message, UsageRollup, UsageRollupUser, AsyncSessionLocal, init_db
+from app.settings import get_settings
+from app.utils.logger import setup_logger
+
+logger = setup_logger("Analytics")
+
+GRANULARITIES = ('minute', 'hour')
+ALL_ROOMS = '*'
+_COUNTERS = (
+    'user_messages', 'ai_messages', 'other_messages',
+    'ai_duration_samples', 'ai_duration_ms_sum', 'ai_ttft_samples', 'ai_ttft_ms_sum',
+)
+
+
+def bucket_start(ts: Optional[datetime], granularity: str) -> datetime:
+    """Naive UTC start of the minute or hour containing ts"""
+    if ts is None:
+        ts = datetime.now(timezone.utc)
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    if granularity == 'hour':
+        return ts.replace(minute=0, second=0, microsecond=0)
+    return ts.replace(second=0, microsecond=0)
+
+
+def message_facts(message_type: str, raw_metadata: Optional[str]) -> Tuple[str, Dict[str, float]]:
+    """(room, counter deltas) contributed by one message"""
+    try:
+        metadata = json.loads(raw_metadata) if raw_metadata else {}
+    except ValueError:
+        metadata = {}
+    deltas: Dict[str, float] = dict.fromkeys(_COUNTERS, 0)
+    if message_type == 'user':
+        deltas['user_messages'] = 1
+    elif message_type == 'ai':
+        deltas['ai_messages'] = 1
+        if metadata.get('duration_ms') is not None:
+            deltas['ai_duration_samples'] = 1
+            deltas['ai_duration_ms_sum'] = float(metadata['duration_ms'])
+        if metadata.get('ttft_ms') is not None:
+            deltas['ai_ttft_samples'] = 1
+            deltas['ai_ttft_ms_sum'] = float(metadata['ttft_ms'])
+    else:
+        deltas['other_messages'] = 1
+    return metadata.get('room') or 'lobby', deltas
+
+
+def _bucket_keys(room: str, created_at: Optional[datetime]) -> Iterable[Tuple[str, str, datetime]]:
+    for granularity in GRANULARITIES:
+        start = bucket_start(created_at, granularity)
+        yield granularity, room, start
+        yield granularity, ALL_ROOMS, start
+
+
+def _upsert_rollup(granularity: str, room: str, start: datetime, deltas: Dict[str, float],
+                   new_users: int = 0):
+    stmt = sqlite_insert(UsageRollup).values(
+        granularity=granularity, room=room, bucket_start=start, active_users=new_users, **deltas
+    )
+    increments = {name: getattr(UsageRollup, name) + stmt.excluded[name] for name in _COUNTERS}
+    increments['active_users'] = UsageRollup.active_users + stmt.excluded.active_users
+    return stmt.on_conflict_do_update(
+        index_elements=[UsageRollup.granularity, UsageRollup.room, UsageRollup.bucket_start],
+        set_=increments
+    )
+
+
+def _add_member(granularity: str, room: str, start: datetime, user_id: str):
+    return sqlite_insert(UsageRollupUser).values(
+        granularity=granularity, room=room, bucket_start=start, user_id=user_id
+    ).on_conflict_do_nothing()
+
+
+@event.listens_for(Message, "after_insert")
+def _roll_up_inserted_message(mapper, connection, target):
+    """Count new messages into their rollup buckets inside the same transaction"""
+    if not get_settings().analytics_enabled:
+        return
+    room, deltas = message_facts(target.message_type, target.message_metadata)
+    for granularity, bucket_room, start in _bucket_keys(room, target.created_at):
+        new_users = 0
+        if target.message_type == 'user' and target.user_id:
+            # rowcount is 0 when the user was already counted in this bucket
+            new_users = connection.execute(_add_member(granularity, bucket_room, start, target.user_id)).rowcount
+        connection.execute(_upsert_rollup(granularity, bucket_room, start, deltas, new_users))
+
+
+def _row_to_dict(row: UsageRollup) -> Dict[str, Any]:
+    return {
+        'bucket': row.bucket_start.isoformat() + 'Z',
+        'room': row.room,
+        'messages': row.user_messages + row.ai_messages + row.other_messages,
+        'user_messages': row.user_messages,
+        'ai_messages': row.ai_messages,
+        'other_messages': row.other_messages,
+        'active_users': row.active_users,
+        'avg_ai_duration_ms': round(row.ai_duration_ms_sum / row.ai_duration_samples, 1)
+        if row.ai_duration_samples else None,
+        'avg_ttft_ms': round(row.ai_ttft_ms_sum / row.ai_ttft_samples, 1) if row.ai_ttft_samples else None,
+    }
+
+
+async def rollup_series(
+    db: AsyncSession,
+    granularity: str = 'hour',
+    room: str = ALL_ROOMS,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    limit: int = 48
+) -> List[Dict[str, Any]]:
+    """Most recent `limit` buckets in [start, end), oldest first; buckets without messages are absent.
+    An index range read on the primary key, independent of message volume."""
+    query = select(UsageRollup).where(
+        UsageRollup.granularity == granularity,
+        UsageRollup.room == room
+    )
+    if start:
+        query = query.where(UsageRollup.bucket_start >= bucket_start(start, granularity))
+    if end:
+        query = query.where(UsageRollup.bucket_start < bucket_start(end, granularity))
+    query = query.order_by(UsageRollup.bucket_start.desc()).limit(limit)
+    rows = (await db.execute(query)).scalars().all()
+    return [_row_to_dict(row) for row in reversed(rows)]
+
+
+async def prune_minutes(db: AsyncSession, retention_hours: int) -> int:
+    """Drop minute buckets older than the retention window"""
+    cutoff = bucket_start(datetime.now(timezone.utc) - timedelta(hours=retention_hours), 'minute')
+    result = await db.execute(delete(UsageRollup).where(
+        UsageRollup.granularity == 'minute', UsageRollup.bucket_start < cutoff
+    ))
+    await db.execute(delete(UsageRollupUser).where(
+        UsageRollupUser.granularity == 'minute', UsageRollupUser.bucket_start < cutoff
+    ))
+    await db.commit()
+    return result.rowcount
+
+
+async def prune_loop(interval: float = 3600.0):
+    """Background task: prune old minute buckets until cancelled"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            async with AsyncSessionLocal() as db:
+                pruned = await prune_minutes(db, get_settings().analytics_minute_retention_hours)
+            if pruned:
+                logger.info(f"Pruned {pruned} minute rollup buckets")
+        except Exception as e:
+            logger.error(f"Rollup pruning failed: {e}")
+
+
+async def _rebuild_floors(db: AsyncSession, minute_cutoff: datetime) -> Dict[str, Tuple[datetime, bool]]:
+    """Per granularity, the first bucket backfill rebuilds and whether that bucket is kept as is.
+    Buckets before the oldest remaining message hold counts of messages retention already
+    removed and are never touched. The bucket holding the oldest message is kept too when it
+    exists, because retention may have removed its earlier messages."""
+    oldest = (await db.execute(select(func.min(Message.created_at)))).scalar()
+    floors = {}
+    for granularity in GRANULARITIES:
+        start = bucket_start(oldest, granularity)
+        if granularity == 'minute' and start < minute_cutoff:
+            floors[granularity] = (minute_cutoff, False)
+            continue
+        existing = (await db.execute(select(UsageRollup.bucket_start).where(
+            UsageRollup.granularity == granularity, UsageRollup.bucket_start == start
+        ).limit(1))).scalar()
+        floors[granularity] = (start, existing is not None)
+    return floors
+
+
+async def backfill(batch_size: int = 1000, pause: float = 0.05) -> int:
+    """Rebuild rollups from the messages table.
+    Rollups covering the remaining messages are cleared and the current last
+    message id noted in one write transaction; older messages are then counted
+    here, newer ones by the insert hook, so nothing is counted twice while the
+    server keeps running. Hour buckets older than the remaining messages are kept."""
+    await init_db()
+    retention_hours = get_settings().analytics_minute_retention_hours
+    minute_cutoff = bucket_start(datetime.now(timezone.utc) - timedelta(hours=retention_hours), 'minute')
+
+    async with AsyncSessionLocal() as db:
+        floors = await _rebuild_floors(db, minute_cutoff)
+        for granularity, (floor, keep_floor) in floors.items():
+            for model in (UsageRollup, UsageRollupUser):
+                await db.execute(delete(model).where(
+                    model.granularity == granularity,
+                    model.bucket_start > floor if keep_floor else model.bucket_start >= floor
+                ))
+        # Read after the deletes, which hold the write lock until commit
+        max_id = (await db.execute(select(func.max(Message.id)))).scalar() or 0
+        await db.commit()
+
+    counters: Dict[Tuple[str, str, datetime], Dict[str, float]] = {}
+    members: Dict[Tuple[str, str, datetime], Set[str]] = {}
+    last_id, scanned = 0, 0
+    while last_id < max_id:
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(
+                select(Message.id, Message.message_type, Message.user_id,
+                       Message.created_at, Message.message_metadata)
+                .where(Message.id > last_id, Message.id <= max_id)
+                .order_by(Message.id).limit(batch_size)
+            )).all()
+        if not rows:
+            break
+        for row in rows:
+            room, deltas = message_facts(row.message_type, row.message_metadata)
+            for key in _bucket_keys(room, row.created_at):
+                floor, keep_floor = floors[key[0]]
+                if key[2] < floor or (keep_floor and key[2] == floor):
+                    continue
+                totals = counters.setdefault(key, dict.fromkeys(_COUNTERS, 0))
+                for name, value in deltas.items():
+                    totals[name] += value
+                if row.message_type == 'user' and row.user_id:
+                    members.setdefault(key, set()).add(row.user_id)
+        last_id = rows[-1].id
+        scanned += len(rows)
+        logger.info(f"Scanned {scanned} messages (up to id {last_id})")
+        await asyncio.sleep(pause)
+
+    keys = list(counters)
+    for offset in range(0, len(keys), batch_size):
+        async with AsyncSessionLocal() as db:
+            for key in keys[offset:offset + batch_size]:
+                granularity, room, start = key
+                for user_id in members.get(key, ()):
+                    await db.execute(_add_member(granularity, room, start, user_id))
+                await db.execute(_upsert_rollup(granularity, room, start, counters[key]))
+                # Live inserts may have counted some of these users already: recount
+                await db.execute(update(UsageRollup).where(
+                    UsageRollup.granularity == granularity,
+                    UsageRollup.room == room,
+                    UsageRollup.bucket_start == start
+                ).values(active_users=select(func.count()).where(
+                    UsageRollupUser.granularity == granularity,
+                    UsageRollupUser.room == room,
+                    UsageRollupUser.bucket_start == start
+                ).scalar_subquery()))
+            await db.commit()
+        await asyncio.sleep(pause)
+    logger.info(f"Backfilled {len(keys)} rollup buckets from {scanned} messages")
+    return scanned
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MindWeb usage analytics rollups")
+    sub = parser.add_subparsers(dest='command', required=True)
+    backfill_parser = sub.add_parser('backfill', help='Rebuild rollups from existing messages')
+    backfill_parser.add_argument('--batch-size', type=int, default=1000)
+    backfill_parser.add_argument('--pause', type=float, default=0.05,
+                                 help='Seconds to sleep between batches')
+    args = parser.parse_args()
+
+    if args.command == 'backfill':
+        total = asyncio.run(backfill(args.batch_size, args.pause))
+        print(f"Counted {total} messages into rollups")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+Broadcast fan-out benchmark for FastAPI MindWeb Application
+Drives the real /api/chat/broadcast SSE route in-process with many listeners
+while AI-style chunks are broadcast at a fixed rate. Each ASGI body send is
+written to /dev/null, so every send costs a real syscall.
+
+Reports, per configuration: events delivered and ASGI sends per second,
+events dropped by full listener queues, average bytes per send and CPU time
+per listener.
+
+Command line:
+    python -m app.benchmark sse --listeners 200 --rate 500 --seconds 5
+    python -m app.benchmark sse --batch-bytes 0 65536 --window-ms 0 5
+"""
+
+import argparse
+import asyncio
+import os
+import time
+from dataclasses import replace
+from typing import Dict, List
+
+from fastapi import FastAPI
+
+from app.broadcast_manager import broadcast_manager
+from app.connection_registry import connection_registry
+from app.routes import chat
+from app.settings import get_settings
+
+
+class _Sink:
+    """ASGI send target counting body writes"""
+
+    def __init__(self, fd: int):
+        self.fd = fd
+        self.sends = 0
+        self.bytes = 0
+
+    async def __call__(self, message: dict):
+        if message['type'] == 'http.response.body':
+            body = message.get('body', b'')
+            if body:
+                os.write(self.fd, body)
+                self.sends += 1
+                self.bytes += len(body)
+
+
+async def _never_disconnect():
+    await asyncio.Event().wait()
+
+
+def _build_app(batch_bytes: int, window_ms: float) -> FastAPI:
+    app = FastAPI()
+    app.include_router(chat.router, prefix="/api/chat")
+    app.state.settings = replace(get_settings(), sse_batch_max_bytes=batch_bytes,
+                                 sse_batch_window_ms=window_ms)
+    return app
+
+
+async def run_sse(listeners: int, rate: int, seconds: float, chunk: str,
+                  batch_bytes: int, window_ms: float) -> Dict[str, float]:
+    app = _build_app(batch_bytes, window_ms)
+    # No caps while benchmarking
+    connection_registry.apply_settings(replace(get_settings(), sse_max_connections=0,
+                                               sse_max_per_user=0, sse_max_per_ip=0))
+    fd = os.open(os.devnull, os.O_WRONLY)
+    sinks: List[_Sink] = []
+    tasks = []
+    for _ in range(listeners):
+        sink = _Sink(fd)
+        sinks.append(sink)
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+            'method': 'GET', 'scheme': 'http', 'path': '/api/chat/broadcast',
+            'raw_path': b'/api/chat/broadcast', 'query_string': b'rooms=bench',
+            'headers': [], 'client': None, 'server': ('bench', 80), 'app': app,
+        }
+        tasks.append(asyncio.create_task(app(scope, _never_disconnect, sink)))
+    while broadcast_manager.listener_count < listeners:
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(0.1)
+    base_sends = sum(s.sends for s in sinks)
+    base_bytes = sum(s.bytes for s in sinks)
+    base_events = sum(c.events_sent for c in connection_registry.connections.values())
+
+    cpu_start = time.process_time()
+    started = time.perf_counter()
+    sent = 0
+    stream_id = f"bench-{batch_bytes}-{window_ms}"
+    while (elapsed := time.perf_counter() - started) < seconds:
+        due = int(elapsed * rate)
+        while sent < due:
+            await broadcast_manager.broadcast(
+                {'type': 'ai_message_chunk', 'stream_id': stream_id, 'content': chunk}, 'bench'
+            )
+            sent += 1
+        await asyncio.sleep(0.001)
+    # Let listeners drain what is queued
+    for _ in range(200):
+        if all(c.queue.empty() for c in connection_registry.connections.values()):
+            break
+        await asyncio.sleep(0.005)
+    wall = time.perf_counter() - started
+    cpu = time.process_time() - cpu_start
+    await broadcast_manager.broadcast({'type': 'ai_message_end', 'stream_id': stream_id}, 'bench')
+
+    sends = sum(s.sends for s in sinks) - base_sends
+    written = sum(s.bytes for s in sinks) - base_bytes
+    # Full queues drop their oldest events, so count what was actually written
+    delivered = sum(c.events_sent for c in connection_registry.connections.values()) - base_events
+    for conn in list(connection_registry.connections.values()):
+        connection_registry.close(conn, 'benchmark')
+    await asyncio.gather(*tasks, return_exceptions=True)
+    os.close(fd)
+    return {
+        'batch_bytes': batch_bytes,
+        'window_ms': window_ms,
+        'events_per_s': round(delivered / wall),
+        'dropped_percent': round(100 - delivered * 100 / (sent * listeners), 1) if sent else 0.0,
+        'sends_per_s': round(sends / wall),
+        'bytes_per_send': round(written / sends) if sends else 0,
+        'cpu_ms_per_listener_s': round(cpu * 1000 / listeners / wall, 3),
+        'cpu_percent': round(cpu * 100 / wall, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MindWeb broadcast benchmarks")
+    sub = parser.add_subparsers(dest='command', required=True)
+    sse = sub.add_parser('sse', help='SSE fan-out: sends/s and CPU per listener')
+    sse.add_argument('--listeners', type=int, default=200)
+    sse.add_argument('--rate', type=int, default=500, help='Chunks broadcast per second')
+    sse.add_argument('--seconds', type=float, default=5.0)
+    sse.add_argument('--chunk', default='token ', help='Content of each chunk')
+    sse.add_argument('--batch-bytes', type=int, nargs='+', default=[0, get_settings().sse_batch_max_bytes],
+                     help='SSE_BATCH_MAX_BYTES values to compare (0 = one event per write)')
+    sse.add_argument('--window-ms', type=float, nargs='+', default=[0.0],
+                     help='SSE_BATCH_WINDOW_MS values to compare')
+    args = parser.parse_args()
+
+    columns = ('batch_bytes', 'window_ms', 'events_per_s', 'dropped_percent', 'sends_per_s', 'bytes_per_send',
+               'cpu_ms_per_listener_s', 'cpu_percent')
+    print(' '.join(f"{c:>21}" for c in columns))
+    for batch_bytes in args.batch_bytes:
+        for window_ms in args.window_ms:
+            result = asyncio.run(run_sse(args.listeners, args.rate, args.seconds, args.chunk,
+                                         batch_bytes, window_ms))
+            print(' '.join(f"{result[c]:>21}" for c in columns))
+
+
+if __name__ == "__main__":
+    main()
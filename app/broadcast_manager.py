@@ -1,70 +1,338 @@
 """
 Broadcast Manager for FastAPI MindWeb Application
-Handles real-time streaming to all connected users via SSE only
+Handles real-time streaming to connected users, scoped by room/topic
 """
 
 import asyncio
 import json
+import re
 import time
-from typing import Dict, Any, Set
+import uuid
+from collections import OrderedDict, deque
+from typing import Dict, Any, Set, Iterable, List, Optional, Tuple
+from app.event_journal import EventJournal
+from app.settings import Settings, get_settings, on_reload
 from app.utils.logger import setup_logger
 
 logger = setup_logger("BroadcastManager")
 
+# Room every listener joins unless it asks for specific rooms
+DEFAULT_ROOM = "lobby"
+# Events that close an in-flight AI stream
+STREAM_END_TYPES = {'ai_message_end', 'ai_message_cancelled', 'ai_message_timeout', 'error'}
+# Fields copied from the first chunk of a stream into its snapshot header
+_STREAM_HEADER_FIELDS = (
+    'stream_id', 'conversation_id', 'reply_to_username', 'reply_to_user_id',
+    'prompt', 'from_user', 'from_user_id'
+)
+_ROOM_PATTERN = re.compile(r'^[\w\-:.]{1,64}$')
+# Keepalive queued to idle listeners; one shared instance so transports can pre-encode it
+PING_EVENT = {'type': 'ping'}
+
+
+def normalize_room(room: Optional[str]) -> str:
+    """Validate a room name; empty means the default room"""
+    if not room:
+        return DEFAULT_ROOM
+    room = room.strip()
+    if not _ROOM_PATTERN.match(room):
+        raise ValueError(f"Invalid room name: {room!r}")
+    return room
+
+
+def parse_rooms(rooms: Optional[str]) -> List[str]:
+    """Parse a comma-separated room list (query parameter form)"""
+    if not rooms:
+        return [DEFAULT_ROOM]
+    parsed = [normalize_room(r) for r in rooms.split(',') if r.strip()]
+    return parsed or [DEFAULT_ROOM]
+
+
+class StreamAggregate:
+    """Header of an in-flight AI stream plus the text streamed so far"""
+
+    __slots__ = ('header', 'room', 'parts', 'last_event_id', 'updated_at')
+
+    def __init__(self, chunk: Dict[str, Any], room: str):
+        self.header = {k: chunk.get(k) for k in _STREAM_HEADER_FIELDS}
+        self.room = room
+        self.parts: List[str] = []
+        self.last_event_id = 0
+        self.updated_at = time.time()
+
+    def append(self, chunk: Dict[str, Any]):
+        self.parts.append(chunk.get('content') or '')
+        self.last_event_id = chunk['event_id']
+        self.updated_at = time.time()
+
+    def snapshot(self) -> Dict[str, Any]:
+        content = ''.join(self.parts)
+        # Compact the parts so repeated snapshots stay cheap
+        self.parts = [content]
+        return {
+            'type': 'ai_stream_snapshot',
+            **self.header,
+            'content': content,
+            'room': self.room,
+            'event_id': self.last_event_id,
+            'timestamp': int(self.updated_at * 1000),
+        }
+
+
 class BroadcastManager:
-    """Manages real-time broadcasting to connected SSE clients"""
-    
+    """Manages real-time broadcasting to connected clients, indexed by room"""
+
     def __init__(self):
-        self.sse_listeners: Set[asyncio.Queue] = set()
-        self.event_history = []
+        # room -> listener queues; fan-out only touches the target room
+        self.rooms: Dict[str, Set[asyncio.Queue]] = {}
+        # listener queue -> rooms it is subscribed to
+        self.listener_rooms: Dict[asyncio.Queue, Set[str]] = {}
+        # listener id -> queue, for subscribe/unsubscribe calls from other requests
+        self.listener_ids: Dict[str, asyncio.Queue] = {}
+        self.queue_ids: Dict[asyncio.Queue, str] = {}
+        # room -> recent events; least recently used rooms are evicted beyond max_rooms
+        self.room_history: "OrderedDict[str, deque]" = OrderedDict()
         self.max_history = 50
-        
-    def add_listener(self, queue: asyncio.Queue):
-        """Add SSE listener queue"""
-        self.sse_listeners.add(queue)
-        logger.debug(f"SSE listener added. Total listeners: {len(self.sse_listeners)}")
-    
+        self.max_rooms = 1000
+        self._event_seq = 0
+        # stream_id -> aggregated in-flight AI answer; chunks are kept here, not in history
+        self.active_streams: Dict[str, StreamAggregate] = {}
+        # Streams that never sent an end event (e.g. worker crash) are dropped after this
+        self.stream_max_idle = 30 * 60
+        # Shared heartbeat: listeners that asked for it get PING_EVENT once idle this long
+        self.heartbeat_interval = 30.0
+        # queue -> monotonic time of its last ping (or attach), for heartbeat listeners only
+        self.heartbeat_listeners: Dict[asyncio.Queue, float] = {}
+        # room -> monotonic time of its last broadcast; a listener is idle when all its rooms are
+        self.room_activity: Dict[str, float] = {}
+        self.heartbeats_sent = 0
+        # Optional on-disk journal of history events (see app/event_journal.py)
+        self.journal: Optional[EventJournal] = None
+
+    def apply_settings(self, settings: Settings):
+        self.heartbeat_interval = settings.sse_heartbeat_seconds
+
+    def attach_journal(self, journal: EventJournal) -> int:
+        """Load room history from the journal, continue event ids after the
+        last reserved one and journal new events from now on. Returns events loaded."""
+        loaded = 0
+        for event in journal.replay():
+            room = event.get('room') or DEFAULT_ROOM
+            self._room_history(room).append(event)
+            loaded += 1
+        self._event_seq = max(self._event_seq, journal.reserved_seq)
+        self.journal = journal
+        logger.info(f"Journal replayed {loaded} events; event ids continue after {self._event_seq}")
+        return loaded
+
+    @property
+    def listener_count(self) -> int:
+        return len(self.listener_rooms)
+
+    def add_listener(self, queue: asyncio.Queue, rooms: Optional[Iterable[str]] = None,
+                     heartbeat: bool = False) -> str:
+        """Add listener queue to the given rooms (default room if none). Returns a listener id.
+        With heartbeat, PING_EVENT is queued whenever the listener has been idle for the interval."""
+        listener_id = str(uuid.uuid4())
+        self.listener_ids[listener_id] = queue
+        self.queue_ids[queue] = listener_id
+        self.listener_rooms[queue] = set()
+        if heartbeat:
+            self.heartbeat_listeners[queue] = time.monotonic()
+        for room in (rooms or [DEFAULT_ROOM]):
+            self._join(queue, room)
+        logger.debug(f"Listener added. Total listeners: {self.listener_count}")
+        return listener_id
+
     def remove_listener(self, queue: asyncio.Queue):
-        """Remove SSE listener queue"""
-        self.sse_listeners.discard(queue)
-        logger.debug(f"SSE listener removed. Total listeners: {len(self.sse_listeners)}")
-    
-    async def broadcast(self, message: Dict[str, Any]):
-        """Broadcast message to all connected SSE clients"""
-        # Add timestamp and event ID
+        """Remove listener queue from all rooms"""
+        for room in self.listener_rooms.pop(queue, set()):
+            self._leave(queue, room)
+        self.heartbeat_listeners.pop(queue, None)
+        listener_id = self.queue_ids.pop(queue, None)
+        if listener_id is not None:
+            self.listener_ids.pop(listener_id, None)
+        logger.debug(f"Listener removed. Total listeners: {self.listener_count}")
+
+    def subscribe(self, listener_id: str, room: str) -> bool:
+        """Subscribe an existing listener to a room"""
+        queue = self.listener_ids.get(listener_id)
+        if queue is None:
+            return False
+        self._join(queue, normalize_room(room))
+        return True
+
+    def unsubscribe(self, listener_id: str, room: str) -> bool:
+        """Unsubscribe an existing listener from a room"""
+        queue = self.listener_ids.get(listener_id)
+        if queue is None:
+            return False
+        room = normalize_room(room)
+        self.listener_rooms.get(queue, set()).discard(room)
+        self._leave(queue, room)
+        return True
+
+    def get_rooms(self, listener_id: str) -> List[str]:
+        queue = self.listener_ids.get(listener_id)
+        return sorted(self.listener_rooms.get(queue, set())) if queue is not None else []
+
+    def _join(self, queue: asyncio.Queue, room: str):
+        self.rooms.setdefault(room, set()).add(queue)
+        self.listener_rooms.setdefault(queue, set()).add(room)
+
+    def _leave(self, queue: asyncio.Queue, room: str):
+        members = self.rooms.get(room)
+        if members is None:
+            return
+        members.discard(queue)
+        if not members:
+            del self.rooms[room]
+
+    def _room_history(self, room: str) -> deque:
+        history = self.room_history.get(room)
+        if history is None:
+            history = self.room_history[room] = deque(maxlen=self.max_history)
+            while len(self.room_history) > self.max_rooms:
+                self.room_history.popitem(last=False)
+        else:
+            self.room_history.move_to_end(room)
+        return history
+
+    async def broadcast(self, message: Dict[str, Any], room: str = DEFAULT_ROOM):
+        """Broadcast message to all listeners subscribed to the room"""
+        # Add timestamp and a monotonically increasing event ID
+        self._event_seq += 1
         message['timestamp'] = int(time.time() * 1000)
-        message['event_id'] = len(self.event_history) + 1
-        
-        # Add to history
-        self.event_history.append(message)
-        if len(self.event_history) > self.max_history:
-            self.event_history.pop(0)
-        
-        logger.debug(f"Broadcasting to {len(self.sse_listeners)} SSE clients: {message.get('type', 'unknown')}")
-        
-        # Send to SSE listeners
-        if self.sse_listeners:
-            disconnected_sse = set()
-            for queue in self.sse_listeners:
-                try:
-                    if queue.full():
-                        try:
-                            _ = queue.get_nowait()
-                        except asyncio.QueueEmpty:
-                            pass
-                    queue.put_nowait(message)
-                except asyncio.QueueFull:
-                    logger.debug("SSE queue full, dropping oldest message for this listener")
-                except Exception as e:
-                    logger.debug(f"Failed to send to SSE listener: {e}")
-                    disconnected_sse.add(queue)
-            
-            # Remove disconnected SSE listeners
-            self.sse_listeners -= disconnected_sse
-    
-    def get_recent_history(self, limit: int = 10):
-        """Get recent event history for new SSE clients"""
-        return self.event_history[-limit:] if self.event_history else []
+        message['event_id'] = self._event_seq
+        message['room'] = room
+        self.room_activity[room] = time.monotonic()
+
+        # Chunks are folded into the stream aggregate; everything else goes to room history
+        message_type = message.get('type')
+        stream_id = message.get('stream_id')
+        if message_type == 'ai_message_chunk' and stream_id:
+            aggregate = self.active_streams.get(stream_id)
+            if aggregate is None:
+                aggregate = self.active_streams[stream_id] = StreamAggregate(message, room)
+            aggregate.append(message)
+        else:
+            if message_type in STREAM_END_TYPES and stream_id:
+                aggregate = self.active_streams.pop(stream_id, None)
+                # Chunks never reach history: the end event carries the final text, so
+                # listeners that (re)connect after the stream closed still get the answer
+                if aggregate is not None and message_type != 'error' and 'content' not in message:
+                    message['content'] = ''.join(aggregate.parts)
+            self._room_history(room).append(message)
+        if self.journal is not None:
+            try:
+                if message_type == 'ai_message_chunk' and stream_id:
+                    self.journal.reserve(self._event_seq)
+                else:
+                    self.journal.append(message)
+            except OSError as e:
+                # Live delivery matters more than durability: keep broadcasting
+                logger.error(f"Journal write failed: {e}")
+
+        listeners = self.rooms.get(room)
+        if not listeners:
+            return
+        logger.debug(f"Broadcasting to {len(listeners)} listeners in {room}: {message.get('type', 'unknown')}")
+
+        disconnected = set()
+        for queue in listeners:
+            try:
+                if queue.full():
+                    try:
+                        _ = queue.get_nowait()
+                    except asyncio.QueueEmpty:
+                        pass
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                logger.debug("Listener queue full, dropping oldest message for this listener")
+            except Exception as e:
+                logger.debug(f"Failed to send to listener: {e}")
+                disconnected.add(queue)
+
+        # Remove disconnected listeners
+        for queue in disconnected:
+            self.remove_listener(queue)
+
+    def send_heartbeats(self) -> int:
+        """Queue PING_EVENT to heartbeat listeners none of whose rooms broadcast for the interval"""
+        now = time.monotonic()
+        interval = self.heartbeat_interval
+        sent = 0
+        for queue, last_ping in self.heartbeat_listeners.items():
+            last_active = last_ping
+            for room in self.listener_rooms.get(queue, ()):
+                last_active = max(last_active, self.room_activity.get(room, 0.0))
+            # A full queue is not draining: leave it to the connection reaper
+            if now - last_active >= interval and not queue.full():
+                queue.put_nowait(PING_EVENT)
+                self.heartbeat_listeners[queue] = now
+                sent += 1
+        # Forget activity of rooms nobody listens to any more
+        for room in [r for r in self.room_activity if r not in self.rooms]:
+            del self.room_activity[room]
+        self.heartbeats_sent += sent
+        return sent
+
+    async def heartbeat_loop(self):
+        """Background task: one ticker for every connection instead of a timer per connection.
+        Ticks at a third of the interval, so idle listeners are pinged within 1-1.33 intervals."""
+        while True:
+            await asyncio.sleep(max(self.heartbeat_interval / 3, 0.1))
+            try:
+                self.send_heartbeats()
+            except Exception as e:
+                logger.error(f"Heartbeat failed: {e}")
+
+    def get_recent_history(self, limit: int = 10, rooms: Optional[Iterable[str]] = None,
+                           after_event_id: Optional[int] = None):
+        """Get recent event history of the given rooms, oldest first.
+        With after_event_id, returns every retained event newer than it instead of the last `limit`."""
+        events = []
+        for room in (rooms or [DEFAULT_ROOM]):
+            history = self.room_history.get(room)
+            if not history:
+                continue
+            if after_event_id is not None:
+                events.extend(e for e in history if e['event_id'] > after_event_id)
+            else:
+                events.extend(list(history)[-limit:])
+        events.sort(key=lambda e: e['event_id'])
+        return events if after_event_id is not None else events[-limit:]
+
+    def get_stream_snapshots(self, rooms: Optional[Iterable[str]] = None) -> List[Dict[str, Any]]:
+        """One compact snapshot event per in-flight AI stream in the given rooms"""
+        room_set = set(rooms or [DEFAULT_ROOM])
+        now = time.time()
+        snapshots = []
+        for stream_id, aggregate in list(self.active_streams.items()):
+            if now - aggregate.updated_at > self.stream_max_idle:
+                del self.active_streams[stream_id]
+                continue
+            if aggregate.room in room_set:
+                snapshots.append(aggregate.snapshot())
+        return snapshots
+
+    def attach(self, queue: asyncio.Queue, rooms: Optional[Iterable[str]] = None,
+               last_event_id: Optional[int] = None, history_limit: int = 10,
+               heartbeat: bool = False) -> Tuple[str, List[Dict[str, Any]]]:
+        """Register a listener and return (listener_id, initial events) in one step.
+        Initial events are recent history (or everything after last_event_id when a
+        client resumes) and a snapshot of each in-flight stream, in event id order. Nothing is
+        awaited, so no live event can slip between the replay and the queue."""
+        rooms = list(rooms or [DEFAULT_ROOM])
+        listener_id = self.add_listener(queue, rooms, heartbeat)
+        initial = self.get_recent_history(history_limit, rooms, after_event_id=last_event_id)
+        initial.extend(self.get_stream_snapshots(rooms))
+        # A snapshot's id is its last chunk's, often older than the newest history
+        # event; sending in id order keeps the client's Last-Event-ID from going back
+        initial.sort(key=lambda e: e['event_id'])
+        return listener_id, initial
 
 # Global broadcast manager instance
 broadcast_manager = BroadcastManager()
+broadcast_manager.apply_settings(get_settings())
+on_reload(broadcast_manager.apply_settings)
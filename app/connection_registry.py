@@ -0,0 +1,195 @@
+"""
+Connection governance for broadcast listeners in FastAPI MindWeb Application
+Caps SSE connections globally, per user and per IP, replaces duplicate tabs,
+reaps connections that stopped draining, and accounts bytes and lag
+
+Limits come from settings (0 disables a cap) and can be reloaded at runtime:
+    SSE_MAX_CONNECTIONS=1000
+    SSE_MAX_PER_USER=5
+    SSE_MAX_PER_IP=0          # off by default: schools and offices share one NAT address
+    SSE_STALE_SECONDS=90      # no successful write for this long -> reaped
+    SSE_RETRY_MS=3000         # base reconnect delay sent as `retry:`
+    SSE_RETRY_JITTER_MS=2000  # random extra delay so reconnect storms spread out
+"""
+
+import asyncio
+import random
+import time
+import uuid
+from typing import Dict, Optional
+from app.broadcast_manager import broadcast_manager
+from app.settings import Settings, get_settings, on_reload
+from app.utils.logger import setup_logger
+
+logger = setup_logger("Connections")
+
+
+class ConnectionLimitExceeded(Exception):
+    """Raised when opening a connection would exceed a cap"""
+
+    def __init__(self, scope: str, retry_after: int):
+        super().__init__(f"Too many connections ({scope})")
+        self.scope = scope
+        self.retry_after = retry_after
+
+
+class Connection:
+    """One live broadcast connection and its accounting"""
+
+    def __init__(self, queue: asyncio.Queue, user_id: Optional[str], tab_id: Optional[str],
+                 client_ip: Optional[str], transport: str):
+        self.connection_id = str(uuid.uuid4())
+        self.queue = queue
+        self.user_id = user_id
+        self.tab_id = tab_id
+        self.client_ip = client_ip
+        self.transport = transport
+        self.listener_id: Optional[str] = None
+        self.opened_at = time.time()
+        self.last_write = time.monotonic()
+        self.bytes_sent = 0
+        self.events_sent = 0
+        self.close_reason: Optional[str] = None
+
+    @property
+    def closed(self) -> bool:
+        return self.close_reason is not None
+
+    def record_write(self, size: int, events: int = 1):
+        self.bytes_sent += size
+        self.events_sent += events
+        self.last_write = time.monotonic()
+
+    def to_dict(self) -> dict:
+        return {
+            'connection_id': self.connection_id,
+            'listener_id': self.listener_id,
+            'transport': self.transport,
+            'user_id': self.user_id,
+            'tab_id': self.tab_id,
+            'client_ip': self.client_ip,
+            'rooms': broadcast_manager.get_rooms(self.listener_id) if self.listener_id else [],
+            'age_ms': int((time.time() - self.opened_at) * 1000),
+            'lag': self.queue.qsize(),
+            'idle_ms': int((time.monotonic() - self.last_write) * 1000),
+            'bytes_sent': self.bytes_sent,
+            'events_sent': self.events_sent,
+        }
+
+
+class ConnectionRegistry:
+    """Live connections keyed by connection_id, with cap enforcement"""
+
+    def __init__(self, settings: Settings):
+        self.connections: Dict[str, Connection] = {}
+        self.counters = {'opened': 0, 'rejected': 0, 'replaced': 0, 'reaped': 0, 'disconnected': 0}
+        self.apply_settings(settings)
+
+    def apply_settings(self, settings: Settings):
+        """Take new limits; existing connections above a lowered cap are left alone"""
+        self.max_connections = settings.sse_max_connections
+        self.max_per_user = settings.sse_max_per_user
+        self.max_per_ip = settings.sse_max_per_ip
+        self.stale_seconds = settings.sse_stale_seconds
+        self.retry_ms = settings.sse_retry_ms
+        self.retry_jitter_ms = settings.sse_retry_jitter_ms
+
+    def retry_hint_ms(self) -> int:
+        """Reconnect delay with jitter for the SSE `retry:` field"""
+        return self.retry_ms + random.randint(0, max(self.retry_jitter_ms, 0))
+
+    def retry_after_seconds(self) -> int:
+        return max(1, round(self.retry_hint_ms() / 1000))
+
+    def _count(self, attr: str, value) -> int:
+        return sum(1 for c in self.connections.values() if getattr(c, attr) == value)
+
+    def open(self, queue: asyncio.Queue, user_id: Optional[str] = None, tab_id: Optional[str] = None,
+             client_ip: Optional[str] = None, transport: str = 'sse') -> Connection:
+        """Admit a connection or raise ConnectionLimitExceeded.
+        An older connection from the same user and tab is closed first."""
+        if user_id and tab_id:
+            for conn in list(self.connections.values()):
+                if conn.user_id == user_id and conn.tab_id == tab_id:
+                    self.close(conn, 'replaced')
+
+        if self.max_connections and len(self.connections) >= self.max_connections:
+            scope = 'global'
+        elif user_id and self.max_per_user and self._count('user_id', user_id) >= self.max_per_user:
+            scope = 'user'
+        elif client_ip and self.max_per_ip and self._count('client_ip', client_ip) >= self.max_per_ip:
+            scope = 'ip'
+        else:
+            scope = None
+        if scope:
+            self.counters['rejected'] += 1
+            logger.warning(f"Rejected {transport} connection ({scope} cap) user={user_id} ip={client_ip}")
+            raise ConnectionLimitExceeded(scope, self.retry_after_seconds())
+
+        conn = Connection(queue, user_id, tab_id, client_ip, transport)
+        self.connections[conn.connection_id] = conn
+        self.counters['opened'] += 1
+        return conn
+
+    def close(self, conn: Connection, reason: str):
+        """Detach a connection from the broadcast manager and wake its sender with a None sentinel"""
+        if conn.closed:
+            return
+        conn.close_reason = reason
+        self.connections.pop(conn.connection_id, None)
+        broadcast_manager.remove_listener(conn.queue)
+        if reason in self.counters:
+            self.counters[reason] += 1
+        if conn.queue.full():
+            try:
+                conn.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                pass
+        conn.queue.put_nowait(None)
+        if reason != 'disconnected':
+            logger.info(f"Connection {conn.connection_id[:8]} closed ({reason})")
+
+    def reap(self) -> int:
+        """Close connections whose sender has not completed a write for stale_seconds.
+        Idle SSE listeners are sent a shared heartbeat ping (SSE_HEARTBEAT_SECONDS), so any
+        long silence means the client is gone; WebSockets only count as stale with
+        undelivered events queued."""
+        now = time.monotonic()
+        stale = [
+            c for c in self.connections.values()
+            if now - c.last_write > self.stale_seconds
+            and (c.transport == 'sse' or c.queue.qsize() > 0)
+        ]
+        for conn in stale:
+            self.close(conn, 'reaped')
+        return len(stale)
+
+    async def reap_loop(self, interval: float = 30.0):
+        """Background task: reap stale connections until cancelled"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                reaped = self.reap()
+                if reaped:
+                    logger.info(f"Reaped {reaped} stale connections")
+            except Exception as e:
+                logger.error(f"Connection reap failed: {e}")
+
+    def snapshot(self) -> dict:
+        return {
+            'count': len(self.connections),
+            'limits': {
+                'max_connections': self.max_connections,
+                'max_per_user': self.max_per_user,
+                'max_per_ip': self.max_per_ip,
+                'stale_seconds': self.stale_seconds,
+            },
+            'counters': dict(self.counters),
+            'connections': sorted((c.to_dict() for c in self.connections.values()),
+                                  key=lambda d: d['age_ms'], reverse=True),
+        }
+
+
+# Global connection registry instance
+connection_registry = ConnectionRegistry(get_settings())
+on_reload(connection_registry.apply_settings)
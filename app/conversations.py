@@ -0,0 +1,194 @@
+"""
+Conversation summaries for FastAPI MindWeb Application
+Keeps a summary on each conversation row (last message preview, message
+count, last activity, Dify conversation link and the backend that owns it), updated in the same
+transaction as every message insert, so a user's conversation list is one
+index range scan on (user_id, updated_at) instead of subqueries over messages
+"""
+
+import base64
+import binascii
+import json
+import re
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import event, select, update, func, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database import Conversation, Message, AsyncSessionLocal
+from app.utils.logger import setup_logger
+
+logger = setup_logger("Conversations")
+
+PREVIEW_LENGTH = 120
+_WHITESPACE = re.compile(r'\s+')
+
+
+def preview_text(content: Optional[str]) -> str:
+    """One-line excerpt of a message for the conversation list"""
+    text = _WHITESPACE.sub(' ', content or '').strip()
+    return text if len(text) <= PREVIEW_LENGTH else text[:PREVIEW_LENGTH - 1] + '…'
+
+
+def _upstream_link(raw_metadata: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+    """(Dify conversation id, backend name) recorded in an AI message's metadata"""
+    try:
+        metadata = json.loads(raw_metadata) if raw_metadata else {}
+    except ValueError:
+        return None, None
+    upstream = metadata.get('upstream') or {}
+    return upstream.get('conversation_id'), upstream.get('backend')
+
+
+@event.listens_for(Message, "after_insert")
+def _summarize_inserted_message(mapper, connection, target):
+    """Fold a new message into its conversation's summary inside the same transaction"""
+    if not target.conversation_id:
+        return
+    values = {
+        'message_count': func.coalesce(Conversation.message_count, 0) + 1,
+        'last_message_preview': preview_text(target.content),
+        'last_message_type': target.message_type,
+        'last_message_at': target.created_at,
+        'updated_at': target.created_at,
+    }
+    if target.message_type == 'ai':
+        dify_conversation_id, dify_backend = _upstream_link(target.message_metadata)
+        if dify_conversation_id:
+            values['dify_conversation_id'] = dify_conversation_id
+            values['dify_backend'] = dify_backend
+    # Group messages share a conversation id with no row; this updates nothing for them
+    connection.execute(
+        update(Conversation.__table__)
+        .where(Conversation.__table__.c.conversation_id == target.conversation_id)
+        .values(**values)
+    )
+
+
+async def uncount_messages(db: AsyncSession, messages: List[Message]):
+    """Decrement counts for messages removed in bulk (deletes that bypass ORM events)"""
+    removed: Dict[str, int] = {}
+    for message in messages:
+        if message.conversation_id:
+            removed[message.conversation_id] = removed.get(message.conversation_id, 0) + 1
+    for conversation_id, count in removed.items():
+        await db.execute(
+            update(Conversation)
+            .where(Conversation.conversation_id == conversation_id)
+            .values(message_count=func.max(func.coalesce(Conversation.message_count, 0) - count, 0),
+                    updated_at=Conversation.updated_at)
+        )
+
+
+async def set_dify_conversation(db: AsyncSession, conversation_id: str, dify_conversation_id: Optional[str],
+                                dify_backend: Optional[str] = None):
+    """Record (or with None, forget) the Dify conversation behind one of ours and its backend"""
+    await db.execute(
+        update(Conversation)
+        .where(Conversation.conversation_id == conversation_id)
+        .values(dify_conversation_id=dify_conversation_id, dify_backend=dify_backend,
+                updated_at=Conversation.updated_at)
+    )
+
+
+async def dify_conversation_for(db: AsyncSession, conversation_id: str,
+                                user_id: str) -> Tuple[Optional[str], Optional[str]]:
+    """The stored (Dify conversation id, backend name), if the conversation belongs to user_id"""
+    row = (await db.execute(
+        select(Conversation.dify_conversation_id, Conversation.dify_backend).where(
+            Conversation.conversation_id == conversation_id,
+            Conversation.user_id == user_id
+        )
+    )).first()
+    return (row.dify_conversation_id, row.dify_backend) if row else (None, None)
+
+
+def encode_cursor(conversation: Conversation) -> str:
+    raw = f"{conversation.updated_at.isoformat()}|{conversation.id}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """(updated_at, id) of the last row of the previous page; ValueError when malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        stamp, _, row_id = raw.partition('|')
+        return datetime.fromisoformat(stamp), int(row_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError("Invalid cursor")
+
+
+async def list_conversations(
+    db: AsyncSession,
+    user_id: str,
+    limit: int = 20,
+    cursor: Optional[str] = None
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """A user's conversations, most recently active first, and the cursor of the next page.
+    Keyset pagination on (updated_at, id), read in index order from ix_conversation_user_updated."""
+    query = select(Conversation).where(Conversation.user_id == user_id)
+    if cursor:
+        updated_at, row_id = decode_cursor(cursor)
+        query = query.where(tuple_(Conversation.updated_at, Conversation.id) < tuple_(updated_at, row_id))
+    query = query.order_by(Conversation.updated_at.desc(), Conversation.id.desc()).limit(limit + 1)
+    rows = (await db.execute(query)).scalars().all()
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return [row.to_dict() for row in rows[:limit]], next_cursor
+
+
+async def backfill_summaries(batch_size: int = 500) -> int:
+    """Fill summaries of conversations created before they were maintained
+    (message_count still NULL). Runs at startup; a no-op once done."""
+    filled = 0
+    while True:
+        async with AsyncSessionLocal() as db:
+            ids = (await db.execute(
+                select(Conversation.conversation_id)
+                .where(Conversation.message_count.is_(None))
+                .limit(batch_size)
+            )).scalars().all()
+            if not ids:
+                return filled
+            counts = {
+                row.conversation_id: row for row in (await db.execute(
+                    select(Message.conversation_id,
+                           func.count().label('count'),
+                           func.max(Message.created_at).label('last_at'))
+                    .where(Message.conversation_id.in_(ids))
+                    .group_by(Message.conversation_id)
+                )).all()
+            }
+            # Newest message per conversation; read through the ORM so compressed content is decoded
+            ranked = select(
+                Message.id,
+                func.row_number().over(
+                    partition_by=Message.conversation_id,
+                    order_by=(Message.created_at.desc(), Message.id.desc())
+                ).label('rank')
+            ).where(Message.conversation_id.in_(ids)).subquery()
+            latest = {
+                m.conversation_id: m for m in (await db.execute(
+                    select(Message).join(ranked, Message.id == ranked.c.id).where(ranked.c.rank == 1)
+                )).scalars().all()
+            }
+            for conversation_id in ids:
+                stats = counts.get(conversation_id)
+                last = latest.get(conversation_id)
+                # Explicit updated_at keeps the column's onupdate from reordering the list
+                values: Dict[str, Any] = {'message_count': stats.count if stats else 0,
+                                          'updated_at': Conversation.updated_at}
+                if last is not None:
+                    values.update(
+                        last_message_preview=preview_text(last.content),
+                        last_message_type=last.message_type,
+                        last_message_at=stats.last_at,
+                    )
+                await db.execute(
+                    update(Conversation)
+                    .where(Conversation.conversation_id == conversation_id)
+                    .values(**values)
+                )
+            await db.commit()
+            filled += len(ids)
+            logger.info(f"Backfilled summaries of {filled} conversations")
@@ -5,14 +5,28 @@ Using SQLite for simplicity and robustness
 
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from sqlalchemy.orm import declarative_base, sessionmaker
-from sqlalchemy import Column, Integer, String, Text, DateTime, Boolean, Index
+from sqlalchemy import Column, Integer, Float, String, Text, DateTime, Boolean, Index, event, inspect
 from datetime import datetime, timezone
 import os
+from app.utils.compression import CompressedText
 
 # Create async engine for SQLite
 DATABASE_URL = "sqlite+aiosqlite:///./mindweb.db"
 engine = create_async_engine(DATABASE_URL, echo=False)
 
+@event.listens_for(engine.sync_engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """WAL lets long reads (exports, search backfill) run alongside live chat writes"""
+    cursor = dbapi_connection.cursor()
+    # Must precede journal_mode=WAL, which writes the header of a new file; only
+    # takes effect on a fresh database file and lets the retention job return
+    # freed pages to the OS (existing files: python -m app.retention --enable-incremental-vacuum)
+    cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
 # Create async session maker
 AsyncSessionLocal = async_sessionmaker(
     engine, 
@@ -56,6 +70,19 @@ class Conversation(Base):
     title = Column(String(200))
     created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
     updated_at = Column(DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
+    # Summary maintained on every message insert (see app/conversations.py)
+    message_count = Column(Integer, default=0)
+    last_message_preview = Column(String(200))
+    last_message_type = Column(String(20))
+    last_message_at = Column(DateTime)
+    dify_conversation_id = Column(String(100))
+    # DifyPool backend that owns dify_conversation_id (see app/dify_pool.py)
+    dify_backend = Column(String(100))
+    
+    __table_args__ = (
+        # Conversation list: one user's rows, most recently active first
+        Index('ix_conversation_user_updated', 'user_id', 'updated_at'),
+    )
     
     def to_dict(self):
         return {
@@ -64,7 +91,13 @@ class Conversation(Base):
             'user_id': self.user_id,
             'title': self.title,
             'created_at': self.created_at.isoformat(),
-            'updated_at': self.updated_at.isoformat()
+            'updated_at': self.updated_at.isoformat(),
+            'message_count': self.message_count or 0,
+            'last_message_preview': self.last_message_preview,
+            'last_message_type': self.last_message_type,
+            'last_message_at': self.last_message_at.isoformat() if self.last_message_at else None,
+            'dify_conversation_id': self.dify_conversation_id,
+            'dify_backend': self.dify_backend
         }
 
 class Message(Base):
@@ -80,7 +113,7 @@ class Message(Base):
     
     id = Column(Integer, primary_key=True)
     message_id = Column(String(100), unique=True, nullable=False, index=True)
-    content = Column(Text, nullable=False)
+    content = Column(CompressedText, nullable=False)  # zlib BLOB above COMPRESS_MIN_BYTES
     message_type = Column(String(20), nullable=False)  # 'user', 'ai', 'system'
     created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
     
@@ -90,18 +123,48 @@ class Message(Base):
     
     # Additional metadata
     message_metadata = Column(Text)  # JSON string for additional data
+    # Sanitized HTML rendered from content when stored (see app/rendering.py)
+    content_html = Column(CompressedText, nullable=True)
     
     def to_dict(self):
         return {
             'id': self.id,
             'message_id': self.message_id,
             'content': self.content,
+            'content_html': self.content_html,
             'message_type': self.message_type,
             'created_at': self.created_at.isoformat(),
             'user_id': self.user_id,
             'conversation_id': self.conversation_id
         }
 
+class UsageRollup(Base):
+    """Message counts per room and minute/hour bucket, kept current on insert (see app/analytics.py).
+    room '*' aggregates all rooms."""
+    __tablename__ = 'usage_rollups'
+    
+    granularity = Column(String(6), primary_key=True)  # 'minute' or 'hour'
+    room = Column(String(64), primary_key=True)
+    bucket_start = Column(DateTime, primary_key=True)  # UTC, truncated to the granularity
+    user_messages = Column(Integer, nullable=False, default=0)
+    ai_messages = Column(Integer, nullable=False, default=0)
+    other_messages = Column(Integer, nullable=False, default=0)
+    active_users = Column(Integer, nullable=False, default=0)
+    # Averages are sum / samples; only answers that recorded a timing count as samples
+    ai_duration_samples = Column(Integer, nullable=False, default=0)
+    ai_duration_ms_sum = Column(Float, nullable=False, default=0.0)
+    ai_ttft_samples = Column(Integer, nullable=False, default=0)
+    ai_ttft_ms_sum = Column(Float, nullable=False, default=0.0)
+
+class UsageRollupUser(Base):
+    """Users already counted in a rollup bucket, so active_users stays a distinct count"""
+    __tablename__ = 'usage_rollup_users'
+    
+    granularity = Column(String(6), primary_key=True)
+    room = Column(String(64), primary_key=True)
+    bucket_start = Column(DateTime, primary_key=True)
+    user_id = Column(String(100), primary_key=True)
+
 # Dependency to get database session
 async def get_db():
     async with AsyncSessionLocal() as session:
@@ -110,8 +173,34 @@ async def get_db():
         finally:
             await session.close()
 
+def _add_missing_columns(sync_conn):
+    """create_all never alters existing tables: add nullable columns and indexes
+    introduced since the database file was created"""
+    inspector = inspect(sync_conn)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {c['name'] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_type = column.type.compile(dialect=sync_conn.dialect)
+            sync_conn.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}")
+        # Likewise for indexes added to an existing table
+        for index in table.indexes:
+            index.create(sync_conn, checkfirst=True)
+
+async def incremental_vacuum():
+    """Return all free pages to the OS (auto_vacuum=INCREMENTAL databases only).
+    The pragma frees one page per step and the Python driver steps a pragma
+    once, so it is run as a script, which steps it to completion."""
+    async with engine.connect() as conn:
+        raw = await conn.get_raw_connection()
+        await raw.driver_connection.executescript("PRAGMA incremental_vacuum")
+
 # Initialize database
 async def init_db():
     """Initialize database tables"""
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_add_missing_columns)
@@ -8,10 +8,25 @@ import json
 import time
 import asyncio
 from typing import AsyncGenerator, Dict, Any, Optional
+from app.settings import get_settings
 from app.utils.logger import setup_logger
 
 logger = setup_logger("DifyClient")
 
+# Slack past the stream deadlines so the watchdog (app/stream_registry.py),
+# which keeps the partial answer, normally fires before httpx does
+TIMEOUT_GRACE_SECONDS = 5.0
+
+
+def stream_timeout() -> httpx.Timeout:
+    """httpx limits for a streamed answer, derived from the stream deadlines.
+    The read limit is a backstop for a stalled socket; 0 deadlines leave it open-ended."""
+    settings = get_settings()
+    waits = [t for t in (settings.stream_first_byte_seconds, settings.stream_idle_seconds) if t]
+    read = max(waits) + TIMEOUT_GRACE_SECONDS if waits and settings.stream_idle_seconds else None
+    pool = settings.stream_first_byte_seconds or None
+    return httpx.Timeout(connect=10.0, read=read, write=10.0, pool=pool)
+
 class AsyncDifyClient:
     """Async client for interacting with Dify API"""
     
@@ -19,6 +34,7 @@ class AsyncDifyClient:
         self.api_key = api_key
         self.api_url = api_url
         self.client = None
+        # Upstream task_id -> {'user': ..., 'started': ...} for streams in flight
         self.active_requests = {}
         
     async def stream_chat(
@@ -48,11 +64,11 @@ class AsyncDifyClient:
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
         }
+        task_id = None
         
         try:
-            # Create a new client for each request to avoid issues. Use open-ended read timeout for SSE.
-            timeout = httpx.Timeout(connect=10.0, read=None, write=10.0, pool=None)
-            async with httpx.AsyncClient(timeout=timeout) as client:
+            # Create a new client for each request to avoid issues
+            async with httpx.AsyncClient(timeout=stream_timeout()) as client:
                 logger.info(f"Making request to: {self.api_url}/chat-messages")
                 logger.info(f"Request headers: {headers}")
                 logger.info(f"Request payload: {payload}")
@@ -82,6 +98,7 @@ class AsyncDifyClient:
                         yield {
                             'event': 'error',
                             'error': error_msg,
+                            'status': response.status_code,
                             'timestamp': int(time.time() * 1000)
                         }
                         return
@@ -112,6 +129,13 @@ class AsyncDifyClient:
                                 # Add timestamp for tracking
                                 chunk_data['timestamp'] = int(time.time() * 1000)
 
+                                if task_id is None and chunk_data.get('task_id'):
+                                    task_id = chunk_data['task_id']
+                                    self.active_requests[task_id] = {
+                                        'user': user_id,
+                                        'started': time.time()
+                                    }
+
                                 logger.debug(f"Received chunk: {chunk_data.get('event', 'unknown')}")
                                 yield chunk_data
 
@@ -128,6 +152,7 @@ class AsyncDifyClient:
             yield {
                 'event': 'error',
                 'error': f"HTTP {e.response.status_code}: API request failed",
+                'status': e.response.status_code,
                 'timestamp': int(time.time() * 1000)
             }
         except Exception as e:
@@ -137,6 +162,30 @@ class AsyncDifyClient:
                 'error': str(e),
                 'timestamp': int(time.time() * 1000)
             }
+        finally:
+            if task_id:
+                self.active_requests.pop(task_id, None)
+    
+    async def stop(self, task_id: str, user_id: str) -> bool:
+        """Ask Dify to stop generating (frees the upstream slot). Streaming mode only."""
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+        try:
+            async with httpx.AsyncClient(timeout=httpx.Timeout(5.0)) as client:
+                response = await client.post(
+                    f"{self.api_url}/chat-messages/{task_id}/stop",
+                    json={"user": user_id},
+                    headers=headers
+                )
+            if response.status_code != 200:
+                logger.warning(f"Dify stop returned HTTP {response.status_code} for task {task_id}")
+                return False
+            return True
+        except Exception as e:
+            logger.warning(f"Dify stop failed for task {task_id}: {e}")
+            return False
     
     async def close(self):
         """Close the HTTP client"""
@@ -0,0 +1,250 @@
+"""
+Multi-backend Dify routing for FastAPI MindWeb Application
+Spreads answers over several Dify endpoints/keys (replicas of the same app)
+
+    DIFY_BACKENDS=https://dify-a/v1|app-key-a,https://dify-b/v1|app-key-b
+    DIFY_ROUTING=least_loaded   # or: fastest (observed time to first token)
+
+Without DIFY_BACKENDS the pool holds the single DIFY_API_URL / DIFY_API_KEY
+backend, so behaviour is unchanged.
+
+New conversations go to the best healthy backend and fail over to the next
+one if a backend errors before producing any output. A Dify conversation_id
+only exists on the instance that created it, so follow-up messages stay
+pinned to that backend; the backend name is stored with the conversation link
+so pins survive restarts. Only 5xx answers, timeouts and transport errors
+count against a backend's health: a 4xx (bad request, unknown conversation)
+would fail the same way anywhere and is passed on without failover.
+"""
+
+import time
+from collections import OrderedDict
+from typing import Any, AsyncGenerator, Dict, List, Optional
+
+from app.dify_client import AsyncDifyClient
+from app.settings import Settings
+from app.utils.logger import setup_logger
+
+logger = setup_logger("DifyPool")
+
+ROUTING_STRATEGIES = ('least_loaded', 'fastest')
+
+
+class DifyBackend:
+    """One Dify endpoint with its load and health"""
+
+    # Consecutive failures before the backend is skipped for cooldown_seconds
+    failure_threshold = 3
+    cooldown_seconds = 30.0
+    # Weight of the newest sample in the moving average of TTFT
+    ttft_alpha = 0.2
+
+    def __init__(self, name: str, api_url: str, api_key: str):
+        self.name = name
+        self.client = AsyncDifyClient(api_key=api_key, api_url=api_url)
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+        self.ewma_ttft_ms: Optional[float] = None
+        self.last_error: Optional[str] = None
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.unhealthy_until
+
+    def record_ttft(self, ttft_ms: float):
+        if self.ewma_ttft_ms is None:
+            self.ewma_ttft_ms = ttft_ms
+        else:
+            self.ewma_ttft_ms += self.ttft_alpha * (ttft_ms - self.ewma_ttft_ms)
+
+    def record_success(self):
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+
+    def record_failure(self, error: str):
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.last_error = error
+        if self.consecutive_failures >= self.failure_threshold:
+            self.unhealthy_until = time.monotonic() + self.cooldown_seconds
+            logger.warning(f"Dify backend {self.name} marked unhealthy for {self.cooldown_seconds:.0f}s: {error}")
+
+    @staticmethod
+    def is_backend_failure(chunk: Dict[str, Any]) -> bool:
+        """True for 5xx answers and errors without an HTTP status (timeouts, transport)"""
+        status = chunk.get('status')
+        return not isinstance(status, int) or status >= 500
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'api_url': self.client.api_url,
+            'healthy': self.healthy,
+            'in_flight': self.in_flight,
+            'requests': self.requests,
+            'failures': self.failures,
+            'consecutive_failures': self.consecutive_failures,
+            'ewma_ttft_ms': round(self.ewma_ttft_ms, 1) if self.ewma_ttft_ms is not None else None,
+            'last_error': self.last_error,
+        }
+
+
+class DifyPool:
+    """Drop-in replacement for AsyncDifyClient that routes over several backends"""
+
+    # Remembered conversation -> backend pins (least recently used are dropped)
+    max_pins = 100000
+    # Recent upstream task_id -> backend, so stop() reaches the right instance
+    max_tasks = 1000
+
+    def __init__(self, backends: List[DifyBackend], routing: str = 'least_loaded'):
+        if not backends:
+            raise ValueError("DifyPool needs at least one backend")
+        if routing not in ROUTING_STRATEGIES:
+            logger.warning(f"Unknown DIFY_ROUTING {routing!r}; using least_loaded")
+            routing = 'least_loaded'
+        self.backends = backends
+        self.routing = routing
+        self._by_name = {b.name: b for b in backends}
+        self.pins: "OrderedDict[str, str]" = OrderedDict()
+        self.tasks: "OrderedDict[str, str]" = OrderedDict()
+        self.failovers = 0
+
+    @classmethod
+    def from_settings(cls, settings: Settings) -> "DifyPool":
+        backends = []
+        for index, spec in enumerate(s.strip() for s in (settings.dify_backends or '').split(',')):
+            if not spec:
+                continue
+            url, _, key = spec.partition('|')
+            if not url or not key:
+                logger.warning(f"Ignoring malformed DIFY_BACKENDS entry #{index + 1} (expected url|key)")
+                continue
+            backends.append(DifyBackend(f"backend-{index + 1}", url.rstrip('/'), key))
+        if not backends:
+            backends.append(DifyBackend('default', settings.dify_api_url, settings.dify_api_key))
+        logger.info(f"Dify pool: {len(backends)} backend(s), routing={settings.dify_routing}")
+        return cls(backends, settings.dify_routing)
+
+    @property
+    def active_requests(self) -> Dict[str, dict]:
+        """Upstream task_id -> request info across all backends"""
+        merged = {}
+        for backend in self.backends:
+            merged.update(backend.client.active_requests)
+        return merged
+
+    def _score(self, backend: DifyBackend):
+        ttft = backend.ewma_ttft_ms if backend.ewma_ttft_ms is not None else 0.0
+        if self.routing == 'fastest':
+            # Expected wait grows with the queue in front of us
+            return (ttft * (1 + backend.in_flight), backend.in_flight)
+        return (backend.in_flight, ttft)
+
+    def candidates(self) -> List[DifyBackend]:
+        """Backends in preference order; unhealthy ones last so a request is never refused outright"""
+        healthy = sorted((b for b in self.backends if b.healthy), key=self._score)
+        cooling = sorted((b for b in self.backends if not b.healthy), key=lambda b: b.unhealthy_until)
+        return healthy + cooling
+
+    def pinned_backend(self, conversation_id: Optional[str]) -> Optional[DifyBackend]:
+        if not conversation_id:
+            return None
+        name = self.pins.get(conversation_id)
+        if name is None:
+            return None
+        self.pins.move_to_end(conversation_id)
+        return self._by_name.get(name)
+
+    def pin(self, conversation_id: Optional[str], backend_name: Optional[str]):
+        """Restore a pin from the stored conversation link (unknown backends are ignored)"""
+        backend = self._by_name.get(backend_name or '')
+        if conversation_id and backend is not None:
+            self._remember(self.pins, conversation_id, backend, self.max_pins)
+
+    def backend_for(self, conversation_id: Optional[str]) -> Optional[str]:
+        """Name of the backend a conversation is pinned to, for storing with the link"""
+        return self.pins.get(conversation_id) if conversation_id else None
+
+    @staticmethod
+    def _remember(table: "OrderedDict[str, str]", key: str, backend: DifyBackend, limit: int):
+        table[key] = backend.name
+        table.move_to_end(key)
+        while len(table) > limit:
+            table.popitem(last=False)
+
+    async def stream_chat(
+        self,
+        message: str,
+        user_id: str,
+        conversation_id: str = None
+    ) -> AsyncGenerator[Dict[str, Any], None]:
+        """Stream from the pinned backend, or the best backend with failover for new conversations"""
+        pinned = self.pinned_backend(conversation_id)
+        order = [pinned] if pinned else self.candidates()
+
+        for attempt, backend in enumerate(order):
+            started = time.monotonic()
+            produced = False
+            error = None
+            backend.in_flight += 1
+            backend.requests += 1
+            upstream = backend.client.stream_chat(message, user_id, conversation_id)
+            try:
+                async for chunk in upstream:
+                    if chunk.get('event') == 'error':
+                        if not DifyBackend.is_backend_failure(chunk):
+                            # Bad request or unknown conversation: the same anywhere, and no sign of ill health
+                            yield chunk
+                            return
+                        error = str(chunk.get('error'))
+                        if not produced:
+                            # Nothing reached the user yet: safe to retry elsewhere
+                            break
+                    elif not produced:
+                        produced = True
+                        backend.record_ttft((time.monotonic() - started) * 1000)
+                    if chunk.get('task_id') and chunk['task_id'] not in self.tasks:
+                        self._remember(self.tasks, chunk['task_id'], backend, self.max_tasks)
+                    if chunk.get('conversation_id') and not pinned:
+                        self._remember(self.pins, chunk['conversation_id'], backend, self.max_pins)
+                        pinned = backend
+                    yield chunk
+            finally:
+                backend.in_flight -= 1
+                await upstream.aclose()
+
+            if error is None:
+                backend.record_success()
+                return
+            backend.record_failure(error)
+            if produced:
+                # The error was already passed on mid-answer
+                return
+            if attempt + 1 < len(order):
+                self.failovers += 1
+                logger.warning(f"Dify backend {backend.name} failed ({error}); failing over")
+                continue
+            yield {'event': 'error', 'error': error, 'timestamp': int(time.time() * 1000)}
+
+    async def stop(self, task_id: str, user_id: str) -> bool:
+        """Stop a generation on whichever backend is running it"""
+        backend = self._by_name.get(self.tasks.get(task_id, ''))
+        if backend is None:
+            return False
+        return await backend.client.stop(task_id, user_id)
+
+    def snapshot(self) -> dict:
+        return {
+            'routing': self.routing,
+            'failovers': self.failovers,
+            'pinned_conversations': len(self.pins),
+            'backends': [b.to_dict() for b in self.backends],
+        }
+
+    async def close(self):
+        for backend in self.backends:
+            await backend.client.close()
@@ -0,0 +1,240 @@
+"""
+Durable broadcast event journal for FastAPI MindWeb Application
+Appends every broadcast event that goes into room history to segment files on
+local disk, so Last-Event-ID resume and the history sent to new clients
+survive restarts and crashes
+
+    JOURNAL_ENABLED=false
+    JOURNAL_DIR=./journal
+    JOURNAL_FSYNC_SECONDS=1.0        # data reaches the disk at least this often
+    JOURNAL_SEGMENT_BYTES=16777216   # start a new segment beyond this size...
+    JOURNAL_SEGMENT_SECONDS=3600     # ...or this age
+    JOURNAL_RETENTION_HOURS=24       # closed segments older than this are deleted
+
+Each record is a little-endian (length, crc32) header followed by the JSON
+event. Writes go to the OS at once (a process crash loses nothing) and are
+fsynced periodically (a power loss loses at most the last interval). Replay
+reads the retained segments through mmap and stops at the first torn or
+corrupt record of a segment.
+
+AI answer chunks are not journaled: they are folded into stream aggregates
+rather than history, and a stream does not outlive the process. Event ids
+stay unique across restarts because ids are reserved in blocks, with a marker
+record written before a block is used.
+"""
+
+import asyncio
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from typing import Any, Dict, Iterator, List, Optional
+
+from app.settings import Settings
+from app.utils.logger import setup_logger
+
+logger = setup_logger("EventJournal")
+
+_HEADER = struct.Struct('<II')
+_SEGMENT_PREFIX = 'events-'
+_SEGMENT_SUFFIX = '.log'
+# Event ids handed out per reservation marker
+SEQ_BLOCK = 10000
+_SEQ_MARKER = '_seq_reserved'
+
+
+def encode_record(event: Dict[str, Any]) -> bytes:
+    payload = json.dumps(event, ensure_ascii=False, separators=(',', ':'), default=str).encode('utf-8')
+    return _HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def read_records(path: str) -> Iterator[Dict[str, Any]]:
+    """Decode one segment through mmap; a torn or corrupt record ends the segment"""
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            offset = 0
+            while offset + _HEADER.size <= size:
+                length, crc = _HEADER.unpack_from(mm, offset)
+                start = offset + _HEADER.size
+                payload = mm[start:start + length]
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    logger.warning(f"Journal {os.path.basename(path)}: stopping at damaged record at byte {offset}")
+                    return
+                yield json.loads(payload)
+                offset = start + length
+
+
+class EventJournal:
+    """Append-only segmented log of broadcast events"""
+
+    def __init__(self, directory: str, fsync_seconds: float = 1.0,
+                 segment_bytes: int = 16 * 1024 * 1024, segment_seconds: float = 3600.0,
+                 retention_hours: float = 24.0):
+        self.directory = directory
+        self.fsync_seconds = fsync_seconds
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.retention_hours = retention_hours
+        self._fd: Optional[int] = None
+        self._path: Optional[str] = None
+        self._opened_at = 0.0
+        self._size = 0
+        self._dirty = False
+        # fsync runs in a worker thread; never let it race a segment close
+        self._fd_lock = threading.Lock()
+        # Highest event id that may be used without writing another marker
+        self.reserved_seq = 0
+        self.counters = {'appended': 0, 'bytes': 0, 'fsyncs': 0, 'segments_deleted': 0, 'replayed': 0}
+
+    @classmethod
+    def from_settings(cls, settings: Settings) -> "EventJournal":
+        return cls(
+            settings.journal_dir,
+            fsync_seconds=settings.journal_fsync_seconds,
+            segment_bytes=settings.journal_segment_bytes,
+            segment_seconds=settings.journal_segment_seconds,
+            retention_hours=settings.journal_retention_hours,
+        )
+
+    def apply_settings(self, settings: Settings):
+        self.fsync_seconds = settings.journal_fsync_seconds
+        self.segment_bytes = settings.journal_segment_bytes
+        self.segment_seconds = settings.journal_segment_seconds
+        self.retention_hours = settings.journal_retention_hours
+
+    def segments(self) -> List[str]:
+        """Segment paths, oldest first"""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return [os.path.join(self.directory, n) for n in sorted(names)
+                if n.startswith(_SEGMENT_PREFIX) and n.endswith(_SEGMENT_SUFFIX)]
+
+    def replay(self) -> Iterator[Dict[str, Any]]:
+        """Every retained event, oldest first; also restores the id reservation"""
+        for path in self.segments():
+            for record in read_records(path):
+                if _SEQ_MARKER in record:
+                    self.reserved_seq = max(self.reserved_seq, record[_SEQ_MARKER])
+                    continue
+                self.reserved_seq = max(self.reserved_seq, record.get('event_id', 0))
+                self.counters['replayed'] += 1
+                yield record
+
+    def _open_segment(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._close_segment()
+        # Zero-padded milliseconds sort by name; bumping the stamp avoids clashes within one ms
+        stamp = int(time.time() * 1000)
+        while True:
+            path = os.path.join(self.directory, f"{_SEGMENT_PREFIX}{stamp:015d}{_SEGMENT_SUFFIX}")
+            if not os.path.exists(path):
+                break
+            stamp += 1
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self._path = path
+        self._opened_at = time.monotonic()
+        self._size = 0
+        # Each segment starts with the current reservation so deleting older ones never loses it
+        if self.reserved_seq:
+            self._write({_SEQ_MARKER: self.reserved_seq})
+
+    def _close_segment(self):
+        with self._fd_lock:
+            if self._fd is None:
+                return
+            try:
+                os.fsync(self._fd)
+            finally:
+                os.close(self._fd)
+                self._fd = None
+                self._dirty = False
+
+    def _write(self, record: Dict[str, Any]):
+        data = encode_record(record)
+        os.write(self._fd, data)
+        self._size += len(data)
+        self._dirty = True
+        self.counters['bytes'] += len(data)
+
+    def _rotate_if_needed(self):
+        if self._fd is None or self._size >= self.segment_bytes or \
+                time.monotonic() - self._opened_at >= self.segment_seconds:
+            self._open_segment()
+
+    def reserve(self, event_id: int):
+        """Make sure event_id is covered by a reservation marker.
+        Called for every event id, journaled or not."""
+        if event_id > self.reserved_seq:
+            self._rotate_if_needed()
+            self.reserved_seq = event_id + SEQ_BLOCK
+            self._write({_SEQ_MARKER: self.reserved_seq})
+
+    def append(self, event: Dict[str, Any]):
+        """Write one event (hands it to the OS; fsync happens in flush_loop)"""
+        self._rotate_if_needed()
+        self.reserve(event.get('event_id', 0))
+        self._write(event)
+        self.counters['appended'] += 1
+
+    def sync(self):
+        """fsync the open segment if anything was written since the last sync"""
+        with self._fd_lock:
+            if self._fd is not None and self._dirty:
+                self._dirty = False
+                os.fsync(self._fd)
+                self.counters['fsyncs'] += 1
+
+    def prune(self) -> int:
+        """Delete closed segments last written before the retention window"""
+        cutoff = time.time() - self.retention_hours * 3600
+        deleted = 0
+        for path in self.segments():
+            if path == self._path:
+                continue
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    deleted += 1
+            except FileNotFoundError:
+                continue
+        self.counters['segments_deleted'] += deleted
+        return deleted
+
+    async def flush_loop(self):
+        """Background task: periodic fsync (off the event loop) and segment pruning"""
+        last_prune = 0.0
+        while True:
+            await asyncio.sleep(max(self.fsync_seconds, 0.05))
+            try:
+                if self._dirty:
+                    await asyncio.to_thread(self.sync)
+                if time.monotonic() - last_prune >= 60:
+                    last_prune = time.monotonic()
+                    deleted = await asyncio.to_thread(self.prune)
+                    if deleted:
+                        logger.info(f"Deleted {deleted} expired journal segments")
+            except Exception as e:
+                logger.error(f"Journal flush failed: {e}")
+
+    def close(self):
+        self._close_segment()
+        self._path = None
+
+    def stats(self) -> dict:
+        segments = self.segments()
+        return {
+            'directory': self.directory,
+            'segments': len(segments),
+            'disk_bytes': sum(os.path.getsize(p) for p in segments if os.path.exists(p)),
+            'current_segment': os.path.basename(self._path) if self._path else None,
+            'reserved_seq': self.reserved_seq,
+            **self.counters,
+        }
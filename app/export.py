@@ -0,0 +1,161 @@
+"""
+Streaming bulk export of chat messages for FastAPI MindWeb Application
+NDJSON or CSV, optionally gzip-compressed while streaming
+
+Rows are read through a server-side cursor (yield_per batches) and encoded
+straight to bytes, so memory stays flat regardless of export size. The
+database runs in WAL mode, so the long read does not block live chat writes.
+
+Command line:
+    python -m app.export --format csv --gzip -o chat.csv.gz --since 2025-01-01
+"""
+
+import argparse
+import asyncio
+import csv
+import io
+import json
+import sys
+import zlib
+from datetime import datetime, timezone
+from typing import AsyncIterator, Optional
+
+from sqlalchemy import select
+
+from app.database import Message, AsyncSessionLocal
+from app.utils.logger import setup_logger
+
+logger = setup_logger("Export")
+
+EXPORT_FORMATS = ('ndjson', 'csv')
+EXPORT_COLUMNS = (
+    'id', 'message_id', 'created_at', 'message_type',
+    'user_id', 'conversation_id', 'content', 'message_metadata'
+)
+# Flush encoded output once this many bytes are buffered
+_FLUSH_BYTES = 64 * 1024
+
+
+def _export_query(
+    user_id: Optional[str] = None,
+    conversation_id: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None
+):
+    query = select(*(getattr(Message, name) for name in EXPORT_COLUMNS))
+    if user_id:
+        query = query.where(Message.user_id == user_id)
+    if conversation_id:
+        query = query.where(Message.conversation_id == conversation_id)
+    if start:
+        query = query.where(Message.created_at >= start)
+    if end:
+        query = query.where(Message.created_at < end)
+    return query.order_by(Message.id)
+
+
+def _row_values(row) -> list:
+    values = list(row)
+    created_at = values[2]
+    values[2] = created_at.isoformat() if created_at else None
+    return values
+
+
+async def stream_export(
+    fmt: str = 'ndjson',
+    compress: bool = False,
+    user_id: Optional[str] = None,
+    conversation_id: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    batch_size: int = 500
+) -> AsyncIterator[bytes]:
+    """Yield export bytes chunk by chunk"""
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format: {fmt}")
+
+    # wbits=31 produces a gzip container rather than a raw zlib stream
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if fmt == 'csv' else None
+    if writer:
+        writer.writerow(EXPORT_COLUMNS)
+
+    def drain() -> bytes:
+        data = buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate(0)
+        return compressor.compress(data) if compressor else data
+
+    rows = 0
+    async with AsyncSessionLocal() as db:
+        result = await db.stream(
+            _export_query(user_id, conversation_id, start, end)
+            .execution_options(yield_per=batch_size)
+        )
+        async for row in result:
+            values = _row_values(row)
+            if writer:
+                writer.writerow(values)
+            else:
+                buffer.write(json.dumps(dict(zip(EXPORT_COLUMNS, values)), ensure_ascii=False))
+                buffer.write('\n')
+            rows += 1
+            if buffer.tell() >= _FLUSH_BYTES:
+                chunk = drain()
+                if chunk:
+                    yield chunk
+
+    chunk = drain()
+    if compressor:
+        chunk += compressor.flush()
+    if chunk:
+        yield chunk
+    logger.debug(f"Exported {rows} messages ({fmt}{', gzip' if compress else ''})")
+
+
+def export_filename(fmt: str, compress: bool) -> str:
+    stamp = datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S')
+    return f"mindweb-messages-{stamp}.{fmt}{'.gz' if compress else ''}"
+
+
+def _parse_date(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+async def _export_to_file(args):
+    out = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    try:
+        async for chunk in stream_export(
+            fmt=args.format,
+            compress=args.gzip,
+            user_id=args.user_id,
+            conversation_id=args.conversation_id,
+            start=_parse_date(args.since),
+            end=_parse_date(args.until),
+            batch_size=args.batch_size
+        ):
+            out.write(chunk)
+    finally:
+        if args.output:
+            out.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export MindWeb chat messages")
+    parser.add_argument('--format', choices=EXPORT_FORMATS, default='ndjson')
+    parser.add_argument('--gzip', action='store_true', help='Compress output with gzip')
+    parser.add_argument('-o', '--output', help='Output file (default: stdout)')
+    parser.add_argument('--user-id')
+    parser.add_argument('--conversation-id')
+    parser.add_argument('--since', help='ISO date/time, inclusive')
+    parser.add_argument('--until', help='ISO date/time, exclusive')
+    parser.add_argument('--batch-size', type=int, default=500)
+    asyncio.run(_export_to_file(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
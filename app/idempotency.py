@@ -0,0 +1,101 @@
+"""
+Idempotency keys for chat submissions in FastAPI MindWeb Application
+A retried send with the same key gets the original result, or waits on the
+original request if it is still running, instead of persisting, broadcasting
+and generating again
+
+    IDEMPOTENCY_TTL_SECONDS=600   # how long a completed result is replayed
+    IDEMPOTENCY_MAX_KEYS=10000    # oldest keys are evicted beyond this
+(read through app.settings; reloadable)
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional, Tuple
+from app.settings import Settings, get_settings, on_reload
+from app.utils.logger import setup_logger
+
+logger = setup_logger("Idempotency")
+
+# Keys are client-generated (UUIDs in the web client); bound what we store
+MAX_KEY_LENGTH = 128
+
+
+class IdempotencyStore:
+    """Bounded TTL map of scoped key -> future of the first request's result.
+    Failed requests are forgotten so the client can retry them."""
+
+    def __init__(self, ttl_seconds: float = 600, max_keys: int = 10000):
+        self.ttl_seconds = ttl_seconds
+        self.max_keys = max_keys
+        self._entries: "OrderedDict[str, Tuple[asyncio.Future, float]]" = OrderedDict()
+        self.counters = {'executed': 0, 'replayed': 0, 'attached': 0, 'failed': 0, 'evicted': 0}
+
+    def _prune(self, now: float):
+        # Entries are in insertion order, so expired ones sit at the front
+        while self._entries:
+            key, (future, expires_at) = next(iter(self._entries.items()))
+            if expires_at > now and len(self._entries) < self.max_keys:
+                break
+            self._entries.popitem(last=False)
+            if expires_at > now:
+                self.counters['evicted'] += 1
+
+    def _forget_on_failure(self, key: str, future: asyncio.Future):
+        def done(f: asyncio.Future):
+            if f.cancelled() or f.exception() is not None:
+                self.counters['failed'] += 1
+                entry = self._entries.get(key)
+                if entry and entry[0] is future:
+                    del self._entries[key]
+        future.add_done_callback(done)
+
+    async def run(self, key: Optional[str], scope: str,
+                  work: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Run work once per (scope, key). Returns (result, replayed).
+        Without a key the work simply runs."""
+        if not key:
+            return await work(), False
+        if len(key) > MAX_KEY_LENGTH:
+            raise ValueError(f"Idempotency key longer than {MAX_KEY_LENGTH} characters")
+
+        now = time.monotonic()
+        self._prune(now)
+        scoped = f"{scope}:{key}"
+        entry = self._entries.get(scoped)
+        if entry is not None:
+            future = entry[0]
+            self.counters['replayed' if future.done() else 'attached'] += 1
+            logger.info(f"Duplicate submission {key[:16]} ({'replayed' if future.done() else 'attached'})")
+            # Shield so a duplicate giving up does not cancel the original
+            return await asyncio.shield(future), True
+
+        # Run as its own task: duplicates share it even if the first caller goes away
+        future = asyncio.ensure_future(work())
+        self._entries[scoped] = (future, now + self.ttl_seconds)
+        self._forget_on_failure(scoped, future)
+        self.counters['executed'] += 1
+        return await asyncio.shield(future), False
+
+    def apply_settings(self, settings: Settings):
+        self.ttl_seconds = settings.idempotency_ttl_seconds
+        self.max_keys = settings.idempotency_max_keys
+
+    def stats(self) -> dict:
+        in_flight = sum(1 for future, _ in self._entries.values() if not future.done())
+        return {
+            'keys': len(self._entries),
+            'in_flight': in_flight,
+            'ttl_seconds': self.ttl_seconds,
+            'max_keys': self.max_keys,
+            'counters': dict(self.counters),
+        }
+
+
+# Global idempotency store instance
+idempotency_store = IdempotencyStore(
+    ttl_seconds=get_settings().idempotency_ttl_seconds,
+    max_keys=get_settings().idempotency_max_keys
+)
+on_reload(idempotency_store.apply_settings)
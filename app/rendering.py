@@ -0,0 +1,144 @@
+"""
+Server-side markdown rendering for FastAPI MindWeb Application
+Messages are rendered and sanitized once, when they are stored, so clients
+only set the resulting HTML instead of running markdown-it and DOMPurify
+for every message on every device
+
+    RENDER_MARKDOWN=true   # false leaves rendering to the clients
+(read through app.settings; reloadable)
+
+Needs markdown-it-py and nh3 (both optional). Without them render_html()
+returns None and clients render the markdown themselves, as before.
+"""
+
+import hashlib
+from collections import OrderedDict
+from typing import Optional
+
+try:
+    from markdown_it import MarkdownIt
+except ImportError:  # markdown-it-py is optional; clients can render instead
+    MarkdownIt = None
+
+try:
+    import nh3
+except ImportError:  # never serve unsanitized HTML, so no nh3 means no rendering
+    nh3 = None
+
+try:
+    from mdit_py_plugins.tasklists import tasklists_plugin
+except ImportError:
+    tasklists_plugin = None
+
+try:
+    import linkify_it  # noqa: F401  (needed by markdown-it-py's linkify option)
+    _linkify = True
+except ImportError:
+    _linkify = False
+
+from app.settings import get_settings
+from app.utils.logger import setup_logger
+
+logger = setup_logger("Rendering")
+
+# Mirrors the client: raw HTML disabled, soft line breaks kept, bare URLs linked
+_md = None
+if MarkdownIt is not None and nh3 is not None:
+    _md = MarkdownIt('commonmark', {'html': False, 'breaks': True, 'linkify': _linkify})
+    _md.enable(['table', 'strikethrough'])
+    if _linkify:
+        _md.enable('linkify')
+    if tasklists_plugin is not None:
+        _md.use(tasklists_plugin, enabled=False, label=True, label_after=True)
+
+renderer_available = _md is not None
+
+# Same ground as the client's DOMPurify html profile, minus anything scriptable
+ALLOWED_TAGS = {
+    'a', 'b', 'blockquote', 'br', 'code', 'del', 'em', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+    'hr', 'i', 'img', 'input', 'label', 'li', 'ol', 'p', 'pre', 's', 'span', 'strong',
+    'table', 'tbody', 'td', 'th', 'thead', 'tr', 'ul',
+}
+ALLOWED_ATTRIBUTES = {
+    'a': {'href', 'title'},
+    'img': {'src', 'alt', 'title'},
+    'code': {'class'},
+    'input': {'type', 'checked', 'disabled'},
+    'li': {'class'},
+    'ul': {'class'},
+    'th': {'style'},
+    'td': {'style'},
+}
+URL_SCHEMES = {'http', 'https', 'mailto', 'tel'}
+
+# Bump when rendering changes so cached output is not reused
+RENDER_VERSION = 1
+
+
+class _RenderCache:
+    """Bounded LRU of content digest -> sanitized HTML"""
+
+    def __init__(self, max_entries: int = 2048):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[bytes, str]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: bytes) -> Optional[str]:
+        html = self._entries.get(key)
+        if html is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return html
+
+    def put(self, key: bytes, html: str):
+        self._entries[key] = html
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+render_cache = _RenderCache()
+
+
+def _digest(text: str) -> bytes:
+    return hashlib.blake2b(f"{RENDER_VERSION}:{text}".encode('utf-8'), digest_size=16).digest()
+
+
+def render_html(text: Optional[str]) -> Optional[str]:
+    """Sanitized HTML for a message, or None when the client should render it"""
+    if not text or _md is None or not get_settings().render_markdown:
+        return None
+    key = _digest(text)
+    html = render_cache.get(key)
+    if html is not None:
+        return html
+    try:
+        html = nh3.clean(
+            _md.render(text),
+            tags=ALLOWED_TAGS,
+            attributes=ALLOWED_ATTRIBUTES,
+            url_schemes=URL_SCHEMES,
+            link_rel='noopener noreferrer nofollow',
+            filter_style_properties={'text-align'},
+        )
+    except Exception as e:
+        logger.warning(f"Markdown render failed: {e}")
+        return None
+    render_cache.put(key, html)
+    return html
+
+
+def stats() -> dict:
+    return {
+        'available': renderer_available,
+        'enabled': renderer_available and get_settings().render_markdown,
+        'linkify': _linkify,
+        'tasklists': tasklists_plugin is not None,
+        'cache': render_cache.stats(),
+    }
@@ -0,0 +1,277 @@
+"""
+Message retention and archival for FastAPI MindWeb Application
+Moves expired messages into compressed monthly archives and reclaims space
+
+Policies come from settings (environment / .env, reloadable):
+    RETENTION_DEFAULT_DAYS=0                      # 0 keeps messages forever
+    RETENTION_POLICIES=type:ai=90,conversation:group=30
+A conversation rule wins over a message_type rule, which wins over the default.
+
+Archives are gzip-compressed NDJSON, one file per month of created_at:
+    <RETENTION_ARCHIVE_DIR>/messages-2025-01.ndjson.gz
+Each batch is appended as its own gzip member and flushed to disk before the
+rows are deleted, so a crash can at worst archive a batch twice (message_id
+is unique, so duplicates are easy to drop on restore).
+
+Run once from the command line with:
+    python -m app.retention [--dry-run]
+"""
+
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import select, delete, and_, or_, not_, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database import Message, AsyncSessionLocal, engine, incremental_vacuum
+from app.search import init_search, unindex_messages
+from app.conversations import uncount_messages
+from app.settings import Settings, get_settings
+from app.utils.logger import setup_logger
+
+logger = setup_logger("Retention")
+
+
+@dataclass
+class RetentionPolicy:
+    default_days: int = 0
+    message_type_days: Dict[str, int] = field(default_factory=dict)
+    conversation_days: Dict[str, int] = field(default_factory=dict)
+
+    @classmethod
+    def from_settings(cls, settings: Settings) -> "RetentionPolicy":
+        policy = cls(default_days=settings.retention_default_days)
+        for rule in (settings.retention_policies or "").split(','):
+            rule = rule.strip()
+            if not rule:
+                continue
+            try:
+                scope, days = rule.rsplit('=', 1)
+                kind, name = scope.split(':', 1)
+                if kind == 'type':
+                    policy.message_type_days[name] = int(days)
+                elif kind == 'conversation':
+                    policy.conversation_days[name] = int(days)
+                else:
+                    raise ValueError(kind)
+            except ValueError:
+                logger.warning(f"Ignoring malformed retention rule: {rule}")
+        return policy
+
+    def conditions(self, now: datetime) -> List[Any]:
+        """One WHERE clause per rule, each selecting only rows that rule governs"""
+        clauses = []
+        conv_keys = list(self.conversation_days)
+        type_keys = list(self.message_type_days)
+        not_ruled_conversation = or_(
+            Message.conversation_id.is_(None),
+            not_(Message.conversation_id.in_(conv_keys))
+        ) if conv_keys else None
+
+        for conversation_id, days in self.conversation_days.items():
+            if days > 0:
+                clauses.append(and_(
+                    Message.conversation_id == conversation_id,
+                    Message.created_at < now - timedelta(days=days)
+                ))
+        for message_type, days in self.message_type_days.items():
+            if days > 0:
+                clause = and_(
+                    Message.message_type == message_type,
+                    Message.created_at < now - timedelta(days=days)
+                )
+                if not_ruled_conversation is not None:
+                    clause = and_(clause, not_ruled_conversation)
+                clauses.append(clause)
+        if self.default_days > 0:
+            clause = Message.created_at < now - timedelta(days=self.default_days)
+            if type_keys:
+                clause = and_(clause, not_(Message.message_type.in_(type_keys)))
+            if not_ruled_conversation is not None:
+                clause = and_(clause, not_ruled_conversation)
+            clauses.append(clause)
+        return clauses
+
+    @property
+    def active(self) -> bool:
+        return (self.default_days > 0
+                or any(d > 0 for d in self.message_type_days.values())
+                or any(d > 0 for d in self.conversation_days.values()))
+
+
+def _archive_path(archive_dir: str, created_at: Optional[datetime]) -> str:
+    month = created_at.strftime('%Y-%m') if created_at else 'undated'
+    return os.path.join(archive_dir, f"messages-{month}.ndjson.gz")
+
+
+def _archive_record(message: Message) -> Dict[str, Any]:
+    record = message.to_dict()
+    record['message_metadata'] = message.message_metadata
+    # Derived from content; re-rendered if the message is ever restored
+    record.pop('content_html', None)
+    return record
+
+
+def _write_archive(archive_dir: str, messages: List[Message]) -> Dict[str, int]:
+    """Append messages to their monthly archives; returns compressed bytes per file"""
+    os.makedirs(archive_dir, exist_ok=True)
+    by_file: Dict[str, List[str]] = {}
+    for message in messages:
+        path = _archive_path(archive_dir, message.created_at)
+        by_file.setdefault(path, []).append(json.dumps(_archive_record(message), ensure_ascii=False))
+
+    written = {}
+    for path, lines in by_file.items():
+        before = os.path.getsize(path) if os.path.exists(path) else 0
+        with open(path, 'ab') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='wb') as gz:
+                gz.write(('\n'.join(lines) + '\n').encode('utf-8'))
+            raw.flush()
+            os.fsync(raw.fileno())
+        written[path] = os.path.getsize(path) - before
+    return written
+
+
+def _pragma(name: str):
+    return text(f"PRAGMA {name}")
+
+
+async def _database_bytes(db: AsyncSession) -> int:
+    page_size = (await db.execute(_pragma('page_size'))).scalar()
+    page_count = (await db.execute(_pragma('page_count'))).scalar()
+    return (page_size or 0) * (page_count or 0)
+
+
+async def run_retention(
+    policy: Optional[RetentionPolicy] = None,
+    archive_dir: Optional[str] = None,
+    batch_size: Optional[int] = None,
+    pause: float = 0.05,
+    dry_run: bool = False
+) -> Dict[str, Any]:
+    """Archive and delete expired messages in small batches, then vacuum incrementally"""
+    # Settings are read per run so a reload applies to the next one
+    settings = get_settings()
+    policy = policy or RetentionPolicy.from_settings(settings)
+    archive_dir = archive_dir or settings.retention_archive_dir
+    batch_size = batch_size or settings.retention_batch_size
+    started = time.monotonic()
+    report = {
+        'rows_moved': 0,
+        'archive_bytes': 0,
+        'bytes_reclaimed': 0,
+        'archives': [],
+        'dry_run': dry_run,
+    }
+    if not policy.active:
+        logger.debug("No retention rules configured; nothing to do")
+        return report
+
+    now = datetime.now(timezone.utc)
+    archives = set()
+    async with AsyncSessionLocal() as db:
+        size_before = await _database_bytes(db)
+
+    for clause in policy.conditions(now):
+        last_id = 0
+        while True:
+            async with AsyncSessionLocal() as db:
+                result = await db.execute(
+                    select(Message)
+                    .where(clause, Message.id > last_id)
+                    .order_by(Message.id)
+                    .limit(batch_size)
+                )
+                batch = result.scalars().all()
+                if not batch:
+                    break
+                last_id = batch[-1].id
+                if dry_run:
+                    report['rows_moved'] += len(batch)
+                    continue
+
+                written = await asyncio.to_thread(_write_archive, archive_dir, batch)
+                ids = [m.id for m in batch]
+                await unindex_messages(db, ids)
+                await uncount_messages(db, batch)
+                await db.execute(delete(Message).where(Message.id.in_(ids)))
+                await db.commit()
+
+            report['rows_moved'] += len(batch)
+            report['archive_bytes'] += sum(written.values())
+            archives.update(written)
+            # Short transactions with a pause keep live chat writes flowing
+            await asyncio.sleep(pause)
+
+    if report['rows_moved'] and not dry_run:
+        async with AsyncSessionLocal() as db:
+            auto_vacuum = (await db.execute(_pragma('auto_vacuum'))).scalar()
+            if auto_vacuum == 2:
+                await incremental_vacuum()
+            else:
+                logger.info("auto_vacuum is not INCREMENTAL; freed pages stay in the file "
+                            "(run 'python -m app.retention --enable-incremental-vacuum' once)")
+            report['bytes_reclaimed'] = max(0, size_before - await _database_bytes(db))
+
+    report['archives'] = sorted(archives)
+    report['duration_ms'] = int((time.monotonic() - started) * 1000)
+    logger.info(
+        f"Retention run: {report['rows_moved']} rows moved, "
+        f"{report['bytes_reclaimed']} bytes reclaimed, "
+        f"{report['archive_bytes']} archive bytes written in {report['duration_ms']} ms"
+    )
+    return report
+
+
+async def enable_incremental_vacuum():
+    """One-time conversion of an existing database to auto_vacuum=INCREMENTAL (rewrites the file)"""
+    # VACUUM cannot run inside a transaction
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+        await conn.exec_driver_sql("VACUUM")
+
+
+async def retention_loop(interval_hours: float):
+    """Background task: run retention every interval until cancelled"""
+    while True:
+        try:
+            await run_retention()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Retention run failed: {e}")
+        await asyncio.sleep(interval_hours * 3600)
+
+
+async def _run_from_cli(batch_size: Optional[int], dry_run: bool) -> Dict[str, Any]:
+    # The server opens the search index at startup; without it deleted rows stay indexed
+    await init_search()
+    return await run_retention(batch_size=batch_size, dry_run=dry_run)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MindWeb message retention")
+    parser.add_argument('--dry-run', action='store_true', help='Count expired rows without moving them')
+    parser.add_argument('--batch-size', type=int, default=None)
+    parser.add_argument('--enable-incremental-vacuum', action='store_true',
+                        help='Convert an existing database so freed pages can be reclaimed')
+    args = parser.parse_args()
+
+    if args.enable_incremental_vacuum:
+        asyncio.run(enable_incremental_vacuum())
+        print("auto_vacuum set to INCREMENTAL")
+        return
+    report = asyncio.run(_run_from_cli(args.batch_size, args.dry_run))
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
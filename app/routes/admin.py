@@ -0,0 +1,157 @@
+"""
+Admin routes for FastAPI MindWeb Application
+Operational endpoints guarded by the ADMIN_TOKEN shared secret
+"""
+
+from fastapi import APIRouter, Depends, HTTPException, Header, Request
+from fastapi.responses import StreamingResponse
+from typing import Optional
+from datetime import datetime, timezone
+import hmac
+from app.export import stream_export, export_filename, EXPORT_FORMATS
+from app.stream_registry import stream_registry
+from app.connection_registry import connection_registry
+from app.idempotency import idempotency_store
+from app.broadcast_manager import broadcast_manager
+from app import rendering
+from app.storage import storage_stats
+from app.usage import usage_by_user, usage_by_hour, slowest_messages
+from app.database import AsyncSessionLocal
+from app.settings import get_settings, reload_settings, redacted
+from app.utils.logger import setup_logger
+
+router = APIRouter()
+logger = setup_logger("AdminRouter")
+
+def is_admin_token(token: Optional[str]) -> bool:
+    """True when token matches ADMIN_TOKEN (never when ADMIN_TOKEN is unset)"""
+    expected = get_settings().admin_token
+    return bool(expected and token and hmac.compare_digest(token, expected))
+
+async def require_admin(x_admin_token: Optional[str] = Header(default=None)):
+    """Require the X-Admin-Token header to match ADMIN_TOKEN. Admin routes are disabled when unset."""
+    if not get_settings().admin_token:
+        raise HTTPException(status_code=403, detail="Admin API disabled (ADMIN_TOKEN not set)")
+    if not is_admin_token(x_admin_token):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+def _ms_to_datetime(value: Optional[int]) -> Optional[datetime]:
+    return datetime.fromtimestamp(value / 1000.0, tz=timezone.utc) if value else None
+
+@router.get("/export", dependencies=[Depends(require_admin)])
+async def export_messages(
+    format: str = 'ndjson',
+    gzip: bool = True,
+    user_id: Optional[str] = None,
+    conversation_id: Optional[str] = None,
+    start_ms: Optional[int] = None,
+    end_ms: Optional[int] = None
+):
+    """Stream all matching messages as NDJSON or CSV (gzip by default).
+    Memory use is constant regardless of export size."""
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(EXPORT_FORMATS)}")
+
+    start = _ms_to_datetime(start_ms)
+    end = _ms_to_datetime(end_ms)
+    filename = export_filename(format, gzip)
+    if gzip:
+        media_type = "application/gzip"
+    elif format == 'csv':
+        media_type = "text/csv; charset=utf-8"
+    else:
+        media_type = "application/x-ndjson"
+
+    logger.info(f"Export started: {filename}")
+    return StreamingResponse(
+        stream_export(
+            fmt=format,
+            compress=gzip,
+            user_id=user_id,
+            conversation_id=conversation_id,
+            start=start,
+            end=end
+        ),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@router.get("/streams", dependencies=[Depends(require_admin)])
+async def list_streams():
+    """List in-flight AI generations, with deadline violation counters"""
+    streams = [s.to_dict() for s in stream_registry.streams.values()]
+    return {"status": "success", "streams": streams, "count": len(streams), **stream_registry.stats()}
+
+@router.get("/connections", dependencies=[Depends(require_admin)])
+async def list_connections():
+    """List live SSE/WebSocket connections with age, lag (queued events) and bytes sent"""
+    return {"status": "success", **connection_registry.snapshot()}
+
+@router.get("/idempotency", dependencies=[Depends(require_admin)])
+async def idempotency_stats():
+    """Idempotency key store size and duplicate-hit counters"""
+    return {"status": "success", **idempotency_store.stats()}
+
+@router.get("/journal", dependencies=[Depends(require_admin)])
+async def journal_stats():
+    """Broadcast event journal segments, disk use and write/fsync counters"""
+    if broadcast_manager.journal is None:
+        return {"status": "success", "enabled": False}
+    return {"status": "success", "enabled": True, **broadcast_manager.journal.stats()}
+
+@router.get("/rendering", dependencies=[Depends(require_admin)])
+async def rendering_stats():
+    """Server-side markdown renderer availability and cache hit counters"""
+    return {"status": "success", **rendering.stats()}
+
+@router.get("/storage", dependencies=[Depends(require_admin)])
+async def storage(exact: bool = False):
+    """Stored message sizes (plain vs compressed) and compression CPU cost in this process.
+    exact=true decompresses compressed rows to report bytes saved (scans the table)."""
+    return {"status": "success", **(await storage_stats(exact=exact))}
+
+@router.get("/usage/users", dependencies=[Depends(require_admin)])
+async def usage_users(start_ms: Optional[int] = None, end_ms: Optional[int] = None, limit: int = 100):
+    """AI token usage, cost and latency per user, heaviest first"""
+    async with AsyncSessionLocal() as db:
+        users = await usage_by_user(db, _ms_to_datetime(start_ms), _ms_to_datetime(end_ms), max(1, min(limit, 1000)))
+    return {"status": "success", "users": users}
+
+@router.get("/usage/hourly", dependencies=[Depends(require_admin)])
+async def usage_hourly(start_ms: Optional[int] = None, end_ms: Optional[int] = None, user_id: Optional[str] = None):
+    """AI throughput, token usage and cost per UTC hour"""
+    async with AsyncSessionLocal() as db:
+        hours = await usage_by_hour(db, _ms_to_datetime(start_ms), _ms_to_datetime(end_ms), user_id)
+    return {"status": "success", "hours": hours}
+
+@router.get("/usage/slowest", dependencies=[Depends(require_admin)])
+async def usage_slowest(start_ms: Optional[int] = None, end_ms: Optional[int] = None, limit: int = 20):
+    """Slowest AI answers with their prompts, for finding expensive prompts"""
+    async with AsyncSessionLocal() as db:
+        messages = await slowest_messages(db, _ms_to_datetime(start_ms), _ms_to_datetime(end_ms), max(1, min(limit, 200)))
+    return {"status": "success", "messages": messages}
+
+@router.get("/settings", dependencies=[Depends(require_admin)])
+async def show_settings():
+    """Current settings with secrets masked"""
+    return {"status": "success", "settings": redacted(get_settings())}
+
+@router.post("/settings/reload", dependencies=[Depends(require_admin)])
+async def reload_app_settings():
+    """Re-read .env and the environment (same as SIGHUP).
+    Only runtime-safe values are applied; the others are listed as needing a restart."""
+    settings, applied, restart_required = reload_settings()
+    return {
+        "status": "success",
+        "applied": applied,
+        "restart_required": restart_required,
+        "settings": redacted(settings)
+    }
+
+@router.get("/backends", dependencies=[Depends(require_admin)])
+async def list_backends(request: Request):
+    """Dify backends with health, in-flight streams, failures and observed TTFT"""
+    pool = getattr(request.app.state, 'dify_client', None)
+    if pool is None or not hasattr(pool, 'snapshot'):
+        raise HTTPException(status_code=503, detail="Dify client not initialized")
+    return {"status": "success", **pool.snapshot()}
@@ -3,31 +3,58 @@ Chat routes for FastAPI MindWeb Application
 Handles Dify API integration with streaming responses
 """
 
-from fastapi import APIRouter, HTTPException, Depends, Request
+from fastapi import APIRouter, HTTPException, Depends, Request, Response, Header, WebSocket, WebSocketDisconnect
 from fastapi.responses import StreamingResponse
 import asyncio
-import os
 from pydantic import BaseModel
-from dotenv import load_dotenv
+from sqlalchemy import update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.asyncio import AsyncSession
-from typing import Optional
+from typing import Optional, Tuple
+from collections import OrderedDict
+from datetime import datetime, timezone
+import hmac
 import json
 import time
 import uuid
 from app.database import get_db, User, Conversation, Message, AsyncSessionLocal
-from app.dify_client import AsyncDifyClient
-from app.broadcast_manager import broadcast_manager
+from app.dify_pool import DifyPool
+from app.broadcast_manager import broadcast_manager, normalize_room, parse_rooms, PING_EVENT
+from app.stream_registry import stream_registry, ActiveStream
+from app.connection_registry import connection_registry, ConnectionLimitExceeded
+from app.idempotency import idempotency_store, MAX_KEY_LENGTH
+from app.usage import normalize_usage
+from app.rendering import render_html
+from app.settings import app_settings, chat_config_body
+from app.routes.admin import is_admin_token
+from app import search
+from app import conversations
 from app.utils.logger import setup_logger
+from app.utils.timing import PhaseTimer
+from app.utils.codec import negotiate_subprotocol, is_binary, encode_frame, decode_frame
 
 router = APIRouter()
 logger = setup_logger("ChatRouter")
 
+# Shorter cancel tokens are ignored, leaving the stream cancellable by moderators only
+MIN_CANCEL_TOKEN_LENGTH = 16
+
 class ChatRequest(BaseModel):
     message: str
     user_id: str
     conversation_id: Optional[str] = None
     username: Optional[str] = None
     emoji: Optional[str] = "😀"
+    room: Optional[str] = None
+    # Client-generated secret that lets the asker cancel this answer; never broadcast
+    cancel_token: Optional[str] = None
+
+class CancelRequest(BaseModel):
+    cancel_token: Optional[str] = None
+
+class SubscriptionRequest(BaseModel):
+    listener_id: str
+    room: str
 
 class ChatResponse(BaseModel):
     status: str
@@ -40,164 +67,318 @@ class ChatConfigResponse(BaseModel):
     ai_placeholder: str
     ai_placeholder_zh: str
 
-async def get_dify_client(request: Request) -> AsyncDifyClient:
+async def get_dify_client(request: Request) -> DifyPool:
     """Get Dify client from app state"""
     return request.app.state.dify_client
 
+async def run_idempotent(key: Optional[str], scope: str, payload: ChatRequest, work,
+                         response: Optional[Response] = None) -> dict:
+    """Run a submission once per Idempotency-Key; retries get the original result.
+    Keys are scoped per endpoint and user."""
+    if key and len(key) > MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Idempotency-Key longer than {MAX_KEY_LENGTH} characters")
+    result, replayed = await idempotency_store.run(key, f"{scope}:{payload.user_id}", work)
+    if replayed and response is not None:
+        response.headers["Idempotent-Replayed"] = "true"
+    return result
+
 @router.post("/stream")
 async def stream_chat(
     payload: ChatRequest,
-    req: Request
+    req: Request,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
 ):
-    """Stream chat response from Dify API with real-time broadcasting"""
+    """Stream chat response from Dify API with real-time broadcasting.
+    A retried request with the same Idempotency-Key waits for and returns the
+    original answer instead of starting another generation."""
     
     print(f"DEBUG: stream_chat function called with message: {payload.message[:50]}...")
+    return await run_idempotent(
+        idempotency_key, 'stream', payload,
+        lambda: process_chat_message(payload, req.app), response
+    )
+
+async def process_chat_message(payload: ChatRequest, app) -> dict:
+    """Persist a user message, stream the Dify answer to all listeners and persist it.
+    Shared by the HTTP and WebSocket transports."""
     logger.info(f"Chat request from {payload.username}: {payload.message[:50]}...")
+    room = _resolve_room(payload.room)
     
     # Get Dify client from app state (preferred)
-    dify_client: AsyncDifyClient = getattr(req.app.state, 'dify_client', None)
+    dify_client: DifyPool = getattr(app.state, 'dify_client', None)
     if dify_client is None:
         # Fallback: create a temporary client
-        load_dotenv()
-        api_key = os.getenv("DIFY_API_KEY")
-        api_url = os.getenv("DIFY_API_URL", "http://dify.mindspringedu.com/v1")
         logger.warning("App-level Dify client missing; creating a temporary client")
-        dify_client = AsyncDifyClient(api_key=api_key, api_url=api_url)
+        dify_client = DifyPool.from_settings(app_settings(app))
     
     # Ensure mapping storage exists
-    if not hasattr(req.app.state, 'dify_conversations') or req.app.state.dify_conversations is None:
-        req.app.state.dify_conversations = {}
-    dify_conv_map = req.app.state.dify_conversations
+    if not hasattr(app.state, 'dify_conversations') or app.state.dify_conversations is None:
+        app.state.dify_conversations = {}
+    dify_conv_map = app.state.dify_conversations
     
-    # Create a new database session for this request
-    async with AsyncSessionLocal() as db:
+    timer = PhaseTimer()
+    stream_id = str(uuid.uuid4())
+    prompt_message_id = str(uuid.uuid4())
+    # Set from the stored user once the prompt is persisted; nothing is broadcast before
+    display_name = payload.username
+
+    # The upstream conversation for a conversation we have already mapped is known
+    # without touching the database, so the Dify request can start right away
+    dify_conv_id = None
+    if payload.conversation_id:
+        dify_conv_id = dify_conv_map.get(f"{payload.user_id}:{payload.conversation_id}")
+        if dify_conv_id is None:
+            # Not mapped since the last restart: the stored link keeps the Dify context,
+            # and its backend pin routes the follow-up to the instance that owns it
+            async with AsyncSessionLocal() as db:
+                dify_conv_id, dify_backend = await conversations.dify_conversation_for(
+                    db, payload.conversation_id, payload.user_id)
+            if dify_conv_id:
+                dify_conv_map[f"{payload.user_id}:{payload.conversation_id}"] = dify_conv_id
+                dify_client.pin(dify_conv_id, dify_backend)
+
+    chunks: asyncio.Queue = asyncio.Queue()
+
+    async def pump_upstream():
+        """Prefetch upstream chunks while the user message is persisted"""
         try:
-            # Get or create user
-            user = await get_or_create_user(db, payload.user_id, payload.username, payload.emoji)
-            
-            # Get or create conversation
-            conversation = await get_or_create_conversation(db, payload.conversation_id, payload.user_id)
-            
-            # Save user message to database
-            user_message = Message(
-                message_id=str(uuid.uuid4()),
-                content=payload.message,
-                message_type='user',
-                user_id=payload.user_id,
-                conversation_id=conversation.conversation_id
-            )
-            db.add(user_message)
-            await db.commit()
-            
-            # Broadcast user message to all connected clients
-            await broadcast_manager.broadcast({
-                'type': 'user_message',
-                'content': payload.message,
-                'from_user': payload.username or user.username,
-                'from_user_id': payload.user_id,
-                'emoji': payload.emoji,
-                'timestamp': int(time.time() * 1000)
-            })
-            
-            # Directly stream from Dify and broadcast without StreamTaskManager
-            map_key = f"{payload.user_id}:{conversation.conversation_id}"
+            async for chunk in dify_client.stream_chat(payload.message, payload.user_id, dify_conv_id):
+                timer.mark('upstream_first_chunk')
+                active.touch()
+                if chunk.get('task_id'):
+                    active.upstream_task_id = chunk['task_id']
+                await chunks.put(chunk)
+        except Exception as e:
+            await chunks.put({'event': 'error', 'error': str(e)})
+        finally:
+            await chunks.put(None)
+
+    pump_task = asyncio.create_task(pump_upstream())
+    active = ActiveStream(
+        stream_id, payload.user_id, room, pump_task,
+        stop_upstream=lambda task_id: dify_client.stop(task_id, payload.user_id),
+        cancel_token=_usable_cancel_token(payload.cancel_token)
+    )
+    stream_registry.register(active)
+    prompt_html = render_html(payload.message)
+    persist_task = asyncio.create_task(_persist_user_message(payload, room, timer, prompt_message_id, prompt_html))
+
+    def ai_event(event_type: str, **fields) -> dict:
+        return {
+            'type': event_type,
+            'stream_id': stream_id,
+            'reply_to_username': display_name,
+            'reply_to_user_id': payload.user_id,
+            'prompt': payload.message,
+            'from_user': display_name,
+            'from_user_id': payload.user_id,
+            'timestamp': int(time.time() * 1000),
+            **fields
+        }
+
+    try:
+        # Nothing is broadcast, neither the prompt nor the answer, until the
+        # prompt is safely stored. If persistence fails the transaction is rolled
+        # back, the upstream stream is closed and only the sender gets the error.
+        # The upstream request is already running, so the answer's latency is unchanged.
+        try:
+            user, conversation = await persist_task
+        except Exception as e:
+            logger.error(f"Chat persistence error: {e}")
+            # Closes the upstream stream and, once Dify has reported its task_id, stops the generation
+            await stream_registry.cancel(stream_id, 'persist_failed')
+            raise HTTPException(status_code=500, detail=f"Failed to process chat: {str(e)}")
+        timer.mark('persisted')
+        display_name = payload.username or user.username
+
+        await broadcast_manager.broadcast({
+            'type': 'user_message',
+            'content': payload.message,
+            'content_html': prompt_html,
+            'from_user': display_name,
+            'from_user_id': payload.user_id,
+            'emoji': payload.emoji,
+            'timestamp': int(time.time() * 1000)
+        }, room)
+        timer.mark('user_broadcast')
+
+        map_key = f"{payload.user_id}:{conversation.conversation_id}"
+        ai_text = ""
+        ai_html = None
+        chunk_count = 0
+        usage = None
+        upstream = {}
+        try:
+            while True:
+                chunk = await chunks.get()
+                if chunk is None or active.cancelled:
+                    break
+                event = chunk.get('event')
+                for key in ('task_id', 'message_id', 'conversation_id'):
+                    if chunk.get(key) and key not in upstream:
+                        upstream[key] = chunk[key]
+                if event == 'message':
+                    content = chunk.get('answer', '')
+                    if content:
+                        timer.mark('first_token_broadcast')
+                        chunk_count += 1
+                        ai_text += content
+                        await broadcast_manager.broadcast(ai_event(
+                            'ai_message_chunk',
+                            content=content,
+                            conversation_id=conversation.conversation_id
+                        ), room)
+                    conv_id = chunk.get('conversation_id')
+                    if conv_id and not dify_conv_map.get(map_key):
+                        dify_conv_map[map_key] = conv_id
+                elif event == 'message_end':
+                    usage = normalize_usage((chunk.get('metadata') or {}).get('usage'))
+                    # Rendered once here, off the event loop, for every listener and for history
+                    ai_html = await asyncio.to_thread(render_html, ai_text)
+                    await broadcast_manager.broadcast(ai_event(
+                        'ai_message_end',
+                        conversation_id=conversation.conversation_id,
+                        content_html=ai_html
+                    ), room)
+                    conv_id = chunk.get('conversation_id')
+                    if conv_id:
+                        dify_conv_map[map_key] = conv_id
+                    break
+                elif event == 'error':
+                    await broadcast_manager.broadcast(ai_event('error', error=chunk.get('error')), room)
+                    # Clear bad mapping
+                    if map_key in dify_conv_map:
+                        dify_conv_map.pop(map_key, None)
+                    async with AsyncSessionLocal() as db:
+                        await conversations.set_dify_conversation(db, conversation.conversation_id, None)
+                        await db.commit()
+                    ai_text = ""
+                    break
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"Streaming error: {e}")
+            await broadcast_manager.broadcast(ai_event('error', error=str(e)), room)
             ai_text = ""
-            dify_conv_id = dify_conv_map.get(map_key)
-            stream_id = str(uuid.uuid4())
-            try:
-                async for chunk in dify_client.stream_chat(payload.message, payload.user_id, dify_conv_id):
-                    event = chunk.get('event')
-                    if event == 'message':
-                        content = chunk.get('answer', '')
-                        if content:
-                            ai_text += content
-                            await broadcast_manager.broadcast({
-                                'type': 'ai_message_chunk',
-                                'content': content,
-                                'conversation_id': conversation.conversation_id,
-                                'stream_id': stream_id,
-                                'reply_to_username': payload.username or user.username,
-                                'reply_to_user_id': payload.user_id,
-                                'prompt': payload.message,
-                                'from_user': payload.username or user.username,
-                                'from_user_id': payload.user_id,
-                                'timestamp': int(time.time() * 1000)
-                            })
-                        conv_id = chunk.get('conversation_id')
-                        if conv_id and not dify_conv_map.get(map_key):
-                            dify_conv_map[map_key] = conv_id
-                    elif event == 'message_end':
-                        await broadcast_manager.broadcast({
-                            'type': 'ai_message_end',
-                            'conversation_id': conversation.conversation_id,
-                            'stream_id': stream_id,
-                            'reply_to_username': payload.username or user.username,
-                            'reply_to_user_id': payload.user_id,
-                            'prompt': payload.message,
-                            'from_user': payload.username or user.username,
-                            'from_user_id': payload.user_id,
-                            'timestamp': int(time.time() * 1000)
-                        })
-                        conv_id = chunk.get('conversation_id')
-                        if conv_id:
-                            dify_conv_map[map_key] = conv_id
-                        break
-                    elif event == 'error':
-                        await broadcast_manager.broadcast({
-                            'type': 'error',
-                            'error': chunk.get('error'),
-                            'stream_id': stream_id,
-                            'reply_to_username': payload.username or user.username,
-                            'reply_to_user_id': payload.user_id,
-                            'prompt': payload.message,
-                            'from_user': payload.username or user.username,
-                            'from_user_id': payload.user_id,
-                            'timestamp': int(time.time() * 1000)
-                        })
-                        # Clear bad mapping
-                        if map_key in dify_conv_map:
-                            dify_conv_map.pop(map_key, None)
-                        ai_text = ""
-                        break
-            except asyncio.CancelledError:
-                pass
-            except Exception as e:
-                logger.error(f"Streaming error: {e}")
-                await broadcast_manager.broadcast({
-                    'type': 'error',
-                    'error': str(e),
-                    'stream_id': stream_id,
-                    'reply_to_username': payload.username or user.username,
-                    'reply_to_user_id': payload.user_id,
-                    'prompt': payload.message,
-                    'from_user': payload.username or user.username,
-                    'from_user_id': payload.user_id,
-                    'timestamp': int(time.time() * 1000)
-                })
-                ai_text = ""
-
-            # Persist AI message after stream end
-            if ai_text:
+        timer.mark('upstream_done')
+        if upstream.get('conversation_id'):
+            # Stored with the conversation link so the pin survives a restart
+            upstream['backend'] = dify_client.backend_for(upstream['conversation_id'])
+
+        # Usage and latency for capacity planning (see app/usage.py)
+        metadata = {
+            'room': room,
+            'usage': usage,
+            'ttft_ms': timer.phases.get('first_token_broadcast'),
+            'duration_ms': timer.elapsed_ms(),
+            'chunk_count': chunk_count,
+            'upstream': upstream,
+            'prompt_message_id': prompt_message_id,
+        }
+        if active.cancelled:
+            metadata.update({'cancelled': True, 'cancel_reason': active.cancel_reason})
+            await broadcast_manager.broadcast(ai_event(
+                # Deadline violations get their own event so clients can say why the answer stopped
+                'ai_message_timeout' if active.timed_out else 'ai_message_cancelled',
+                conversation_id=conversation.conversation_id,
+                reason=active.cancel_reason
+            ), room)
+
+        # Persist AI message (partial if cancelled) after stream end
+        if ai_text:
+            if ai_html is None:
+                # Cancelled or cut short: render the partial answer for history
+                ai_html = await asyncio.to_thread(render_html, ai_text)
+            async with AsyncSessionLocal() as db:
                 ai_message = Message(
                     message_id=str(uuid.uuid4()),
                     content=ai_text,
+                    content_html=ai_html,
                     message_type='ai',
                     user_id=payload.user_id,
-                    conversation_id=conversation.conversation_id
+                    conversation_id=conversation.conversation_id,
+                    message_metadata=json.dumps(metadata)
                 )
                 db.add(ai_message)
                 await db.commit()
-            
-            # Return success response
-            return {
-                "status": "success",
-                "message": "Message processed successfully",
-                "conversation_id": conversation.conversation_id
-            }
-            
-        except Exception as e:
-            logger.error(f"Chat processing error: {e}")
-            raise HTTPException(status_code=500, detail=f"Failed to process chat: {str(e)}")
+
+        logger.info(f"Chat {stream_id[:8]} timings: {timer.summary()}")
+
+        # Return success response
+        return {
+            "status": ("timeout" if active.timed_out else "cancelled") if active.cancelled else "success",
+            "message": "Message processed successfully",
+            "conversation_id": conversation.conversation_id,
+            "stream_id": stream_id,
+            "timings": timer.phases
+        }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Chat processing error: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to process chat: {str(e)}")
+    finally:
+        pump_task.cancel()
+        if not persist_task.done():
+            persist_task.cancel()
+        stream_registry.unregister(stream_id)
+
+@router.post("/stream/{stream_id}/cancel")
+async def cancel_stream(
+    stream_id: str,
+    payload: CancelRequest,
+    x_admin_token: Optional[str] = Header(default=None)
+):
+    """Stop an in-flight AI answer. Allowed for the asker, who proves it with the cancel_token sent
+    along with the question, or with the admin token (moderation). user_id is no proof: every
+    AI event broadcasts it to the room.
+    The partial answer is kept and an ai_message_cancelled event is broadcast."""
+    active = stream_registry.get(stream_id)
+    if active is None:
+        raise HTTPException(status_code=404, detail="Stream not found or already finished")
+    if is_admin_token(x_admin_token):
+        reason = 'moderator'
+    elif payload.cancel_token and active.cancel_token and \
+            hmac.compare_digest(payload.cancel_token, active.cancel_token):
+        reason = 'user'
+    else:
+        raise HTTPException(status_code=403, detail="Not allowed to cancel this stream")
+    if not await stream_registry.cancel(stream_id, reason):
+        raise HTTPException(status_code=409, detail="Stream already cancelled")
+    return {"status": "success", "stream_id": stream_id, "reason": reason}
+
+def _usable_cancel_token(token: Optional[str]) -> Optional[str]:
+    """Accept only tokens long enough not to be guessed (the web client sends a random UUID)"""
+    if token and MIN_CANCEL_TOKEN_LENGTH <= len(token) <= MAX_KEY_LENGTH:
+        return token
+    return None
+
+async def _persist_user_message(payload: ChatRequest, room: str, timer: PhaseTimer,
+                                message_id: str, content_html: Optional[str] = None) -> Tuple[User, Conversation]:
+    """Store user, conversation and prompt in one transaction; rolled back as a whole on failure"""
+    async with AsyncSessionLocal() as db:
+        try:
+            user = await get_or_create_user(db, payload.user_id, payload.username, payload.emoji)
+            timer.mark('user_ready')
+            conversation = await get_or_create_conversation(db, payload.conversation_id, payload.user_id)
+            timer.mark('conversation_ready')
+            db.add(Message(
+                message_id=message_id,
+                content=payload.message,
+                content_html=content_html,
+                message_type='user',
+                user_id=payload.user_id,
+                conversation_id=conversation.conversation_id,
+                message_metadata=json.dumps({'room': room})
+            ))
+            await db.commit()
+            timer.mark('user_message_committed')
+            return user, conversation
+        except Exception:
+            await db.rollback()
+            raise
 
 @router.get("/history")
 async def get_chat_history(
@@ -238,9 +419,29 @@ async def get_chat_history(
             if oldest and oldest.created_at:
                 next_before_ms = int(oldest.created_at.timestamp() * 1000)
 
+        history = [msg.to_dict() for msg in messages_chrono]
+        # Stored before server rendering (or while it was off): rendered off the event loop
+        # once and written back, so later requests read the stored HTML
+        unrendered = [item for item in history if item['content_html'] is None]
+        if unrendered:
+            rendered = await asyncio.to_thread(lambda: [render_html(item['content']) for item in unrendered])
+            for item, html in zip(unrendered, rendered):
+                item['content_html'] = html
+            try:
+                for item in unrendered:
+                    await db.execute(
+                        update(Message)
+                        .where(Message.id == item['id'], Message.content_html.is_(None))
+                        .values(content_html=item['content_html'])
+                    )
+                await db.commit()
+            except Exception as e:
+                await db.rollback()
+                logger.warning(f"Could not store rendered history HTML: {e}")
+
         return {
             "status": "success",
-            "messages": [msg.to_dict() for msg in messages_chrono],
+            "messages": history,
             "count": len(messages),
             "next_before_ms": next_before_ms
         }
@@ -249,12 +450,86 @@ async def get_chat_history(
         logger.error(f"Error getting chat history: {e}")
         raise HTTPException(status_code=500, detail="Failed to get chat history")
 
+@router.get("/conversations")
+async def list_conversations(
+    user_id: str,
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_db)
+):
+    """A user's conversations, most recently active first, with last message preview and count.
+    Pass next_cursor back as cursor to page further."""
+    limit = max(1, min(limit, 100))
+    try:
+        items, next_cursor = await conversations.list_conversations(db, user_id, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {
+        "status": "success",
+        "conversations": items,
+        "count": len(items),
+        "next_cursor": next_cursor
+    }
+
+@router.get("/search")
+async def search_chat(
+    q: str,
+    user_id: Optional[str] = None,
+    conversation_id: Optional[str] = None,
+    start_ms: Optional[int] = None,
+    end_ms: Optional[int] = None,
+    limit: int = 20,
+    offset: int = 0,
+    db: AsyncSession = Depends(get_db)
+):
+    """Full-text search over chat history, best match first with highlighted snippets.
+    Optional filters: user, conversation and a [start_ms, end_ms) time range (epoch ms)."""
+    if not search.fts_available:
+        raise HTTPException(status_code=503, detail="Search index unavailable")
+    try:
+        from datetime import datetime, timezone
+
+        limit = max(1, min(limit, 50))
+        offset = max(0, offset)
+        start = datetime.fromtimestamp(start_ms / 1000.0, tz=timezone.utc) if start_ms else None
+        end = datetime.fromtimestamp(end_ms / 1000.0, tz=timezone.utc) if end_ms else None
+
+        results = await search.search_messages(
+            db, q,
+            user_id=user_id,
+            conversation_id=conversation_id,
+            start=start,
+            end=end,
+            limit=limit,
+            offset=offset
+        )
+        return {
+            "status": "success",
+            "results": results,
+            "count": len(results),
+            "next_offset": offset + limit if len(results) == limit else None
+        }
+
+    except Exception as e:
+        logger.error(f"Error searching chat history: {e}")
+        raise HTTPException(status_code=500, detail="Failed to search chat history")
+
 @router.post("/group")
 async def send_group_message(
-    payload: ChatRequest
+    payload: ChatRequest,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
 ):
-    """Broadcast a group chat message without triggering Dify."""
-    load_dotenv()
+    """Broadcast a group chat message without triggering Dify.
+    Retries with the same Idempotency-Key are not persisted or broadcast again."""
+    return await run_idempotent(
+        idempotency_key, 'group', payload,
+        lambda: process_group_message(payload), response
+    )
+
+async def process_group_message(payload: ChatRequest) -> dict:
+    """Persist and broadcast a group message. Shared by the HTTP and WebSocket transports."""
+    room = _resolve_room(payload.room)
     async with AsyncSessionLocal() as db:
         try:
             # Ensure user exists/updated
@@ -262,12 +537,15 @@ async def send_group_message(
 
             # Persist message with a fixed group conversation id
             group_conversation_id = "group"
+            content_html = render_html(payload.message)
             message = Message(
                 message_id=str(uuid.uuid4()),
                 content=payload.message,
+                content_html=content_html,
                 message_type='user',
                 user_id=payload.user_id,
-                conversation_id=group_conversation_id
+                conversation_id=group_conversation_id,
+                message_metadata=json.dumps({'room': room})
             )
             db.add(message)
             await db.commit()
@@ -276,11 +554,12 @@ async def send_group_message(
             await broadcast_manager.broadcast({
                 'type': 'user_message',
                 'content': payload.message,
+                'content_html': content_html,
                 'from_user': payload.username or user.username,
                 'from_user_id': payload.user_id,
                 'emoji': payload.emoji or user.emoji,
                 'timestamp': int(time.time() * 1000)
-            })
+            }, room)
 
             return {
                 'status': 'success',
@@ -291,110 +570,209 @@ async def send_group_message(
             raise HTTPException(status_code=500, detail="Failed to send group message")
 
 @router.get("/config", response_model=ChatConfigResponse)
-async def get_chat_config():
-    """Return frontend configuration such as WEB_URL for sharing"""
+async def get_chat_config(
+    req: Request,
+    if_none_match: Optional[str] = Header(None, alias="If-None-Match")
+):
+    """Return frontend configuration such as WEB_URL for sharing.
+    The body is rendered once per settings version and served with an ETag;
+    clients revalidate and get 304 until the settings are reloaded."""
+    body, etag = chat_config_body(app_settings(req.app))
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(',')]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def _resolve_room(room: Optional[str]) -> str:
+    """Validate a client-supplied room, mapping bad names to HTTP 400"""
     try:
-        load_dotenv()
-        web_url = os.getenv("WEB_URL", "http://localhost:9530")
-        ai_name = os.getenv("AI_NAME", "MindMate")
-        ai_placeholder = os.getenv("AI_PLACEHOLDER", "Ask MindMate AI anything...")
-        ai_placeholder_zh = os.getenv("AI_PLACEHOLDER_ZH", "问问 MindMate AI 吧…")
-        return ChatConfigResponse(
-            web_url=web_url, 
-            ai_name=ai_name, 
-            ai_placeholder=ai_placeholder,
-            ai_placeholder_zh=ai_placeholder_zh
-        )
-    except Exception as e:
-        logger.error(f"Error reading config: {e}")
-        raise HTTPException(status_code=500, detail="Failed to load config")
+        return normalize_room(room)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 async def get_or_create_user(db: AsyncSession, user_id: str, username: str, emoji: str) -> User:
-    """Get or create user in database"""
-    from sqlalchemy import select
-    
-    result = await db.execute(select(User).where(User.user_id == user_id))
-    user = result.scalar_one_or_none()
-    
-    if not user:
-        user = User(
-            user_id=user_id,
-            username=username or f"User{user_id[-4:]}",
-            emoji=emoji
-        )
-        db.add(user)
-        await db.commit()
-        await db.refresh(user)
-        logger.info(f"Created new user: {user.username}")
-    else:
-        # Update last seen
-        from datetime import datetime, timezone
-        user.last_seen = datetime.now(timezone.utc)
-        await db.commit()
-        logger.debug(f"Updated user last seen: {user.username}")
-    
-    return user
+    """Insert the user or refresh last_seen in one INSERT ... ON CONFLICT ... RETURNING.
+    Concurrent first messages from one user_id cannot trip the unique constraint.
+    Runs in the caller's transaction; the caller commits."""
+    now = datetime.now(timezone.utc)
+    stmt = sqlite_insert(User).values(
+        user_id=user_id,
+        username=username or f"User{user_id[-4:]}",
+        emoji=emoji,
+        created_at=now,
+        last_seen=now
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[User.user_id],
+        set_={'last_seen': stmt.excluded.last_seen}
+    ).returning(User)
+    result = await db.execute(stmt, execution_options={'populate_existing': True})
+    return result.scalar_one()
 
 async def get_or_create_conversation(db: AsyncSession, conversation_id: str, user_id: str) -> Conversation:
-    """Get or create conversation in database"""
-    from sqlalchemy import select
-    
+    """Touch an existing conversation or create a new one, one statement each way.
+    Unknown ids get a fresh server-issued id, as before. The caller commits."""
+    now = datetime.now(timezone.utc)
     if conversation_id:
-        result = await db.execute(select(Conversation).where(Conversation.conversation_id == conversation_id))
+        result = await db.execute(
+            update(Conversation)
+            .where(Conversation.conversation_id == conversation_id)
+            .values(updated_at=now)
+            .returning(Conversation),
+            execution_options={'populate_existing': True}
+        )
         conversation = result.scalar_one_or_none()
         if conversation:
             return conversation
-    
-    # Create new conversation
+
+    # Create new conversation (a random id cannot conflict)
     new_conversation_id = str(uuid.uuid4())
-    conversation = Conversation(
-        conversation_id=new_conversation_id,
-        user_id=user_id,
-        title="New Conversation"
+    result = await db.execute(
+        sqlite_insert(Conversation).values(
+            conversation_id=new_conversation_id,
+            user_id=user_id,
+            title="New Conversation",
+            created_at=now,
+            updated_at=now
+        ).returning(Conversation)
     )
-    db.add(conversation)
-    await db.commit()
-    await db.refresh(conversation)
-    
     logger.info(f"Created new conversation: {new_conversation_id}")
-    return conversation
+    return result.scalar_one()
+
+# Encoded frames of recent broadcast events; every SSE listener writes the same bytes
+_FRAME_CACHE_SIZE = 1024
+_frame_cache: "OrderedDict[tuple, bytes]" = OrderedDict()
+_PING_FRAME = f"data: {json.dumps({'type': 'ping'})}\n\n".encode('utf-8')
+
+def _sse_frame(event: dict) -> bytes:
+    """Encode one SSE frame; broadcast events carry an id so clients can resume with Last-Event-ID.
+    Broadcast events are encoded once, not once per listener."""
+    if event is PING_EVENT:
+        return _PING_FRAME
+    event_id = event.get('event_id')
+    if event_id is None:
+        return f"data: {json.dumps(event)}\n\n".encode('utf-8')
+    # A stream snapshot shares the event_id of its last chunk, so the type is part of the key
+    key = (event_id, event.get('type'))
+    frame = _frame_cache.get(key)
+    if frame is None:
+        frame = f"id: {event_id}\ndata: {json.dumps(event)}\n\n".encode('utf-8')
+        _frame_cache[key] = frame
+        if len(_frame_cache) > _FRAME_CACHE_SIZE:
+            _frame_cache.popitem(last=False)
+    return frame
+
+def _take_batch(queue: asyncio.Queue, first: Optional[dict], max_bytes: int) -> Tuple[bytes, int, bool]:
+    """Encode `first` plus whatever is already queued, up to max_bytes, for a single write.
+    Returns (payload, events, closed); closed means the None sentinel was reached."""
+    parts, size, events = [], 0, 0
+    message = first
+    while message is not None:
+        frame = _sse_frame(message)
+        parts.append(frame)
+        size += len(frame)
+        events += 1
+        if size >= max_bytes:
+            break
+        try:
+            message = queue.get_nowait()
+        except asyncio.QueueEmpty:
+            break
+    return b''.join(parts), events, message is None
+
+def _parse_event_id(value: Optional[str]) -> Optional[int]:
+    try:
+        return int(value) if value else None
+    except ValueError:
+        return None
 
 @router.get("/broadcast")
-async def broadcast_stream():
-    """Server-Sent Events endpoint for real-time broadcasting"""
+async def broadcast_stream(
+    request: Request,
+    rooms: Optional[str] = None,
+    user_id: Optional[str] = None,
+    tab_id: Optional[str] = None,
+    last_event_id: Optional[str] = None,
+    last_event_id_header: Optional[str] = Header(None, alias="Last-Event-ID")
+):
+    """Server-Sent Events endpoint for real-time broadcasting.
+    `rooms` is a comma-separated list of rooms to join (default: lobby); the first
+    event carries a listener_id for /broadcast/subscribe and /broadcast/unsubscribe.
+    Reconnecting clients send Last-Event-ID (or ?last_event_id=) to receive only
+    the events they missed; in-flight AI answers arrive as one ai_stream_snapshot each.
+    Connections are capped (429 + Retry-After); a new connection with the same
+    user_id and tab_id replaces the older one."""
+    try:
+        room_list = parse_rooms(rooms)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    resume_from = _parse_event_id(last_event_id_header or last_event_id)
+    
+    # Create a queue for this connection
+    queue = asyncio.Queue(maxsize=200)
+    try:
+        conn = connection_registry.open(
+            queue, user_id, tab_id, request.client.host if request.client else None, 'sse'
+        )
+    except ConnectionLimitExceeded as e:
+        raise HTTPException(status_code=429, detail=str(e),
+                            headers={"Retry-After": str(e.retry_after)})
+    
+    # Register and take history + stream snapshots atomically
+    listener_id, initial_events = broadcast_manager.attach(queue, room_list, resume_from, heartbeat=True)
+    conn.listener_id = listener_id
     
     async def event_generator():
-        # Create a queue for this connection
-        queue = asyncio.Queue(maxsize=200)
-        
-        # Add this queue to the broadcast manager
-        broadcast_manager.add_listener(queue)
-        
         try:
-            # Send recent history to new client
-            for event in broadcast_manager.get_recent_history(10):
-                yield f"data: {json.dumps(event)}\n\n"
+            # retry: tells EventSource how long to wait before reconnecting (jittered)
+            frame = f"retry: {connection_registry.retry_hint_ms()}\n".encode('utf-8') + _sse_frame({
+                'type': 'subscribed',
+                'listener_id': listener_id,
+                'connection_id': conn.connection_id,
+                'rooms': room_list
+            })
+            yield frame
+            conn.record_write(len(frame), 0)
+            
+            # Replay (history + stream snapshots) goes out in as few writes as the budget allows
+            max_bytes = app_settings(request.app).sse_batch_max_bytes
+            frames, size = [], 0
+            for index, event in enumerate(initial_events):
+                frames.append(_sse_frame(event))
+                size += len(frames[-1])
+                if size >= max_bytes or index == len(initial_events) - 1:
+                    yield b''.join(frames)
+                    conn.record_write(size, len(frames))
+                    frames, size = [], 0
             
             while True:
-                # Wait for messages from the broadcast manager
-                try:
-                    message = await asyncio.wait_for(queue.get(), timeout=30.0)
-                    yield f"data: {json.dumps(message)}\n\n"
-                except asyncio.TimeoutError:
-                    # Send keepalive ping
-                    yield f"data: {json.dumps({'type': 'ping'})}\n\n"
-                except asyncio.CancelledError:
-                    # Client disconnected; exit quietly
+                # Events, keepalive pings (shared heartbeat) and the close sentinel all arrive here
+                message = await queue.get()
+
+                settings = app_settings(request.app)
+                if message is not None and message is not PING_EVENT \
+                        and settings.sse_batch_window_ms > 0 and queue.empty():
+                    # Let a fast producer add to this write (bounded extra latency)
+                    await asyncio.sleep(settings.sse_batch_window_ms / 1000)
+                # Everything queued so far goes out as one chunk: one send, one wakeup
+                payload, events, closed = _take_batch(queue, message, settings.sse_batch_max_bytes)
+                if closed:
+                    # Replaced by a newer tab connection or reaped
+                    payload += _sse_frame({'type': 'closed', 'reason': conn.close_reason})
+                # Resuming after the yield means the previous write completed
+                yield payload
+                conn.record_write(len(payload), events)
+                if closed:
                     break
                     
         except asyncio.CancelledError:
-            # Connection cancelled during shutdown; suppress stacktrace
+            # Client disconnected or server shutting down; suppress stacktrace
             pass
         except Exception as e:
             logger.error(f"Broadcast stream error: {e}")
         finally:
-            # Remove this queue from the broadcast manager
-            broadcast_manager.remove_listener(queue)
+            # Detach from the broadcast manager and free the connection slot
+            connection_registry.close(conn, 'disconnected')
     
     return StreamingResponse(
         event_generator(),
@@ -407,3 +785,184 @@ async def broadcast_stream():
             "Access-Control-Allow-Headers": "Cache-Control",
         }
     )
+
+@router.post("/broadcast/subscribe")
+async def subscribe_room(payload: SubscriptionRequest):
+    """Add a room to a live broadcast connection"""
+    try:
+        found = broadcast_manager.subscribe(payload.listener_id, payload.room)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not found:
+        raise HTTPException(status_code=404, detail="Listener not found")
+    return {"status": "success", "rooms": broadcast_manager.get_rooms(payload.listener_id)}
+
+@router.post("/broadcast/unsubscribe")
+async def unsubscribe_room(payload: SubscriptionRequest):
+    """Remove a room from a live broadcast connection"""
+    try:
+        found = broadcast_manager.unsubscribe(payload.listener_id, payload.room)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not found:
+        raise HTTPException(status_code=404, detail="Listener not found")
+    return {"status": "success", "rooms": broadcast_manager.get_rooms(payload.listener_id)}
+
+@router.websocket("/ws")
+async def websocket_endpoint(websocket: WebSocket):
+    """Bidirectional transport: sends, acks, presence and broadcast events over one connection.
+    Clients may negotiate the `mindweb.msgpack` subprotocol for binary frames;
+    permessage-deflate is negotiated by the server (see WS_PER_MESSAGE_DEFLATE)."""
+    subprotocol = negotiate_subprotocol(websocket.scope.get('subprotocols') or [])
+    await websocket.accept(subprotocol=subprotocol)
+    binary = is_binary(subprotocol)
+    send_lock = asyncio.Lock()
+    pending = set()
+
+    params = websocket.query_params
+    user_id = params.get('user_id')
+    username = params.get('username')
+    emoji = params.get('emoji') or "😀"
+    try:
+        room_list = parse_rooms(params.get('rooms'))
+    except ValueError as e:
+        await websocket.close(code=1008, reason=str(e))
+        return
+
+    queue = asyncio.Queue(maxsize=200)
+    try:
+        conn = connection_registry.open(
+            queue, user_id, params.get('tab_id'),
+            websocket.client.host if websocket.client else None, 'ws'
+        )
+    except ConnectionLimitExceeded as e:
+        # 1013: try again later
+        await websocket.close(code=1013, reason=str(e))
+        return
+
+    async def send(message: dict):
+        frame = encode_frame(message, binary)
+        async with send_lock:
+            if binary:
+                await websocket.send_bytes(frame)
+            else:
+                await websocket.send_text(frame)
+        conn.record_write(len(frame) if binary else len(frame.encode('utf-8')))
+
+    listener_id, initial_events = broadcast_manager.attach(
+        queue, room_list, _parse_event_id(params.get('last_event_id'))
+    )
+    conn.listener_id = listener_id
+
+    async def forward_broadcasts():
+        try:
+            for event in initial_events:
+                await send(event)
+            while True:
+                message = await queue.get()
+                if message is None:
+                    # Replaced by a newer tab connection or reaped
+                    await send({'type': 'closed', 'reason': conn.close_reason})
+                    await websocket.close(code=4000, reason=conn.close_reason or 'closed')
+                    break
+                await send(message)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.debug(f"WebSocket forwarder stopped: {e}")
+
+    async def handle_send(frame: dict):
+        ref = frame.get('ref')
+        try:
+            payload = ChatRequest(
+                message=frame.get('message', ''),
+                user_id=frame.get('user_id') or user_id,
+                conversation_id=frame.get('conversation_id'),
+                username=frame.get('username') or username,
+                emoji=frame.get('emoji') or emoji,
+                room=frame.get('room') or room_list[0],
+                cancel_token=frame.get('cancel_token')
+            )
+            key = frame.get('idempotency_key')
+            if frame.get('mode') == 'group':
+                result = await run_idempotent(key, 'group', payload, lambda: process_group_message(payload))
+            else:
+                result = await run_idempotent(
+                    key, 'stream', payload, lambda: process_chat_message(payload, websocket.app)
+                )
+            ack = {'type': 'ack', 'ref': ref, **result}
+        except HTTPException as e:
+            ack = {'type': 'ack', 'ref': ref, 'status': 'error', 'detail': e.detail}
+        except Exception as e:
+            logger.error(f"WebSocket send error: {e}")
+            ack = {'type': 'ack', 'ref': ref, 'status': 'error', 'detail': str(e)}
+        try:
+            await send(ack)
+        except Exception:
+            # Client went away while the answer was streaming; the broadcast already happened
+            pass
+
+    forwarder = asyncio.create_task(forward_broadcasts())
+    try:
+        await send({
+            'type': 'hello',
+            'encoding': 'msgpack' if binary else 'json',
+            'listener_id': listener_id,
+            'rooms': room_list
+        })
+        if user_id:
+            await _broadcast_presence('online', user_id, username, emoji, room_list)
+
+        while True:
+            message = await websocket.receive()
+            if message.get('type') == 'websocket.disconnect':
+                break
+            data = message.get('bytes') if message.get('bytes') is not None else message.get('text')
+            try:
+                frame = decode_frame(data)
+            except Exception as e:
+                await send({'type': 'error', 'error': f"Invalid frame: {e}"})
+                continue
+
+            op = frame.get('op')
+            if op == 'send':
+                # AI answers can take a while; keep reading frames while they stream
+                task = asyncio.create_task(handle_send(frame))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            elif op in ('subscribe', 'unsubscribe'):
+                try:
+                    if op == 'subscribe':
+                        broadcast_manager.subscribe(listener_id, frame.get('room'))
+                    else:
+                        broadcast_manager.unsubscribe(listener_id, frame.get('room'))
+                    await send({'type': 'subscribed', 'ref': frame.get('ref'),
+                                'rooms': broadcast_manager.get_rooms(listener_id)})
+                except ValueError as e:
+                    await send({'type': 'error', 'error': str(e), 'ref': frame.get('ref')})
+            elif op == 'ping':
+                await send({'type': 'pong', 'ref': frame.get('ref')})
+            else:
+                await send({'type': 'error', 'error': f"Unknown op: {op}", 'ref': frame.get('ref')})
+
+    except (WebSocketDisconnect, asyncio.CancelledError):
+        pass
+    except Exception as e:
+        logger.error(f"WebSocket error: {e}")
+    finally:
+        forwarder.cancel()
+        rooms_left = broadcast_manager.get_rooms(listener_id)
+        connection_registry.close(conn, 'disconnected')
+        if user_id:
+            await _broadcast_presence('offline', user_id, username, emoji, rooms_left)
+
+async def _broadcast_presence(status: str, user_id: str, username: Optional[str], emoji: str, rooms):
+    """Announce a WebSocket user joining or leaving to each of its rooms"""
+    for room in rooms:
+        await broadcast_manager.broadcast({
+            'type': 'presence',
+            'status': status,
+            'user_id': user_id,
+            'username': username,
+            'emoji': emoji
+        }, room)
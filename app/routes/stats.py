@@ -0,0 +1,52 @@
+"""
+Usage statistics routes for FastAPI MindWeb Application
+Dashboard reads served from the analytics rollups (see app/analytics.py)
+"""
+
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Optional
+from app.analytics import rollup_series, GRANULARITIES, ALL_ROOMS
+from app.broadcast_manager import normalize_room
+from app.database import get_db
+from app.routes.admin import require_admin, _ms_to_datetime
+from app.utils.logger import setup_logger
+
+router = APIRouter()
+logger = setup_logger("StatsRouter")
+
+@router.get("", dependencies=[Depends(require_admin)])
+async def get_stats(
+    granularity: str = 'hour',
+    room: Optional[str] = None,
+    start_ms: Optional[int] = None,
+    end_ms: Optional[int] = None,
+    limit: int = 48,
+    db: AsyncSession = Depends(get_db)
+):
+    """Messages by type, distinct active users, AI answers and average AI latency per
+    minute or hour bucket, for one room (class) or all rooms (default)"""
+    if granularity not in GRANULARITIES:
+        raise HTTPException(status_code=400, detail=f"granularity must be one of {', '.join(GRANULARITIES)}")
+    try:
+        room = normalize_room(room) if room and room != ALL_ROOMS else ALL_ROOMS
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    limit = max(1, min(limit, 1440))
+    try:
+        buckets = await rollup_series(
+            db, granularity, room,
+            start=_ms_to_datetime(start_ms),
+            end=_ms_to_datetime(end_ms),
+            limit=limit
+        )
+    except Exception as e:
+        logger.error(f"Error reading stats: {e}")
+        raise HTTPException(status_code=500, detail="Failed to read stats")
+    return {
+        "status": "success",
+        "granularity": granularity,
+        "room": room,
+        "buckets": buckets,
+        "count": len(buckets)
+    }
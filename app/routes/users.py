@@ -5,6 +5,7 @@ User management routes for FastAPI MindWeb Application
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, and_, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from datetime import datetime, timedelta
 from pydantic import BaseModel
 from typing import List, Optional
@@ -71,33 +72,32 @@ async def track_user_visit(
     try:
         logger.info(f"User visit tracked: {request.username} ({request.user_id})")
         
-        # Get or create user
-        result = await db.execute(select(User).where(User.user_id == request.user_id))
-        user = result.scalar_one_or_none()
-        
-        if not user:
-            # Create new user with server-generated username
-            server_username = generate_username(request.user_id)
-            user = User(
-                user_id=request.user_id,
-                username=server_username,
-                emoji=request.emoji
-            )
-            db.add(user)
-            logger.info(f"Created new user: {request.username}")
-        else:
-            # Update existing user: do not overwrite username; update emoji/online/last_seen
-            user.emoji = request.emoji
-            user.last_seen = datetime.utcnow()
-            user.is_online = True
-            logger.debug(f"Updated user: {request.username}")
-        
+        # Create the user (server-generated username) or refresh emoji/online/last_seen,
+        # in one statement; the username of an existing user is never overwritten
+        now = datetime.utcnow()
+        stmt = sqlite_insert(User).values(
+            user_id=request.user_id,
+            username=generate_username(request.user_id),
+            emoji=request.emoji,
+            created_at=now,
+            last_seen=now,
+            is_online=True
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[User.user_id],
+            set_={
+                'emoji': stmt.excluded.emoji,
+                'last_seen': stmt.excluded.last_seen,
+                'is_online': True
+            }
+        ).returning(User.username)
+        username = (await db.execute(stmt)).scalar_one()
         await db.commit()
         logger.debug(f"User {request.username} added/updated in database")
         
         return UserVisitResponse(
             success=True,
-            message=f"User {user.username} visit tracked successfully"
+            message=f"User {username} visit tracked successfully"
         )
         
     except Exception as e:
@@ -0,0 +1,210 @@
+"""
+Full-text search over chat history for FastAPI MindWeb Application
+SQLite FTS5 index mirroring Message.content, kept in sync on insert
+
+CJK text has no spaces between words, so the unicode61 tokenizer would treat a
+whole sentence as one token. Before indexing, every CJK character is followed
+by an invisible separator so each character becomes a token; a query term is
+segmented the same way and matched as a phrase, which gives substring matching
+for Chinese and ordinary word matching for everything else.
+
+Backfill existing databases with:
+    python -m app.search backfill [--batch-size 500]
+"""
+
+import argparse
+import asyncio
+import html
+import re
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import event, select, text, literal_column, table, column
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database import Message, engine, AsyncSessionLocal
+from app.utils.logger import setup_logger
+
+logger = setup_logger("Search")
+
+FTS_TABLE = "messages_fts"
+# Zero-width space: declared as a tokenizer separator and stripped from snippets
+_SEP = "\u200b"
+_CJK = re.compile('([\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af])')
+# Snippet match markers; control characters pass through html.escape untouched
+_MARK_OPEN = "\x02"
+_MARK_CLOSE = "\x03"
+
+# Set by init_search(); inserts are only mirrored once the index exists
+fts_available = False
+
+_fts = table(FTS_TABLE, column('rowid'))
+
+
+def segment_text(value: str) -> str:
+    """Split CJK runs into single-character tokens for the FTS index"""
+    return _CJK.sub(r'\1' + _SEP, value or '')
+
+
+def build_match_query(query: str) -> str:
+    """Turn user input into a safe FTS5 MATCH expression (all terms, phrase-quoted)"""
+    terms = []
+    for term in query.split():
+        segmented = segment_text(term).strip(_SEP)
+        if segmented:
+            terms.append('"' + segmented.replace('"', '""') + '"')
+    return ' '.join(terms)
+
+
+def render_snippet(raw: str) -> str:
+    """Escape snippet text and turn match markers into <mark> tags"""
+    escaped = html.escape(raw.replace(_SEP, ''))
+    return escaped.replace(_MARK_OPEN, '<mark>').replace(_MARK_CLOSE, '</mark>')
+
+
+async def init_search() -> bool:
+    """Create the FTS5 table if the SQLite build supports it"""
+    global fts_available
+    try:
+        async with engine.begin() as conn:
+            await conn.execute(text(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+                f"content, tokenize=\"unicode61 remove_diacritics 2 separators '{_SEP}'\")"
+            ))
+        fts_available = True
+    except Exception as e:
+        fts_available = False
+        logger.warning(f"Full-text search disabled (FTS5 unavailable): {e}")
+    return fts_available
+
+
+@event.listens_for(Message, "after_insert")
+def _index_inserted_message(mapper, connection, target):
+    """Mirror new messages into the FTS index inside the same transaction"""
+    if not fts_available:
+        return
+    connection.execute(
+        text(f"INSERT OR REPLACE INTO {FTS_TABLE}(rowid, content) VALUES (:id, :content)"),
+        {'id': target.id, 'content': segment_text(target.content)}
+    )
+
+
+@event.listens_for(Message, "after_delete")
+def _unindex_deleted_message(mapper, connection, target):
+    if not fts_available:
+        return
+    connection.execute(text(f"DELETE FROM {FTS_TABLE} WHERE rowid = :id"), {'id': target.id})
+
+
+async def unindex_messages(db: AsyncSession, ids: List[int]):
+    """Drop rows from the index; for bulk deletes that bypass ORM events"""
+    if not fts_available or not ids:
+        return
+    await db.execute(text(f"DELETE FROM {FTS_TABLE} WHERE rowid = :id"), [{'id': i} for i in ids])
+
+
+async def search_messages(
+    db: AsyncSession,
+    query: str,
+    user_id: Optional[str] = None,
+    conversation_id: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    limit: int = 20,
+    offset: int = 0
+) -> List[Dict[str, Any]]:
+    """Ranked search (best match first) with highlighted snippets"""
+    match = build_match_query(query)
+    if not match:
+        return []
+
+    rank = literal_column(f"bm25({FTS_TABLE})")
+    snippet = literal_column(
+        f"snippet({FTS_TABLE}, 0, char(2), char(3), '…', 24)"
+    )
+    stmt = (
+        select(
+            Message.message_id,
+            Message.message_type,
+            Message.user_id,
+            Message.conversation_id,
+            Message.created_at,
+            snippet.label('snippet'),
+            rank.label('rank'),
+        )
+        .select_from(_fts)
+        .join(Message, Message.id == _fts.c.rowid)
+        .where(text(f"{FTS_TABLE} MATCH :match"))
+    )
+    if user_id:
+        stmt = stmt.where(Message.user_id == user_id)
+    if conversation_id:
+        stmt = stmt.where(Message.conversation_id == conversation_id)
+    if start:
+        stmt = stmt.where(Message.created_at >= start)
+    if end:
+        stmt = stmt.where(Message.created_at < end)
+    stmt = stmt.order_by(rank).limit(limit).offset(offset)
+
+    result = await db.execute(stmt, {'match': match})
+    return [
+        {
+            'message_id': row.message_id,
+            'message_type': row.message_type,
+            'user_id': row.user_id,
+            'conversation_id': row.conversation_id,
+            'created_at': row.created_at.isoformat() if row.created_at else None,
+            'snippet': render_snippet(row.snippet or ''),
+            'rank': row.rank,
+        }
+        for row in result
+    ]
+
+
+async def backfill(batch_size: int = 500, pause: float = 0.05) -> int:
+    """Index existing messages in small id-ordered batches.
+    Each batch is its own short transaction so the live server keeps writing."""
+    if not await init_search():
+        return 0
+    last_id = 0
+    indexed = 0
+    while True:
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                select(Message.id, Message.content)
+                .where(Message.id > last_id)
+                .order_by(Message.id)
+                .limit(batch_size)
+            )
+            rows = result.all()
+            if not rows:
+                break
+            await db.execute(
+                text(f"INSERT OR REPLACE INTO {FTS_TABLE}(rowid, content) VALUES (:id, :content)"),
+                [{'id': row.id, 'content': segment_text(row.content)} for row in rows]
+            )
+            await db.commit()
+        last_id = rows[-1].id
+        indexed += len(rows)
+        logger.info(f"Indexed {indexed} messages (up to id {last_id})")
+        # Yield the database to live writers between batches
+        await asyncio.sleep(pause)
+    return indexed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MindWeb full-text search index")
+    sub = parser.add_subparsers(dest='command', required=True)
+    backfill_parser = sub.add_parser('backfill', help='Index existing messages')
+    backfill_parser.add_argument('--batch-size', type=int, default=500)
+    backfill_parser.add_argument('--pause', type=float, default=0.05,
+                                 help='Seconds to sleep between batches')
+    args = parser.parse_args()
+
+    if args.command == 'backfill':
+        total = asyncio.run(backfill(args.batch_size, args.pause))
+        print(f"Indexed {total} messages")
+
+
+if __name__ == "__main__":
+    main()
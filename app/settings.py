@@ -0,0 +1,295 @@
+"""
+Typed application settings for FastAPI MindWeb Application
+Read from the environment (and .env) once, cached, and shared through
+app.state.settings; reloaded only on an explicit trigger (SIGHUP or
+POST /api/admin/settings/reload)
+
+Only RELOADABLE fields take effect on reload. The rest are used to build
+long-lived objects at startup (the Dify client, the server socket) and
+need a restart; reload reports them instead of applying them.
+"""
+
+import hashlib
+import json
+import os
+from dataclasses import dataclass, fields, replace
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Tuple
+
+from dotenv import dotenv_values
+
+from app.utils.logger import setup_logger, configure_logging
+
+logger = setup_logger("Settings")
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None or value == '':
+        return default
+    return value.strip().lower() not in ('false', '0', 'no', 'off')
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name) or default)
+    except ValueError:
+        logger.warning(f"Ignoring invalid {name}={os.getenv(name)!r}")
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name) or default)
+    except ValueError:
+        logger.warning(f"Ignoring invalid {name}={os.getenv(name)!r}")
+        return default
+
+
+@dataclass(frozen=True)
+class Settings:
+    # Dify upstream
+    dify_api_key: Optional[str] = None
+    dify_api_url: str = "http://dify.mindspringedu.com/v1"
+    # Several replicas as url|key,url|key (overrides the two above when set)
+    dify_backends: str = ""
+    dify_routing: str = "least_loaded"
+
+    # Frontend config served by /api/chat/config
+    web_url: str = "http://localhost:9530"
+    ai_name: str = "MindMate"
+    ai_placeholder: str = "Ask MindMate AI anything..."
+    ai_placeholder_zh: str = "问问 MindMate AI 吧…"
+
+    # Server
+    port: int = 9530
+    ws_per_message_deflate: bool = True
+    admin_token: Optional[str] = None
+    log_level: str = "INFO"
+
+    # Broadcast connection governance
+    sse_max_connections: int = 1000
+    sse_max_per_user: int = 5
+    # Off by default: a whole school often shares one NAT address
+    sse_max_per_ip: int = 0
+    sse_stale_seconds: float = 90.0
+    # Idle SSE listeners get a keepalive ping this often (keep below sse_stale_seconds)
+    sse_heartbeat_seconds: float = 30.0
+    sse_retry_ms: int = 3000
+    sse_retry_jitter_ms: int = 2000
+    # Queued events are written to a listener as one chunk up to this size (0: one event per write)
+    sse_batch_max_bytes: int = 65536
+    # Optional wait for more events before writing (adds up to this much latency)
+    sse_batch_window_ms: float = 10.0
+
+    # Deadlines for one upstream AI answer, in seconds (0 disables)
+    stream_first_byte_seconds: float = 60.0
+    stream_idle_seconds: float = 60.0
+    stream_max_seconds: float = 600.0
+
+    # Durable broadcast event journal (replay across restarts)
+    journal_enabled: bool = False
+    journal_dir: str = "./journal"
+    journal_fsync_seconds: float = 1.0
+    journal_segment_bytes: int = 16 * 1024 * 1024
+    journal_segment_seconds: float = 3600.0
+    journal_retention_hours: float = 24.0
+
+    # Server-side markdown rendering (needs markdown-it-py and nh3)
+    render_markdown: bool = True
+
+    # Transparent compression of large message content
+    compress_content: bool = False
+    compress_min_bytes: int = 1024
+    compress_level: int = 6
+
+    # Idempotency keys
+    idempotency_ttl_seconds: float = 600.0
+    idempotency_max_keys: int = 10000
+
+    # Usage analytics rollups
+    analytics_enabled: bool = True
+    analytics_minute_retention_hours: int = 48
+
+    # Retention
+    retention_enabled: bool = False
+    retention_interval_hours: float = 24.0
+    retention_default_days: int = 0
+    retention_policies: str = ""
+    retention_archive_dir: str = "./archive"
+    retention_batch_size: int = 500
+
+    @classmethod
+    def from_env(cls) -> "Settings":
+        d = cls()
+        return cls(
+            dify_api_key=os.getenv("DIFY_API_KEY") or None,
+            dify_api_url=os.getenv("DIFY_API_URL", d.dify_api_url),
+            dify_backends=os.getenv("DIFY_BACKENDS", d.dify_backends),
+            dify_routing=(os.getenv("DIFY_ROUTING") or d.dify_routing).lower(),
+            web_url=os.getenv("WEB_URL", d.web_url),
+            ai_name=os.getenv("AI_NAME", d.ai_name),
+            ai_placeholder=os.getenv("AI_PLACEHOLDER", d.ai_placeholder),
+            ai_placeholder_zh=os.getenv("AI_PLACEHOLDER_ZH", d.ai_placeholder_zh),
+            port=_env_int("PORT", d.port),
+            ws_per_message_deflate=_env_bool("WS_PER_MESSAGE_DEFLATE", d.ws_per_message_deflate),
+            admin_token=os.getenv("ADMIN_TOKEN") or None,
+            log_level=(os.getenv("LOG_LEVEL") or d.log_level).upper(),
+            sse_max_connections=_env_int("SSE_MAX_CONNECTIONS", d.sse_max_connections),
+            sse_max_per_user=_env_int("SSE_MAX_PER_USER", d.sse_max_per_user),
+            sse_max_per_ip=_env_int("SSE_MAX_PER_IP", d.sse_max_per_ip),
+            sse_stale_seconds=_env_float("SSE_STALE_SECONDS", d.sse_stale_seconds),
+            sse_heartbeat_seconds=_env_float("SSE_HEARTBEAT_SECONDS", d.sse_heartbeat_seconds),
+            sse_retry_ms=_env_int("SSE_RETRY_MS", d.sse_retry_ms),
+            sse_retry_jitter_ms=_env_int("SSE_RETRY_JITTER_MS", d.sse_retry_jitter_ms),
+            sse_batch_max_bytes=_env_int("SSE_BATCH_MAX_BYTES", d.sse_batch_max_bytes),
+            sse_batch_window_ms=_env_float("SSE_BATCH_WINDOW_MS", d.sse_batch_window_ms),
+            stream_first_byte_seconds=_env_float("STREAM_FIRST_BYTE_SECONDS", d.stream_first_byte_seconds),
+            stream_idle_seconds=_env_float("STREAM_IDLE_SECONDS", d.stream_idle_seconds),
+            stream_max_seconds=_env_float("STREAM_MAX_SECONDS", d.stream_max_seconds),
+            journal_enabled=_env_bool("JOURNAL_ENABLED", d.journal_enabled),
+            journal_dir=os.getenv("JOURNAL_DIR", d.journal_dir),
+            journal_fsync_seconds=_env_float("JOURNAL_FSYNC_SECONDS", d.journal_fsync_seconds),
+            journal_segment_bytes=_env_int("JOURNAL_SEGMENT_BYTES", d.journal_segment_bytes),
+            journal_segment_seconds=_env_float("JOURNAL_SEGMENT_SECONDS", d.journal_segment_seconds),
+            journal_retention_hours=_env_float("JOURNAL_RETENTION_HOURS", d.journal_retention_hours),
+            render_markdown=_env_bool("RENDER_MARKDOWN", d.render_markdown),
+            compress_content=_env_bool("COMPRESS_CONTENT", d.compress_content),
+            compress_min_bytes=_env_int("COMPRESS_MIN_BYTES", d.compress_min_bytes),
+            compress_level=min(9, max(1, _env_int("COMPRESS_LEVEL", d.compress_level))),
+            idempotency_ttl_seconds=_env_float("IDEMPOTENCY_TTL_SECONDS", d.idempotency_ttl_seconds),
+            idempotency_max_keys=_env_int("IDEMPOTENCY_MAX_KEYS", d.idempotency_max_keys),
+            analytics_enabled=_env_bool("ANALYTICS_ENABLED", d.analytics_enabled),
+            analytics_minute_retention_hours=_env_int("ANALYTICS_MINUTE_RETENTION_HOURS",
+                                                      d.analytics_minute_retention_hours),
+            retention_enabled=_env_bool("RETENTION_ENABLED", d.retention_enabled),
+            retention_interval_hours=_env_float("RETENTION_INTERVAL_HOURS", d.retention_interval_hours),
+            retention_default_days=_env_int("RETENTION_DEFAULT_DAYS", d.retention_default_days),
+            retention_policies=os.getenv("RETENTION_POLICIES", d.retention_policies),
+            retention_archive_dir=os.getenv("RETENTION_ARCHIVE_DIR", d.retention_archive_dir),
+            retention_batch_size=_env_int("RETENTION_BATCH_SIZE", d.retention_batch_size),
+        )
+
+
+# Fields that can change without a restart
+RELOADABLE = frozenset({
+    'web_url', 'ai_name', 'ai_placeholder', 'ai_placeholder_zh',
+    'admin_token', 'log_level',
+    'sse_max_connections', 'sse_max_per_user', 'sse_max_per_ip',
+    'sse_stale_seconds', 'sse_heartbeat_seconds', 'sse_retry_ms', 'sse_retry_jitter_ms',
+    'sse_batch_max_bytes', 'sse_batch_window_ms',
+    'stream_first_byte_seconds', 'stream_idle_seconds', 'stream_max_seconds',
+    'journal_fsync_seconds', 'journal_segment_bytes', 'journal_segment_seconds', 'journal_retention_hours',
+    'render_markdown', 'compress_content', 'compress_min_bytes', 'compress_level',
+    'idempotency_ttl_seconds', 'idempotency_max_keys',
+    'analytics_enabled', 'analytics_minute_retention_hours',
+    'retention_default_days', 'retention_policies',
+    'retention_archive_dir', 'retention_batch_size',
+})
+
+_settings: Optional[Settings] = None
+_reload_hooks: List[Callable[[Settings], None]] = []
+
+
+# Variables whose current value came from .env, so a reload may change or drop them
+_dotenv_owned: Dict[str, str] = {}
+_dotenv_read = False
+
+
+def _apply_dotenv():
+    """Merge .env into os.environ with startup precedence: real environment > .env > defaults.
+    Variables set by the real environment (systemd, Docker) are never overwritten, and
+    variables that came from .env are dropped again once removed from the file."""
+    global _dotenv_read
+    values = {k: v for k, v in dotenv_values().items() if v is not None}
+    for key, value in list(_dotenv_owned.items()):
+        if key not in values:
+            if os.environ.get(key) == value:
+                del os.environ[key]
+            del _dotenv_owned[key]
+    for key, value in values.items():
+        current = os.environ.get(key)
+        # main.py loads .env before this module is imported: on the first read a
+        # variable equal to its .env value is taken to have come from the file
+        if current is None or _dotenv_owned.get(key) == current or (not _dotenv_read and current == value):
+            os.environ[key] = value
+            _dotenv_owned[key] = value
+    _dotenv_read = True
+
+
+def get_settings() -> Settings:
+    """Settings for code outside a request (loaded on first use)"""
+    global _settings
+    if _settings is None:
+        _apply_dotenv()
+        _settings = Settings.from_env()
+    return _settings
+
+
+def app_settings(app) -> Settings:
+    """Settings injected at startup into app.state (falls back to the module cache)"""
+    return getattr(app.state, 'settings', None) or get_settings()
+
+
+def on_reload(hook: Callable[[Settings], None]):
+    """Register a callback that applies reloaded settings to a long-lived object"""
+    _reload_hooks.append(hook)
+
+
+def reload_settings() -> Tuple[Settings, List[str], List[str]]:
+    """Re-read .env and the environment. Returns (settings, applied, restart_required)."""
+    global _settings
+    current = get_settings()
+    _apply_dotenv()
+    fresh = Settings.from_env()
+
+    applied, restart_required, updates = [], [], {}
+    for f in fields(Settings):
+        old, new = getattr(current, f.name), getattr(fresh, f.name)
+        if old == new:
+            continue
+        if f.name in RELOADABLE:
+            updates[f.name] = new
+            applied.append(f.name)
+        else:
+            restart_required.append(f.name)
+
+    _settings = replace(current, **updates)
+    if 'log_level' in updates:
+        # The logger module reads LOG_LEVEL directly; keep it in step
+        os.environ['LOG_LEVEL'] = _settings.log_level
+        configure_logging()
+    for hook in _reload_hooks:
+        try:
+            hook(_settings)
+        except Exception as e:
+            logger.error(f"Settings reload hook failed: {e}")
+    if applied or restart_required:
+        logger.info(f"Settings reloaded: applied={applied} restart_required={restart_required}")
+    return _settings, applied, restart_required
+
+
+@lru_cache(maxsize=8)
+def chat_config_body(settings: Settings) -> Tuple[bytes, str]:
+    """Pre-rendered /api/chat/config response and its ETag"""
+    body = json.dumps({
+        'web_url': settings.web_url,
+        'ai_name': settings.ai_name,
+        'ai_placeholder': settings.ai_placeholder,
+        'ai_placeholder_zh': settings.ai_placeholder_zh,
+    }, ensure_ascii=False).encode('utf-8')
+    return body, '"' + hashlib.sha1(body).hexdigest()[:16] + '"'
+
+
+def redacted(settings: Settings) -> Dict[str, object]:
+    """Settings as a dict with secrets masked, for the admin API"""
+    data = {f.name: getattr(settings, f.name) for f in fields(Settings)}
+    for secret in ('dify_api_key', 'admin_token'):
+        if data[secret]:
+            data[secret] = '***'
+    if data['dify_backends']:
+        # Keep the URLs, mask the keys
+        data['dify_backends'] = ','.join(
+            spec.partition('|')[0] + '|***' for spec in data['dify_backends'].split(',') if spec.strip()
+        )
+    return data
@@ -0,0 +1,179 @@
+"""
+Message storage maintenance for FastAPI MindWeb Application
+Compresses (or restores) message content already in the database and reports
+how much space compression saves. New messages are compressed on write when
+COMPRESS_CONTENT is on (see app/utils/compression.py).
+
+Command line:
+    python -m app.storage compress [--min-bytes 1024] [--level 6] [--batch-size 200]
+    python -m app.storage decompress
+    python -m app.storage stats [--exact]
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from typing import Any, Dict, Optional
+
+from sqlalchemy import select, update, func, case, cast, LargeBinary, text
+
+from app.database import Message, AsyncSessionLocal, incremental_vacuum
+from app.settings import get_settings
+from app.utils.compression import compress_text, decompress_text, compression_stats
+from app.utils.logger import setup_logger
+
+logger = setup_logger("Storage")
+
+_COLUMNS = ('content', 'content_html')
+
+
+def _stored_bytes(column):
+    return func.coalesce(func.sum(func.length(cast(column, LargeBinary))), 0)
+
+
+def _is_blob(column):
+    return func.typeof(column) == 'blob'
+
+
+async def storage_stats(exact: bool = False, batch_size: int = 500) -> Dict[str, Any]:
+    """Row and byte counts per column, split by stored form.
+    With exact=True compressed values are decompressed to count their original size."""
+    stats: Dict[str, Any] = {}
+    async with AsyncSessionLocal() as db:
+        for name in _COLUMNS:
+            column = getattr(Message, name)
+            row = (await db.execute(select(
+                func.count(column).label('rows'),
+                func.coalesce(func.sum(case((_is_blob(column), 1), else_=0)), 0).label('compressed_rows'),
+                _stored_bytes(column).label('stored_bytes'),
+                func.coalesce(func.sum(case((_is_blob(column), func.length(column)), else_=0)), 0)
+                .label('compressed_stored_bytes'),
+            ))).one()
+            stats[name] = dict(row._asdict())
+
+        if exact:
+            for name in _COLUMNS:
+                stats[name]['compressed_raw_bytes'] = await _raw_bytes_of_compressed(db, name, batch_size)
+                stats[name]['bytes_saved'] = (stats[name]['compressed_raw_bytes']
+                                              - stats[name]['compressed_stored_bytes'])
+    stats['process'] = compression_stats.to_dict()
+    return stats
+
+
+async def _raw_bytes_of_compressed(db, name: str, batch_size: int) -> int:
+    # Read the stored form untyped so each value is decompressed exactly once here
+    raw_column = cast(getattr(Message, name), LargeBinary)
+    last_id, total = 0, 0
+    while True:
+        rows = (await db.execute(
+            select(Message.id, raw_column)
+            .where(Message.id > last_id, _is_blob(getattr(Message, name)))
+            .order_by(Message.id).limit(batch_size)
+        )).all()
+        if not rows:
+            return total
+        for _, stored in rows:
+            total += len(decompress_text(stored).encode('utf-8'))
+        last_id = rows[-1][0]
+
+
+async def recompress(
+    compress: bool = True,
+    min_bytes: Optional[int] = None,
+    level: Optional[int] = None,
+    batch_size: int = 200,
+    pause: float = 0.05
+) -> Dict[str, Any]:
+    """Rewrite existing rows in small id-ordered batches, each its own transaction,
+    so the live server keeps writing. compress=False restores plain text."""
+    settings = get_settings()
+    min_bytes = settings.compress_min_bytes if min_bytes is None else min_bytes
+    level = settings.compress_level if level is None else level
+    compression_stats.reset()
+    started = time.perf_counter()
+    last_id, scanned, rewritten = 0, 0, 0
+
+    while True:
+        async with AsyncSessionLocal() as db:
+            if compress:
+                # Only plain values big enough to be worth compressing
+                condition = (func.typeof(Message.content) == 'text') & \
+                    (func.length(cast(Message.content, LargeBinary)) >= min_bytes)
+                condition |= (func.typeof(Message.content_html) == 'text') & \
+                    (func.length(cast(Message.content_html, LargeBinary)) >= min_bytes)
+            else:
+                condition = _is_blob(Message.content) | _is_blob(Message.content_html)
+            rows = (await db.execute(
+                select(Message.id, Message.content, Message.content_html)
+                .where(Message.id > last_id, condition)
+                .order_by(Message.id).limit(batch_size)
+            )).all()
+            if not rows:
+                break
+            for row in rows:
+                values = {}
+                for name in _COLUMNS:
+                    value = getattr(row, name)
+                    if value is None:
+                        continue
+                    # bytes pass through the column type untouched; str is stored as plain text
+                    values[name] = compress_text(value, min_bytes, level) if compress else value
+                if compress and not any(isinstance(v, bytes) for v in values.values()):
+                    continue
+                if not compress:
+                    # Untyped binds bypass COMPRESS_CONTENT, so the text really is stored plain
+                    await db.execute(
+                        text("UPDATE messages SET " + ', '.join(f"{k} = :{k}" for k in values) + " WHERE id = :id"),
+                        {'id': row.id, **values}
+                    )
+                else:
+                    await db.execute(update(Message).where(Message.id == row.id).values(**values))
+                rewritten += 1
+            await db.commit()
+        scanned += len(rows)
+        last_id = rows[-1].id
+        logger.info(f"{'Compressed' if compress else 'Decompressed'} {rewritten}/{scanned} messages (up to id {last_id})")
+        await asyncio.sleep(pause)
+
+    if rewritten:
+        # Hand freed pages back to the OS (a no-op unless auto_vacuum is incremental)
+        await incremental_vacuum()
+    return {
+        'scanned': scanned,
+        'rewritten': rewritten,
+        'seconds': round(time.perf_counter() - started, 2),
+        **compression_stats.to_dict(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MindWeb message storage maintenance")
+    sub = parser.add_subparsers(dest='command', required=True)
+    compress_parser = sub.add_parser('compress', help='Compress existing large messages')
+    compress_parser.add_argument('--min-bytes', type=int, default=None,
+                                 help='Smallest value to compress (default: COMPRESS_MIN_BYTES)')
+    compress_parser.add_argument('--level', type=int, choices=range(1, 10), default=None,
+                                 help='zlib level (default: COMPRESS_LEVEL)')
+    compress_parser.add_argument('--batch-size', type=int, default=200)
+    compress_parser.add_argument('--pause', type=float, default=0.05,
+                                 help='Seconds to sleep between batches')
+    decompress_parser = sub.add_parser('decompress', help='Store all messages as plain text again')
+    decompress_parser.add_argument('--batch-size', type=int, default=200)
+    decompress_parser.add_argument('--pause', type=float, default=0.05)
+    stats_parser = sub.add_parser('stats', help='Report stored sizes')
+    stats_parser.add_argument('--exact', action='store_true',
+                              help='Decompress compressed rows to count their original size')
+    args = parser.parse_args()
+
+    if args.command == 'compress':
+        result = asyncio.run(recompress(True, args.min_bytes, args.level, args.batch_size, args.pause))
+    elif args.command == 'decompress':
+        result = asyncio.run(recompress(False, batch_size=args.batch_size, pause=args.pause))
+    else:
+        result = asyncio.run(storage_stats(exact=args.exact))
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
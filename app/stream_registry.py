@@ -0,0 +1,199 @@
+"""
+Registry of in-flight AI generations for FastAPI MindWeb Application
+Lets a user or moderator cancel a stream, and cancels everything on shutdown
+
+A watchdog also cancels streams that break their deadlines (0 disables one):
+
+    STREAM_FIRST_BYTE_SECONDS=60   # nothing received from Dify yet
+    STREAM_IDLE_SECONDS=60         # no chunk since the previous one
+    STREAM_MAX_SECONDS=600         # whole answer
+(read through app.settings; reloadable)
+"""
+
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from app.settings import get_settings
+from app.utils.logger import setup_logger
+
+logger = setup_logger("StreamRegistry")
+
+# Cancel reasons used by the watchdog, one per deadline
+TIMEOUT_REASONS = {
+    'first_byte': 'first_byte_timeout',
+    'idle': 'idle_timeout',
+    'duration': 'duration_timeout',
+}
+
+
+class ActiveStream:
+    """One AI generation: the task consuming the upstream stream plus what is needed to stop it"""
+
+    def __init__(self, stream_id: str, user_id: str, room: str, task: asyncio.Task,
+                 stop_upstream: Optional[Callable[[str], Awaitable[bool]]] = None,
+                 cancel_token: Optional[str] = None):
+        self.stream_id = stream_id
+        self.user_id = user_id
+        self.room = room
+        self.task = task
+        self.stop_upstream = stop_upstream
+        # Secret the asker must present to cancel (not in to_dict: the admin listing must not leak it)
+        self.cancel_token = cancel_token
+        self.upstream_task_id: Optional[str] = None
+        self.cancel_reason: Optional[str] = None
+        self.started_at = time.time()
+        self.started_monotonic = time.monotonic()
+        self.first_chunk_at: Optional[float] = None
+        self.last_chunk_at: Optional[float] = None
+        self.finished = asyncio.Event()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_reason is not None
+
+    @property
+    def timed_out(self) -> bool:
+        return self.cancel_reason in TIMEOUT_REASONS.values()
+
+    def touch(self):
+        """Record an upstream chunk (monotonic clock)"""
+        now = time.monotonic()
+        if self.first_chunk_at is None:
+            self.first_chunk_at = now
+        self.last_chunk_at = now
+
+    def violated_deadline(self, now: float, first_byte: float, idle: float, max_duration: float) -> Optional[str]:
+        """Which deadline this stream has broken, if any (limits in seconds, 0 = off)"""
+        if max_duration and now - self.started_monotonic > max_duration:
+            return 'duration'
+        if self.last_chunk_at is None:
+            if first_byte and now - self.started_monotonic > first_byte:
+                return 'first_byte'
+        elif idle and now - self.last_chunk_at > idle:
+            return 'idle'
+        return None
+
+    def to_dict(self) -> dict:
+        return {
+            'stream_id': self.stream_id,
+            'user_id': self.user_id,
+            'room': self.room,
+            'upstream_task_id': self.upstream_task_id,
+            'age_ms': int((time.time() - self.started_at) * 1000),
+            'idle_ms': int((time.monotonic() - self.last_chunk_at) * 1000) if self.last_chunk_at else None,
+            'cancel_reason': self.cancel_reason,
+        }
+
+
+class StreamRegistry:
+    """Active streams keyed by stream_id"""
+
+    def __init__(self):
+        self.streams: Dict[str, ActiveStream] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # Deadline violations since startup, by kind
+        self.timeouts: Dict[str, int] = dict.fromkeys(TIMEOUT_REASONS, 0)
+
+    def bind_loop(self, loop: asyncio.AbstractEventLoop):
+        """Remember the serving loop so signal handlers can schedule shutdown cancellation"""
+        self._loop = loop
+
+    def register(self, stream: ActiveStream):
+        self.streams[stream.stream_id] = stream
+
+    def unregister(self, stream_id: str):
+        stream = self.streams.pop(stream_id, None)
+        if stream:
+            stream.finished.set()
+
+    def get(self, stream_id: str) -> Optional[ActiveStream]:
+        return self.streams.get(stream_id)
+
+    async def cancel(self, stream_id: str, reason: str) -> bool:
+        """Close the upstream HTTP stream and ask Dify to stop generating.
+        The owning request persists the partial answer and broadcasts the cancellation."""
+        stream = self.streams.get(stream_id)
+        if stream is None or stream.cancelled:
+            return False
+        stream.cancel_reason = reason
+        stream.task.cancel()
+        if stream.upstream_task_id and stream.stop_upstream:
+            try:
+                await stream.stop_upstream(stream.upstream_task_id)
+            except Exception as e:
+                logger.warning(f"Upstream stop failed for {stream_id}: {e}")
+        logger.info(f"Stream {stream_id[:8]} cancelled ({reason})")
+        return True
+
+    async def cancel_all(self, reason: str = 'shutdown', timeout: float = 3.0) -> int:
+        """Cancel every active stream and wait (bounded) for their partial answers to be saved"""
+        streams = list(self.streams.values())
+        if not streams:
+            return 0
+        await asyncio.gather(*(self.cancel(s.stream_id, reason) for s in streams), return_exceptions=True)
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(s.finished.wait() for s in streams)),
+                timeout=timeout
+            )
+        except asyncio.TimeoutError:
+            logger.warning(f"{len(self.streams)} streams still finishing after {timeout}s")
+        return len(streams)
+
+    def expired(self, now: Optional[float] = None) -> List[Tuple[ActiveStream, str]]:
+        """(stream, deadline kind) for every live stream past one of its deadlines"""
+        settings = get_settings()
+        now = time.monotonic() if now is None else now
+        expired = []
+        for stream in list(self.streams.values()):
+            if stream.cancelled:
+                continue
+            kind = stream.violated_deadline(now, settings.stream_first_byte_seconds,
+                                            settings.stream_idle_seconds, settings.stream_max_seconds)
+            if kind:
+                expired.append((stream, kind))
+        return expired
+
+    async def enforce_deadlines(self) -> int:
+        """Cancel streams past a deadline; the owning request saves the partial answer
+        and broadcasts ai_message_timeout"""
+        cancelled = 0
+        for stream, kind in self.expired():
+            if await self.cancel(stream.stream_id, TIMEOUT_REASONS[kind]):
+                self.timeouts[kind] += 1
+                cancelled += 1
+                logger.warning(f"Stream {stream.stream_id[:8]} broke its {kind} deadline")
+        return cancelled
+
+    async def watchdog_loop(self, interval: float = 1.0):
+        """Background task: enforce stream deadlines until cancelled"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.enforce_deadlines()
+            except Exception as e:
+                logger.error(f"Stream watchdog failed: {e}")
+
+    def stats(self) -> dict:
+        settings = get_settings()
+        return {
+            'active': len(self.streams),
+            'timeouts': dict(self.timeouts),
+            'deadlines': {
+                'first_byte_seconds': settings.stream_first_byte_seconds,
+                'idle_seconds': settings.stream_idle_seconds,
+                'max_seconds': settings.stream_max_seconds,
+            },
+        }
+
+    def request_shutdown(self, timeout: float = 3.0):
+        """Thread/signal-safe: schedule cancel_all on the serving loop"""
+        if self._loop is None or self._loop.is_closed():
+            return
+        self._loop.call_soon_threadsafe(
+            lambda: asyncio.ensure_future(self.cancel_all('shutdown', timeout))
+        )
+
+
+# Global stream registry instance
+stream_registry = StreamRegistry()
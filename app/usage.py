@@ -0,0 +1,155 @@
+"""
+Token usage and latency accounting for FastAPI MindWeb Application
+Each AI message stores its Dify usage and timings in message_metadata:
+
+    {"room": "...", "usage": {"prompt_tokens": 12, "completion_tokens": 80,
+     "total_tokens": 92, "total_price": 0.0004, "currency": "USD", "latency": 2.1},
+     "ttft_ms": 640.2, "duration_ms": 2310.5, "chunk_count": 57,
+     "upstream": {"task_id": "...", "message_id": "...", "conversation_id": "..."},
+     "prompt_message_id": "..."}
+
+The aggregations below read those fields with SQLite's json_extract.
+"""
+
+import json
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import select, func, desc
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database import Message
+
+_USAGE_INT_FIELDS = ('prompt_tokens', 'completion_tokens', 'total_tokens')
+_USAGE_FLOAT_FIELDS = ('total_price', 'latency')
+
+
+def normalize_usage(raw: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Keep the usage fields we aggregate, as numbers (Dify sends prices as strings)"""
+    usage: Dict[str, Any] = {}
+    for key in _USAGE_INT_FIELDS:
+        try:
+            usage[key] = int(raw.get(key) or 0)
+        except (AttributeError, TypeError, ValueError):
+            usage[key] = 0
+    for key in _USAGE_FLOAT_FIELDS:
+        try:
+            usage[key] = float(raw.get(key) or 0)
+        except (AttributeError, TypeError, ValueError):
+            usage[key] = 0.0
+    usage['currency'] = (raw or {}).get('currency')
+    return usage
+
+
+def _load_metadata(raw: Optional[str]) -> Dict[str, Any]:
+    try:
+        return json.loads(raw) if raw else {}
+    except ValueError:
+        return {}
+
+
+def _field(path: str):
+    return func.json_extract(Message.message_metadata, path)
+
+
+def _aggregate_columns():
+    return (
+        func.count(Message.id).label('messages'),
+        func.coalesce(func.sum(_field('$.usage.prompt_tokens')), 0).label('prompt_tokens'),
+        func.coalesce(func.sum(_field('$.usage.completion_tokens')), 0).label('completion_tokens'),
+        func.coalesce(func.sum(_field('$.usage.total_tokens')), 0).label('total_tokens'),
+        func.coalesce(func.sum(_field('$.usage.total_price')), 0).label('total_price'),
+        func.avg(_field('$.ttft_ms')).label('avg_ttft_ms'),
+        func.avg(_field('$.duration_ms')).label('avg_duration_ms'),
+        func.max(_field('$.duration_ms')).label('max_duration_ms'),
+        func.coalesce(func.sum(_field('$.duration_ms')), 0).label('_duration'),
+    )
+
+
+def _ai_messages(query, start: Optional[datetime], end: Optional[datetime]):
+    query = query.where(Message.message_type == 'ai')
+    if start:
+        query = query.where(Message.created_at >= start)
+    if end:
+        query = query.where(Message.created_at < end)
+    return query
+
+
+def _row_to_dict(row, key: str) -> Dict[str, Any]:
+    data = row._asdict()
+    completion = data['completion_tokens'] or 0
+    duration_ms = data.pop('_duration') or 0
+    for name in ('avg_ttft_ms', 'avg_duration_ms', 'max_duration_ms'):
+        if data[name] is not None:
+            data[name] = round(float(data[name]), 1)
+    data['total_price'] = round(float(data['total_price']), 6)
+    # Streaming throughput: completion tokens per second of generation time
+    data['tokens_per_second'] = round(completion / (duration_ms / 1000), 2) if duration_ms else None
+    return {key: data.pop(key), **data}
+
+
+async def usage_by_user(
+    db: AsyncSession,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    limit: int = 100
+) -> List[Dict[str, Any]]:
+    """Per-user totals, heaviest token users first"""
+    query = _ai_messages(select(Message.user_id, *_aggregate_columns()), start, end)
+    query = query.group_by(Message.user_id).order_by(desc('total_tokens')).limit(limit)
+    result = await db.execute(query)
+    return [_row_to_dict(row, 'user_id') for row in result]
+
+
+async def usage_by_hour(
+    db: AsyncSession,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    user_id: Optional[str] = None
+) -> List[Dict[str, Any]]:
+    """Per-hour totals (UTC), oldest first"""
+    hour = func.strftime('%Y-%m-%dT%H:00:00Z', Message.created_at).label('hour')
+    query = _ai_messages(select(hour, *_aggregate_columns()), start, end)
+    if user_id:
+        query = query.where(Message.user_id == user_id)
+    result = await db.execute(query.group_by(hour).order_by(hour))
+    return [_row_to_dict(row, 'hour') for row in result]
+
+
+async def slowest_messages(
+    db: AsyncSession,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    limit: int = 20
+) -> List[Dict[str, Any]]:
+    """AI messages with the longest generation time, with the prompt that caused them"""
+    duration = _field('$.duration_ms')
+    query = _ai_messages(select(Message), start, end)
+    query = query.where(duration.isnot(None)).order_by(desc(duration)).limit(limit)
+    messages = (await db.execute(query)).scalars().all()
+
+    metadata = {m.message_id: _load_metadata(m.message_metadata) for m in messages}
+    prompt_ids = [md.get('prompt_message_id') for md in metadata.values() if md.get('prompt_message_id')]
+    prompts = {}
+    if prompt_ids:
+        result = await db.execute(
+            select(Message.message_id, Message.content).where(Message.message_id.in_(prompt_ids))
+        )
+        prompts = dict(result.all())
+
+    slowest = []
+    for message in messages:
+        md = metadata[message.message_id]
+        slowest.append({
+            'message_id': message.message_id,
+            'user_id': message.user_id,
+            'conversation_id': message.conversation_id,
+            'created_at': message.created_at.isoformat() if message.created_at else None,
+            'prompt': prompts.get(md.get('prompt_message_id')),
+            'duration_ms': md.get('duration_ms'),
+            'ttft_ms': md.get('ttft_ms'),
+            'chunk_count': md.get('chunk_count'),
+            'usage': md.get('usage'),
+            'upstream': md.get('upstream'),
+        })
+    return slowest
@@ -0,0 +1,55 @@
+"""
+Wire encodings for the MindWeb WebSocket transport
+JSON text frames by default, MessagePack binary frames when available
+"""
+
+import json
+from typing import Any, Dict, List, Optional, Union
+
+try:
+    import msgpack
+except ImportError:  # msgpack is optional; JSON framing always works
+    msgpack = None
+
+# WebSocket subprotocol names offered by clients, in server preference order
+SUBPROTOCOL_MSGPACK = "mindweb.msgpack"
+SUBPROTOCOL_JSON = "mindweb.json"
+
+
+def supported_subprotocols() -> List[str]:
+    """Subprotocols this server can speak, most compact first"""
+    if msgpack is not None:
+        return [SUBPROTOCOL_MSGPACK, SUBPROTOCOL_JSON]
+    return [SUBPROTOCOL_JSON]
+
+
+def negotiate_subprotocol(requested: List[str]) -> Optional[str]:
+    """Pick the best subprotocol requested by the client, or None for plain JSON"""
+    for candidate in supported_subprotocols():
+        if candidate in requested:
+            return candidate
+    return None
+
+
+def is_binary(subprotocol: Optional[str]) -> bool:
+    return subprotocol == SUBPROTOCOL_MSGPACK
+
+
+def encode_frame(message: Dict[str, Any], binary: bool) -> Union[bytes, str]:
+    """Encode an event for the wire"""
+    if binary:
+        return msgpack.packb(message, use_bin_type=True)
+    return json.dumps(message, ensure_ascii=False)
+
+
+def decode_frame(data: Union[bytes, str]) -> Dict[str, Any]:
+    """Decode a client frame; bytes are MessagePack, text is JSON"""
+    if isinstance(data, (bytes, bytearray)):
+        if msgpack is None:
+            raise ValueError("Binary frames require msgpack")
+        decoded = msgpack.unpackb(data, raw=False)
+    else:
+        decoded = json.loads(data)
+    if not isinstance(decoded, dict):
+        raise ValueError("Frame must be an object")
+    return decoded
@@ -0,0 +1,107 @@
+"""
+Transparent compression of large text columns
+Values at or above a size threshold are stored as a BLOB: one format byte
+followed by a zlib stream. Smaller values, and values that would not shrink,
+stay plain TEXT. Reads accept both, so compression can be switched on or off
+at any time.
+
+    COMPRESS_CONTENT=false      # compress new messages on write
+    COMPRESS_MIN_BYTES=1024     # smaller values are stored as-is
+    COMPRESS_LEVEL=6            # zlib level 1 (fast) .. 9 (small)
+(read through app.settings; reloadable)
+"""
+
+import time
+import zlib
+from typing import Optional, Union
+
+from sqlalchemy.types import Text, TypeDecorator
+
+from app.settings import get_settings
+
+# Leading format byte of a compressed value (room for other codecs later)
+FORMAT_ZLIB = b'\x01'
+
+
+class CompressionStats:
+    """Bytes saved and CPU spent by this process"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.compressed = 0
+        self.skipped = 0
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+        self.compress_seconds = 0.0
+        self.decompressed = 0
+        self.decompress_seconds = 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            'compressed': self.compressed,
+            'skipped_incompressible': self.skipped,
+            'raw_bytes': self.raw_bytes,
+            'stored_bytes': self.stored_bytes,
+            'bytes_saved': self.raw_bytes - self.stored_bytes,
+            'compress_ms': round(self.compress_seconds * 1000, 1),
+            'avg_compress_us': round(self.compress_seconds * 1e6 / self.compressed, 1) if self.compressed else None,
+            'decompressed': self.decompressed,
+            'decompress_ms': round(self.decompress_seconds * 1000, 1),
+            'avg_decompress_us': round(self.decompress_seconds * 1e6 / self.decompressed, 1) if self.decompressed else None,
+        }
+
+
+compression_stats = CompressionStats()
+
+
+def compress_text(value: str, min_bytes: int, level: int = 6) -> Union[str, bytes]:
+    """Compressed form of value, or value itself when small or incompressible"""
+    raw = value.encode('utf-8')
+    if len(raw) < min_bytes:
+        return value
+    started = time.perf_counter()
+    packed = FORMAT_ZLIB + zlib.compress(raw, level)
+    compression_stats.compress_seconds += time.perf_counter() - started
+    if len(packed) >= len(raw):
+        compression_stats.skipped += 1
+        return value
+    compression_stats.compressed += 1
+    compression_stats.raw_bytes += len(raw)
+    compression_stats.stored_bytes += len(packed)
+    return packed
+
+
+def decompress_text(value: Union[str, bytes, None]) -> Optional[str]:
+    """Plain text for a stored value in either form"""
+    if value is None or isinstance(value, str):
+        return value
+    started = time.perf_counter()
+    value = bytes(value)
+    if value[:1] != FORMAT_ZLIB:
+        raise ValueError(f"Unknown compressed format {value[:1]!r}")
+    text = zlib.decompress(value[1:]).decode('utf-8')
+    compression_stats.decompressed += 1
+    compression_stats.decompress_seconds += time.perf_counter() - started
+    return text
+
+
+class CompressedText(TypeDecorator):
+    """Text column that compresses large values on write (when enabled) and
+    decompresses on read. Declared TEXT; SQLite keeps BLOB values as BLOBs."""
+
+    impl = Text
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None or isinstance(value, bytes):
+            # Already in storage form (used by the migration tool)
+            return value
+        settings = get_settings()
+        if not settings.compress_content:
+            return value
+        return compress_text(value, settings.compress_min_bytes, settings.compress_level)
+
+    def process_result_value(self, value, dialect):
+        return decompress_text(value)
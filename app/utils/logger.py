@@ -6,6 +6,7 @@ import logging
 import os
 import sys
 from datetime import datetime
+from typing import Optional
 
 _FORMAT = '%(asctime)s | %(levelname)-5s | %(name)-15s | %(message)s'
 _DATEFMT = '%H:%M:%S'
@@ -52,7 +53,7 @@ def configure_logging() -> None:
     for name in noisy:
         logging.getLogger(name).setLevel(logging.WARNING if level > logging.DEBUG else level)
 
-def setup_logger(name: str, level: int | None = None) -> logging.Logger:
+def setup_logger(name: str, level: Optional[int] = None) -> logging.Logger:
     """Get a named logger using centralized configuration.
     If level is None, uses LOG_LEVEL from environment."""
     if level is None:
@@ -79,9 +80,13 @@ class ColorFormatter(logging.Formatter):
         'RESET': '\u001b[0m',
     }
 
+    def __init__(self, *args, use_color: Optional[bool] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Decided once per formatter rather than per log line
+        self.use_color = _color_enabled() if use_color is None else use_color
+
     def format(self, record: logging.LogRecord) -> str:
-        use_color = (os.getenv('LOG_COLOR', 'true').lower() != 'false')
-        if use_color:
+        if self.use_color:
             levelname = record.levelname
             color = self.COLORS.get(levelname, '')
             reset = self.COLORS['RESET'] if color else ''
@@ -89,8 +94,12 @@ class ColorFormatter(logging.Formatter):
         return super().format(record)
 
 
+def _color_enabled() -> bool:
+    return os.getenv('LOG_COLOR', 'true').lower() != 'false'
+
+
 def _build_formatter() -> logging.Formatter:
-    if os.getenv('LOG_COLOR', 'true').lower() == 'false':
+    if not _color_enabled():
         return logging.Formatter(_FORMAT, datefmt=_DATEFMT)
     return ColorFormatter(_FORMAT, datefmt=_DATEFMT)
 
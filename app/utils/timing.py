@@ -0,0 +1,26 @@
+"""
+Lightweight phase timing for request pipelines
+"""
+
+import time
+from typing import Dict
+
+
+class PhaseTimer:
+    """Records milliseconds elapsed since creation at named points in a request.
+    Phases may be marked from concurrent tasks; each name keeps its first mark."""
+
+    def __init__(self):
+        self._start = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+
+    def mark(self, phase: str) -> float:
+        elapsed = round((time.perf_counter() - self._start) * 1000, 1)
+        self.phases.setdefault(phase, elapsed)
+        return elapsed
+
+    def elapsed_ms(self) -> float:
+        return round((time.perf_counter() - self._start) * 1000, 1)
+
+    def summary(self) -> str:
+        return ", ".join(f"{name}={ms}ms" for name, ms in sorted(self.phases.items(), key=lambda kv: kv[1]))
@@ -5,7 +5,9 @@ FastAPI + Uvicorn Application with Dify AI Integration
 """
 
 import uvicorn
+import asyncio
 import os
+import signal
 import sys
 from dotenv import load_dotenv
 
@@ -22,8 +24,17 @@ from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 
 from app.database import init_db
-from app.dify_client import AsyncDifyClient
-from app.routes import chat, users
+from app.search import init_search
+from app.conversations import backfill_summaries
+from app.retention import retention_loop
+from app.stream_registry import stream_registry
+from app.connection_registry import connection_registry
+from app.broadcast_manager import broadcast_manager
+from app.event_journal import EventJournal
+from app.settings import get_settings, reload_settings, on_reload
+from app.dify_pool import DifyPool
+from app.routes import chat, users, admin, stats
+from app import analytics
 from app.utils.logger import setup_logger, configure_logging, get_uvicorn_log_config
  
 
@@ -37,22 +48,74 @@ async def lifespan(app: FastAPI):
     configure_logging()
     logger.info("Starting MindWeb FastAPI Application")
     
+    # Typed settings, loaded once and shared through app.state
+    settings = get_settings()
+    app.state.settings = settings
+    on_reload(lambda s: setattr(app.state, 'settings', s))
+    
     # Initialize database
     await init_db()
     logger.info("Database initialized")
+    if await init_search():
+        logger.info("Search index ready")
+    filled = await backfill_summaries()
+    if filled:
+        logger.info(f"Conversation summaries backfilled for {filled} conversations")
     
-    # Initialize Dify client
-    app.state.dify_client = AsyncDifyClient(
-        api_key=os.getenv("DIFY_API_KEY"),
-        api_url=os.getenv("DIFY_API_URL", "http://dify.mindspringedu.com/v1")
-    )
+    loop = asyncio.get_running_loop()
+    stream_registry.bind_loop(loop)
+    # SIGHUP re-reads .env (also available as POST /api/admin/settings/reload)
+    if hasattr(signal, 'SIGHUP'):
+        try:
+            loop.add_signal_handler(signal.SIGHUP, reload_settings)
+        except (NotImplementedError, RuntimeError):
+            pass
+    
+    # Initialize Dify client (one or more backends, see DIFY_BACKENDS)
+    app.state.dify_client = DifyPool.from_settings(settings)
     logger.info("Dify client initialized")
     # In-memory mapping: our conversation_id -> Dify conversation_id
     app.state.dify_conversations = {}
     
+    # Scheduled retention/archival of old messages (off by default)
+    retention_task = None
+    if settings.retention_enabled:
+        retention_task = asyncio.create_task(retention_loop(settings.retention_interval_hours))
+        logger.info("Retention job scheduled")
+    
+    # Broadcast history from before the restart, so Last-Event-ID resume keeps working
+    journal_task = None
+    if settings.journal_enabled:
+        journal = EventJournal.from_settings(settings)
+        broadcast_manager.attach_journal(journal)
+        on_reload(journal.apply_settings)
+        journal_task = asyncio.create_task(journal.flush_loop())
+    
+    # Close broadcast connections whose client stopped reading
+    reaper_task = asyncio.create_task(connection_registry.reap_loop())
+    # One keepalive ticker for all idle SSE listeners
+    heartbeat_task = asyncio.create_task(broadcast_manager.heartbeat_loop())
+    # Drop minute analytics buckets past their retention window
+    analytics_task = asyncio.create_task(analytics.prune_loop())
+    # Cancel AI streams past their first-byte, idle or total deadline
+    watchdog_task = asyncio.create_task(stream_registry.watchdog_loop())
+    
     yield
     
     # Shutdown
+    reaper_task.cancel()
+    heartbeat_task.cancel()
+    analytics_task.cancel()
+    watchdog_task.cancel()
+    if retention_task:
+        retention_task.cancel()
+    # Normally already triggered by the exit signal (see MindWebServer); this
+    # covers servers started another way, e.g. `uvicorn main:app`
+    await stream_registry.cancel_all('shutdown')
+    # After cancellation, so the cancelled events are journaled too
+    if journal_task:
+        journal_task.cancel()
+        broadcast_manager.journal.close()
     if hasattr(app.state, 'dify_client'):
         await app.state.dify_client.close()
     logger.info("MindWeb application shutdown")
@@ -77,6 +140,8 @@ app.add_middleware(
 # Include routers
 app.include_router(chat.router, prefix="/api/chat", tags=["chat"])
 app.include_router(users.router, prefix="/api/users", tags=["users"])
+app.include_router(admin.router, prefix="/api/admin", tags=["admin"])
+app.include_router(stats.router, prefix="/api/stats", tags=["stats"])
 
 # Serve static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -99,6 +164,15 @@ async def health_check():
         "version": "2.0.0"
     }
 
+class MindWebServer(uvicorn.Server):
+    """Uvicorn server that cancels active AI streams as soon as shutdown starts.
+    Uvicorn waits for in-flight requests before running lifespan shutdown, so
+    without this a long answer would hold the process for the whole grace period."""
+
+    def handle_exit(self, sig, frame):
+        stream_registry.request_shutdown(timeout=3.0)
+        super().handle_exit(sig, frame)
+
 def main():
     """Start the FastAPI application with Uvicorn"""
     
@@ -113,8 +187,8 @@ def main():
     ╚═╝     ╚═╝╚═╝╚═╝  ╚═══╝╚═════╝ ╚═╝     ╚═╝╚═╝  ╚═╝   ╚═╝   ╚══════╝
 ================================================================================
 """
-    # Get port from environment variable
-    port = int(os.getenv("PORT", 9530))
+    settings = get_settings()
+    port = settings.port
     
     print(banner)
     print("MindWeb Chatroom - FastAPI + Uvicorn")
@@ -134,7 +208,7 @@ def main():
     )
     
     # Start the application
-    uvicorn.run(
+    config = uvicorn.Config(
         app,
         host="0.0.0.0",
         port=port,
@@ -144,8 +218,10 @@ def main():
         access_log=False,  # access logs are noisy; app logs still show requests if needed
         loop="asyncio",
         timeout_keep_alive=5,
-        timeout_graceful_shutdown=5  # Increased grace period for proper cleanup
+        timeout_graceful_shutdown=5,  # Increased grace period for proper cleanup
+        ws_per_message_deflate=settings.ws_per_message_deflate
     )
+    MindWebServer(config).run()
 
 if __name__ == "__main__":
     main()
@@ -10,7 +10,16 @@ class MindWebChatroom {
         this.username = this.loadOrGenerateUsername();
         this.userEmoji = this.loadOrGenerateEmoji();
         this.conversationId = null;
+        // Optional room (e.g. a class) from ?room=...; defaults to the server lobby
+        this.room = new URLSearchParams(window.location.search).get('room') || null;
         this.eventSource = null;
+        this.ws = null;
+        // Per-tab id so the server can replace this tab's stale connection on reconnect
+        this.tabId = this.loadOrGenerateTabId();
+        // Secret sent with this tab's questions; only its holder can stop their answers
+        this.cancelToken = this.newIdempotencyKey();
+        this.wsRefSeq = 0;
+        this.wsPendingAcks = {}; // ref -> { resolve, reject }
         this.aiMessageBuffer = '';
         this.lang = localStorage.getItem('lang') || 'zh';
         this.webUrl = null;
@@ -69,11 +78,12 @@ class MindWebChatroom {
         this.applyTranslations();
         this.fetchConfig();
         this.loadInitialHistory();
-        this.connectSSE();
+        this.connectRealtime();
         this.trackUserVisit();
         this.loadOnlineUsers();
         // Streaming/UI state
         this.streamState = {}; // key: stream_id -> { fullText, isStreaming, el, expanded, conversationId }
+        this.lastEventId = 0; // newest broadcast event seen; sent on reconnect to resume
         this.streamingCount = 0;
         // Markdown renderer (full support) with sanitization handled via DOMPurify
         this.md = (window.markdownit ? window.markdownit({ html: false, linkify: true, breaks: true }) : null);
@@ -104,12 +114,13 @@ class MindWebChatroom {
             for (const msg of data.messages) {
                 const isAi = msg.message_type === 'ai';
                 const el = isAi
-                    ? this.buildMessageElement('ai', msg.content, this.t('mindmateMeta'), '🐈‍⬛')
+                    ? this.buildMessageElement('ai', msg.content, this.t('mindmateMeta'), '🐈‍⬛', msg.content_html)
                     : this.buildMessageElement(
                         (msg.user_id && msg.user_id === this.userId) ? 'user' : 'other',
                         msg.content,
                         (msg.user_id && msg.user_id === this.userId) ? this.username : (msg.username || 'User'),
-                        (msg.user_id && msg.user_id === this.userId) ? this.userEmoji : '😀'
+                        (msg.user_id && msg.user_id === this.userId) ? this.userEmoji : '😀',
+                        msg.content_html
                       );
                 frag.appendChild(el);
             }
@@ -124,7 +135,7 @@ class MindWebChatroom {
         }
     }
 
-    buildMessageElement(type, content, username, emoji = '😀') {
+    buildMessageElement(type, content, username, emoji = '😀', html = null) {
         const messageDiv = document.createElement('div');
         let cls = 'message';
         if (type === 'user') {
@@ -142,7 +153,7 @@ class MindWebChatroom {
 
         const contentDiv = document.createElement('div');
         contentDiv.className = 'message-content';
-        contentDiv.innerHTML = this.renderMarkdown(content);
+        contentDiv.innerHTML = this.messageHtml(content, html);
 
         const metaDiv = document.createElement('div');
         metaDiv.className = 'message-meta';
@@ -168,14 +179,14 @@ class MindWebChatroom {
             for (const msg of data.messages) {
                 const isAi = msg.message_type === 'ai';
                 if (isAi) {
-                    this.addMessage('ai', msg.content, this.t('mindmateMeta'), '🐈‍⬛');
+                    this.addMessage('ai', msg.content, this.t('mindmateMeta'), '🐈‍⬛', msg.content_html);
                     continue;
                 }
                 const isMine = msg.user_id && msg.user_id === this.userId;
                 if (isMine) {
-                    this.addMessage('user', msg.content, this.username, this.userEmoji);
+                    this.addMessage('user', msg.content, this.username, this.userEmoji, msg.content_html);
                 } else {
-                    this.addMessage('other', msg.content, (msg.username || 'User'), '😀');
+                    this.addMessage('other', msg.content, (msg.username || 'User'), '😀', msg.content_html);
                 }
             }
         } catch (e) {
@@ -363,6 +374,20 @@ class MindWebChatroom {
         }
     }
     
+    loadOrGenerateTabId() {
+        let tabId = sessionStorage.getItem('tabId');
+        if (!tabId) {
+            tabId = 'tab_' + Math.random().toString(36).substr(2, 9);
+            sessionStorage.setItem('tabId', tabId);
+        }
+        return tabId;
+    }
+    
+    reconnectDelay() {
+        // Jitter spreads reconnects out after a server restart or network blip
+        return 3000 + Math.floor(Math.random() * 4000);
+    }
+    
     generateUserId() {
         return 'user_' + Math.random().toString(36).substr(2, 9);
     }
@@ -468,19 +493,27 @@ class MindWebChatroom {
         try {
             console.log('Sending to MindMate:', content);
             
-            const response = await fetch('/api/chat/stream', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-                body: JSON.stringify({
-                    message: content,
-                    user_id: this.userId,
-                    conversation_id: this.conversationId,
-                    username: this.username,
-                    emoji: this.userEmoji
-                })
-            });
+            // One key per submission: retries (and an HTTP fallback after a dropped
+            // WebSocket) reuse it so the server never generates the answer twice
+            const idempotencyKey = this.newIdempotencyKey();
+            if (this.isWebSocketOpen()) {
+                const ack = await this.sendOverWebSocket('ai', content, idempotencyKey).catch(() => null);
+                if (ack) {
+                    if (ack.status === 'error') throw new Error(ack.detail || 'Failed to send message to MindMate');
+                    if (ack.conversation_id) this.conversationId = ack.conversation_id;
+                    return;
+                }
+            }
+            
+            const response = await this.postSubmission('/api/chat/stream', {
+                message: content,
+                user_id: this.userId,
+                conversation_id: this.conversationId,
+                username: this.username,
+                emoji: this.userEmoji,
+                room: this.room,
+                cancel_token: this.cancelToken
+            }, idempotencyKey);
             
             if (!response.ok) {
                 const errorData = await response.json().catch(() => ({ detail: 'Unknown error' }));
@@ -503,19 +536,24 @@ class MindWebChatroom {
         try {
             console.log('Sending group message:', content);
             
+            const idempotencyKey = this.newIdempotencyKey();
+            if (this.isWebSocketOpen()) {
+                const ack = await this.sendOverWebSocket('group', content, idempotencyKey).catch(() => null);
+                if (ack) {
+                    if (ack.status === 'error') throw new Error(ack.detail || 'Failed to send group message');
+                    return;
+                }
+            }
+            
             // For group chat, do not trigger Dify. Use group endpoint.
-            const response = await fetch('/api/chat/group', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-                body: JSON.stringify({
-                    message: content,
-                    user_id: this.userId,
-                    username: this.username,
-                    emoji: this.userEmoji
-                })
-            });
+            const response = await this.postSubmission('/api/chat/group', {
+                message: content,
+                user_id: this.userId,
+                username: this.username,
+                emoji: this.userEmoji,
+                room: this.room,
+                cancel_token: this.cancelToken
+            }, idempotencyKey);
             
             if (!response.ok) {
                 const errorData = await response.json().catch(() => ({ detail: 'Unknown error' }));
@@ -530,32 +568,158 @@ class MindWebChatroom {
         }
     }
     
+    connectRealtime() {
+        // Prefer a single WebSocket for sends and events; fall back to SSE + fetch
+        if (!window.WebSocket) {
+            this.connectSSE();
+            return;
+        }
+        const proto = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
+        const params = new URLSearchParams({
+            user_id: this.userId,
+            username: this.username,
+            emoji: this.userEmoji,
+            tab_id: this.tabId
+        });
+        if (this.room) params.set('rooms', this.room);
+        if (this.lastEventId) params.set('last_event_id', this.lastEventId);
+        let opened = false;
+        let ws;
+        try {
+            ws = new WebSocket(`${proto}//${window.location.host}/api/chat/ws?${params}`, ['mindweb.json']);
+        } catch (e) {
+            console.warn('WebSocket unavailable, using SSE', e);
+            this.connectSSE();
+            return;
+        }
+        this.ws = ws;
+        
+        ws.onopen = () => {
+            opened = true;
+            console.log('WebSocket connection opened');
+        };
+        
+        ws.onmessage = (event) => {
+            try {
+                const data = JSON.parse(event.data);
+                if (data.type === 'ack') {
+                    const pending = this.wsPendingAcks[data.ref];
+                    if (pending) {
+                        delete this.wsPendingAcks[data.ref];
+                        pending.resolve(data);
+                    }
+                    return;
+                }
+                this.handleSSEMessage(data);
+            } catch (error) {
+                console.error('Error parsing WebSocket message:', error);
+            }
+        };
+        
+        ws.onclose = (event) => {
+            if (this.ws === ws) this.ws = null;
+            for (const ref of Object.keys(this.wsPendingAcks)) {
+                this.wsPendingAcks[ref].reject(new Error('Connection closed'));
+                delete this.wsPendingAcks[ref];
+            }
+            if (!opened) {
+                // WebSocket blocked (proxy, firewall): use SSE for this session
+                console.warn('WebSocket failed, falling back to SSE');
+                this.connectSSE();
+                return;
+            }
+            if (event.code === 4000 && event.reason === 'replaced') {
+                // A newer connection from this tab took over
+                return;
+            }
+            setTimeout(() => this.connectRealtime(), this.reconnectDelay());
+        };
+    }
+    
+    isWebSocketOpen() {
+        return this.ws && this.ws.readyState === WebSocket.OPEN;
+    }
+    
+    newIdempotencyKey() {
+        if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+        return `${Date.now().toString(36)}-${Math.random().toString(36).substr(2, 12)}`;
+    }
+    
+    async postSubmission(url, body, idempotencyKey) {
+        // Retry once on a network failure; the key makes the retry safe
+        const request = () => fetch(url, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'Idempotency-Key': idempotencyKey
+            },
+            body: JSON.stringify(body)
+        });
+        try {
+            return await request();
+        } catch (error) {
+            console.warn('Send failed, retrying once:', error);
+            return await request();
+        }
+    }
+    
+    sendOverWebSocket(mode, content, idempotencyKey) {
+        const ref = `r${++this.wsRefSeq}`;
+        return new Promise((resolve, reject) => {
+            this.wsPendingAcks[ref] = { resolve, reject };
+            this.ws.send(JSON.stringify({
+                op: 'send',
+                ref,
+                mode,
+                message: content,
+                user_id: this.userId,
+                conversation_id: mode === 'ai' ? this.conversationId : null,
+                username: this.username,
+                emoji: this.userEmoji,
+                room: this.room,
+                cancel_token: mode === 'ai' ? this.cancelToken : null,
+                idempotency_key: idempotencyKey
+            }));
+        });
+    }
+    
     connectSSE() {
         console.log('Connecting to SSE...');
-        this.eventSource = new EventSource('/api/chat/broadcast');
+        // EventSource resends Last-Event-ID on its own retries; a fresh EventSource needs it in the query
+        const params = new URLSearchParams({ user_id: this.userId, tab_id: this.tabId });
+        if (this.room) params.set('rooms', this.room);
+        if (this.lastEventId) params.set('last_event_id', this.lastEventId);
+        const source = new EventSource(`/api/chat/broadcast?${params}`);
+        this.eventSource = source;
         
-        this.eventSource.onopen = () => {
+        source.onopen = () => {
             console.log('SSE connection opened');
         };
         
-        this.eventSource.onmessage = (event) => {
+        source.onmessage = (event) => {
             try {
                 const data = JSON.parse(event.data);
+                if (data.type === 'closed' && data.reason === 'replaced') {
+                    // A newer connection from this tab took over; stop this one retrying
+                    source.close();
+                    return;
+                }
                 this.handleSSEMessage(data);
             } catch (error) {
                 console.error('Error parsing SSE message:', error);
             }
         };
         
-        this.eventSource.onerror = (error) => {
+        source.onerror = (error) => {
             console.error('SSE connection error:', error);
-            // Attempt to reconnect after 5 seconds
+            // EventSource retries by itself (server sends a jittered retry:); if the
+            // connection was refused outright (e.g. 429), reconnect after a jittered delay
             setTimeout(() => {
-                if (this.eventSource.readyState === EventSource.CLOSED) {
+                if (this.eventSource === source && source.readyState === EventSource.CLOSED) {
                     console.log('Attempting to reconnect SSE...');
                     this.connectSSE();
                 }
-            }, 5000);
+            }, this.reconnectDelay());
         };
     }
     
@@ -563,12 +727,13 @@ class MindWebChatroom {
         console.log('Received SSE message:', data);
         // expose last event for initial stream metadata consumption
         window.lastSSEData = data;
+        if (data.event_id > this.lastEventId) this.lastEventId = data.event_id;
         
         switch (data.type) {
             case 'user_message':
                 // Only show messages from other users (left side)
                 if (data.from_user_id !== this.userId) {
-                    this.addMessage('other', data.content, data.from_user, data.emoji);
+                    this.addMessage('other', data.content, data.from_user, data.emoji, data.content_html);
                 }
                 break;
                 
@@ -576,16 +741,39 @@ class MindWebChatroom {
                 this.addAIMessageChunk(data.content, data.from_user, data.conversation_id, data.stream_id);
                 break;
                 
+            case 'ai_stream_snapshot':
+                this.applyStreamSnapshot(data);
+                break;
+                
             case 'ai_message_end':
-                this.finishAIMessage(data.stream_id);
+                this.applyFinalText(data);
+                this.finishAIMessage(data.stream_id, '', data.content_html);
+                break;
+                
+            case 'ai_message_cancelled':
+                this.applyFinalText(data);
+                this.finishAIMessage(data.stream_id, 'Cancelled');
+                break;
+                
+            case 'ai_message_timeout':
+                this.applyFinalText(data);
+                this.finishAIMessage(data.stream_id, 'Timed out');
                 break;
                 
             case 'error':
                 this.addSystemMessage(`Error: ${data.error}`);
                 break;
                 
+            case 'closed':
             case 'ping':
-                // Keep-alive ping - no action needed
+            case 'pong':
+            case 'hello':
+            case 'subscribed':
+                // Keep-alive / handshake - no action needed
+                break;
+                
+            case 'presence':
+                if (data.user_id !== this.userId) this.refreshOnlineUsersSoon();
                 break;
                 
             default:
@@ -593,7 +781,7 @@ class MindWebChatroom {
         }
     }
     
-    addMessage(type, content, username, emoji = '😀') {
+    addMessage(type, content, username, emoji = '😀', html = null) {
         const messageDiv = document.createElement('div');
         // Right-align only 'user'. Map 'other' to left bubble style like AI.
         let cls = 'message';
@@ -612,7 +800,7 @@ class MindWebChatroom {
         
         const contentDiv = document.createElement('div');
         contentDiv.className = 'message-content';
-        contentDiv.innerHTML = this.renderMarkdown(content);
+        contentDiv.innerHTML = this.messageHtml(content, html);
         
         const metaDiv = document.createElement('div');
         metaDiv.className = 'message-meta';
@@ -658,6 +846,7 @@ class MindWebChatroom {
             if (d && d.stream_id === streamId) {
                 state.replyTo = d.reply_to_username || '';
                 state.prompt = d.prompt || '';
+                state.ownerId = d.reply_to_user_id || '';
                 state.replySet = true;
             }
         }
@@ -665,6 +854,25 @@ class MindWebChatroom {
         this.scrollToBottom();
     }
 
+    applyStreamSnapshot(data) {
+        // Compacted state of an answer already in progress when we (re)connected
+        const hadState = !!this.streamState[data.stream_id];
+        this.addAIMessageChunk('', data.from_user, data.conversation_id, data.stream_id);
+        const state = this.streamState[data.stream_id];
+        if (hadState && !state.isStreaming) return;
+        state.fullText = data.content || '';
+        this.updateAIMessagePreview(state);
+        this.scrollToBottom();
+    }
+
+    applyFinalText(data) {
+        // End events carry the whole answer: replayed after the stream closed, they are all we get
+        if (typeof data.content !== 'string' || !data.content) return;
+        const state = this.streamState[data.stream_id];
+        if (state && !state.isStreaming) return;
+        this.applyStreamSnapshot(data);
+    }
+
     createAIMessageCard() {
         const aiMessage = document.createElement('div');
         aiMessage.className = 'message ai ai-message-streaming';
@@ -694,10 +902,16 @@ class MindWebChatroom {
             this.updateAIMessagePreview(st);
             toggleBtn.textContent = st.expanded ? 'Collapse' : 'Show full';
         });
+        const stopBtn = document.createElement('button');
+        stopBtn.className = 'ai-toggle-btn ai-stop-btn';
+        stopBtn.textContent = 'Stop';
+        stopBtn.style.display = 'none';
+        stopBtn.addEventListener('click', () => this.cancelStream(aiMessage.dataset.streamId));
         const statusSpan = document.createElement('span');
         statusSpan.className = 'ai-status';
         statusSpan.textContent = 'Streaming…';
         controlsDiv.appendChild(toggleBtn);
+        controlsDiv.appendChild(stopBtn);
         controlsDiv.appendChild(statusSpan);
         contentDiv.appendChild(metaDiv);
         contentDiv.appendChild(replyDiv);
@@ -713,9 +927,10 @@ class MindWebChatroom {
         const previewDiv = el.querySelector('.ai-preview');
         const replyDiv = el.querySelector('.ai-reply');
         const statusSpan = el.querySelector('.ai-status');
+        const stopBtn = el.querySelector('.ai-stop-btn');
         if (!previewDiv) return;
         if (state.expanded) {
-            previewDiv.innerHTML = this.renderMarkdown(state.fullText);
+            previewDiv.innerHTML = this.messageHtml(state.fullText, state.html);
             previewDiv.classList.remove('clamped');
         } else {
             const preview = this.firstNLines(state.fullText, 5);
@@ -727,11 +942,14 @@ class MindWebChatroom {
             const prompt = state.prompt ? ` — ${this.escapeHtmlInline(state.prompt)}` : '';
             replyDiv.innerHTML = (atUser || prompt) ? `${atUser}${prompt}` : '';
         }
+        if (stopBtn) {
+            stopBtn.style.display = (state.isStreaming && state.ownerId === this.userId) ? '' : 'none';
+        }
         if (state.isStreaming) {
             statusSpan.innerHTML = '<span class="streaming-dots">● ● ●</span>';
             statusSpan.classList.add('streaming');
         } else {
-            statusSpan.textContent = '';
+            statusSpan.textContent = state.endStatus || '';
             statusSpan.classList.remove('streaming');
         }
     }
@@ -752,6 +970,11 @@ class MindWebChatroom {
         return first;
     }
 
+    messageHtml(text, html) {
+        // Prefer HTML the server already rendered and sanitized; render locally otherwise
+        return (typeof html === 'string') ? html : this.renderMarkdown(text);
+    }
+
     renderMarkdown(text) {
         if (!text) return '';
         try {
@@ -809,11 +1032,30 @@ class MindWebChatroom {
         this.imgModalImg.src = '';
     }
     
-    finishAIMessage(streamId) {
+    async cancelStream(streamId) {
+        if (!streamId) return;
+        try {
+            const response = await fetch(`/api/chat/stream/${encodeURIComponent(streamId)}/cancel`, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ cancel_token: this.cancelToken })
+            });
+            if (!response.ok) {
+                const errorData = await response.json().catch(() => ({ detail: 'Unknown error' }));
+                console.warn('Cancel failed:', errorData.detail);
+            }
+        } catch (error) {
+            console.error('Error cancelling stream:', error);
+        }
+    }
+    
+    finishAIMessage(streamId, endStatus = '', html = null) {
         if (!streamId) return;
         const state = this.streamState[streamId];
-        if (!state) return;
+        if (!state || !state.isStreaming) return;
         state.isStreaming = false;
+        state.endStatus = endStatus;
+        state.html = html; // server-rendered full answer, if the server renders markdown
         if (state.el) state.el.classList.remove('ai-message-streaming');
         this.updateAIMessagePreview(state);
         this.decrementStreaming(streamId);
@@ -946,6 +1188,23 @@ class MindWebChatroom {
         }, 30000);
     }
     
+    refreshOnlineUsersSoon() {
+        // Coalesce bursts of presence events into one refresh
+        if (this.presenceRefreshTimer) return;
+        this.presenceRefreshTimer = setTimeout(async () => {
+            this.presenceRefreshTimer = null;
+            try {
+                const response = await fetch('/api/users/online');
+                if (response.ok) {
+                    const data = await response.json();
+                    this.updateOnlineUsersList(data.users);
+                }
+            } catch (error) {
+                console.error('Error refreshing online users:', error);
+            }
+        }, 1000);
+    }
+    
     updateOnlineUsersList(users) {
         this.userList.innerHTML = '';
         